@@ -24,18 +24,24 @@ from __future__ import division
 from __future__ import unicode_literals
 
 import os
+from errno import ENOENT
 from keyword import kwlist
 from collections import namedtuple
+try:
+	from collections.abc import MutableMapping
+except ImportError:
+	from collections import MutableMapping
 from itertools import compress
 from functools import partial
+from operator import eq
 from inspect import getargspec
 
-from compat import unicode, uni, ifilter, imap, izip, iteritems, str_types, builtins, open
+from compat import unicode, uni, ifilter, imap, izip, iteritems, str_types, builtins, open, pickle, PY3
 
 import blob
 from extras import DotDict, job_params
 from jobid import resolve_jobid_filename
-from gzwrite import typed_writer
+from gzwrite import typed_writer, compression_kw, GzWriteBlocked, GzWriteBehind, GzWriteStats, WriteBehindPool, hll_merge, hll_estimate
 
 kwlist = set(kwlist)
 # Add some keywords that are not in all versions
@@ -47,7 +53,7 @@ kwlist.update({
 iskeyword = frozenset(kwlist).__contains__
 
 # A dataset is defined by a pickled DotDict containing at least the following (all strings are unicode):
-#     version = (3, 0,),
+#     version = (3, 5,),
 #     filename = "filename" or None,
 #     hashlabel = "column name" or None,
 #     caption = "caption",
@@ -55,8 +61,9 @@ iskeyword = frozenset(kwlist).__contains__
 #     previous = "previous_jid/datasetname" or None,
 #     parent = "parent_jid/datasetname" or None,
 #     lines = [line, count, per, slice,],
-#     cache = ((id, data), ...), # key is missing if there is no cache in this dataset
-#     cache_distance = datasets_since_last_cache, # key is missing if previous is None
+#     chain_depth = position in the chain, # 1 if previous is None (or a dataset without chain_depth)
+#     rehash_indexes = {"column name": "jobid/path/to/index"}, # key is missing if there are none
+#         the index is a pickled list per slice of the slice each row hashes to (see make_rehash_index).
 #
 # A DatasetColumn has these fields:
 #     type = "type", # something that exists in type2iter and doesn't start with _
@@ -64,20 +71,59 @@ iskeyword = frozenset(kwlist).__contains__
 #     name = "name", # a clean version of the column name, valid in the filesystem and as a python identifier.
 #     location = something, # where the data for this column lives
 #         in version 2 and 3 this is "jobid/path/to/file" if .offsets else "jobid/path/with/%s/for/sliceno"
+#         (or None if .segments is set). If .offsets is set and location still has a %s
+#         the column is in a container, one file per slice with all columns of the slice
+#         (see container in DatasetWriter).
 #     min = minimum value in this dataset or None
 #     max = maximum value in this dataset or None
 #     offsets = (offset, per, slice) or None for non-merged slices.
+#     blocks = "jobid/path/to/index" or None, (since 3.1)
+#         the index is a pickled list with [(offset, count, min, max), ...] per slice.
+#         offset is relative to the start of the slice (so add offsets[sliceno] if set).
+#     compression = "gzip", # or "none" or "gzip-1" to "gzip-9", see gzwrite.compressions (since 3.2)
+#         older versions have None here, which is the same as "gzip".
+#     dictionary = "jobid/path/to/dictionary" or None, (since 3.3)
+#         for dictionary encoded columns (written as "dict:type"), where the file has int32
+#         codes (so backing_type is "int32"). The dictionary is a pickled list per slice of
+#         the values (code -> value).
+#     segments = "jobid/path/to/segments" or None, (since 3.4)
+#         for columns where a slice is made up of parts of several files (without
+#         copying them together, see DatasetWriter.set_segments). The segments are a
+#         pickled list per slice of [("jobid/path/to/file", offset, count), ...].
+#     stats = ColumnStats or None, (since 3.5)
+#         nulls = number of None values or None if not collected (see stats in DatasetWriter)
+#         distinct = approximate number of distinct values or None if not collected
+#         size = bytes on disk (compressed) or None if not known (segments)
+#         sketch = "jobid/path/to/sketches" or None
+#             the sketches are a pickled {column.name: HyperLogLog sketch} (see gzwrite.hll_estimate)
+#             for all columns in a dataset, for merging with other datasets.
 #
 # Going from a DatasetColumn to a filename is like this for version 2 and 3 datasets:
 #     jid, path = dc.location.split('/', 1)
 #     if dc.offsets:
-#         resolve_jobid_filename(jid, path)
+#         resolve_jobid_filename(jid, path) (or path % sliceno for containers)
 #         seek to dc.offsets[sliceno], read only ds.lines[sliceno] values.
 #     else:
 #         resolve_jobid_filename(jid, path % sliceno)
-# There is a ds.column_filename function to do this for you (not the seeking, obviously).
+# There is a ds.column_location function to do this for you (giving (filename, offset)).
+# Containers end with a directory of {"column name": (offset, size)} (see _container_directory).
+# With .segments there is no single file, read count values from offset in each
+# segment in order instead. ds.column_segments gives (filename, offset, count)
+# for all columns.
 #
 # The dataset pickle is jid/name/dataset.pickle, so jid/default/dataset.pickle for the default dataset.
+#
+# The same data is also in jid/name/dataset.meta, which is faster to load (see _meta_save).
+# That is what gets loaded, the pickle is only used for datasets without a .meta (older
+# ones) and by older versions.
+#
+# If previous is set there is also a chain index in jid/name/dataset.chain.pickle, a list of
+# (id, previous, lines, hashlabel, {column: (min, max)}) for the lowbit(chain_depth) (i.e.
+# chain_depth & -chain_depth) nearest datasets before this one, nearest first. The last of
+# these has a larger lowbit, so walking a chain of length n only reads O(log(n)) indexes.
+#
+# Older datasets instead have a cache (of the data of up to 63 previous datasets) in every
+# 64th dataset. That is still used when loading them, but no longer written.
 
 def _clean_name(n, seen_n):
 	n = ''.join(c if c.isalnum() else '_' for c in n)
@@ -104,19 +150,752 @@ def _dsid(t):
 # allow still loading the old versions without messing with the constructor.
 _DatasetColumn_2_0 = namedtuple('_DatasetColumn_2_0', 'type name location min max offsets')
 _DatasetColumn_3_0 = namedtuple('_DatasetColumn_3_0', 'type backing_type name location min max offsets')
-DatasetColumn = _DatasetColumn_3_0
+_DatasetColumn_3_1 = namedtuple('_DatasetColumn_3_1', 'type backing_type name location min max offsets blocks')
+_DatasetColumn_3_2 = namedtuple('_DatasetColumn_3_2', 'type backing_type name location min max offsets blocks compression')
+_DatasetColumn_3_3 = namedtuple('_DatasetColumn_3_3', 'type backing_type name location min max offsets blocks compression dictionary')
+_DatasetColumn_3_4 = namedtuple('_DatasetColumn_3_4', 'type backing_type name location min max offsets blocks compression dictionary segments')
+_DatasetColumn_3_5 = namedtuple('_DatasetColumn_3_5', 'type backing_type name location min max offsets blocks compression dictionary segments stats')
+DatasetColumn = _DatasetColumn_3_5
+_dataset_version = (3, 5,)
+
+ColumnStats = namedtuple('ColumnStats', 'nulls distinct size sketch')
+
+ChainEntry = namedtuple('ChainEntry', 'id previous lines hashlabel minmax')
+
+def _chain_entry(d):
+	return ChainEntry(
+		id=unicode(d),
+		previous=d.previous,
+		lines=d.lines,
+		hashlabel=d.hashlabel,
+		minmax={n: (c.min, c.max,) for n, c in d.columns.items()},
+	)
+
+def _chain_index_load(d):
+	"""The chain index of d as a list of ChainEntry, or None if it has none."""
+	jid, name = _dsid(d).split('/', 1)
+	entries = blob.load('%s/dataset.chain' % (name,), jid, default=())
+	if not entries:
+		return None
+	return [ChainEntry(*e) for e in entries]
+
+# numpy dtypes for the types iterate_blocks supports
+_type2dtype = dict(
+	float64='float64',
+	float32='float32',
+	int64='int64',
+	int32='int32',
+	bits64='uint64',
+	bits32='uint32',
+	bool='bool',
+	datetime='datetime64[us]',
+	date='datetime64[D]',
+	time='timedelta64[us]',
+)
+_none_masked_types = {'int64', 'int32', 'bool'}
+
+def _time2timedelta(t):
+	if t is None:
+		return None
+	from datetime import timedelta
+	return timedelta(hours=t.hour, minutes=t.minute, seconds=t.second, microseconds=t.microsecond)
+
+def _block_array(numpy, typ, values):
+	dtype = _type2dtype[typ]
+	if typ == 'time':
+		values = list(imap(_time2timedelta, values))
+	elif typ in _none_masked_types and None in values:
+		mask = [v is None for v in values]
+		values = [0 if v is None else v for v in values]
+		return numpy.ma.masked_array(numpy.array(values, dtype=dtype), mask=mask)
+	return numpy.array(values, dtype=dtype)
+
+# Uncompressed copies of fixed width columns (for .column_buffer and
+# .column_array) are kept beside the column files as
+# "<column file>.<sliceno>.colcache.raw", with
+# "<column file>.<sliceno>.colcache.none" (one byte per row, 1 for None)
+# if there are any None values. If that directory is not writable they
+# go in the _buffer_fallback_dir directory in the current job instead. The values
+# are native memoryview/struct formats, with date/time types as int64
+# (like numpy datetime64[us]/[D] and timedelta64[us]). None is stored as
+# NaN for floats, NaT (-2**63) for date/time types and 0 otherwise.
+# When the cached files in a directory take more than buffer_cache_size
+# bytes the least recently used ones are removed. Only files with these
+# extensions are ever removed.
+_buffer_raw_ext = '.colcache.raw'
+_buffer_none_ext = '.colcache.none'
+_buffer_fallback_dir = 'colcache'
+_buffer_formats = dict(
+	float64='d',
+	float32='f',
+	int64='q',
+	int32='i',
+	bits64='Q',
+	bits32='I',
+	bool='?',
+	datetime='q',
+	date='q',
+	time='q',
+)
+# These types iterate correctly directly from the buffer.
+_buffer_iterable_types = {'float64', 'float32', 'int64', 'int32', 'bits64', 'bits32', 'bool'}
+buffer_cache_size = 4 * 1024 * 1024 * 1024
+
+# Columns where the average slice file is smaller than this are merged
+# into one file when a dataset is created. None means use the setting
+# for the workdir (see _merge_threshold).
+merge_threshold = None
+
+def set_merge_threshold(size):
+	"""Set the average slice file size (in bytes) up to which the slices
+	of a column are merged into one file. 0 disables merging, None goes
+	back to the workdir setting: a number in WORKDIR/NAME-merge.conf (next
+	to NAME-slices.conf), or 512KB if there is no such file."""
+	global merge_threshold
+	merge_threshold = size
+
+def _merge_threshold():
+	if merge_threshold is not None:
+		return merge_threshold
+	from g import JOBID
+	from jobid import get_workspace_name, get_path
+	wsname = get_workspace_name(JOBID)
+	try:
+		with open(os.path.join(get_path(JOBID), '%s-merge.conf' % (wsname,))) as fh:
+			return int(fh.read())
+	except (IOError, OSError):
+		return 524288
+
+def set_buffer_cache_size(max_size):
+	"""Set how many bytes of uncompressed column cache to keep in each
+	dataset directory. The default is 4GB."""
+	global buffer_cache_size
+	buffer_cache_size = max_size
+
+def _buffer_value_fixer(typ):
+	from datetime import datetime, date
+	nat = -2 ** 63
+	if typ in ('float64', 'float32'):
+		nan = float('nan')
+		return lambda v: nan if v is None else v
+	elif typ == 'datetime':
+		epoch = datetime(1970, 1, 1)
+		def fix(v):
+			if v is None:
+				return nat
+			td = v - epoch
+			return (td.days * 86400 + td.seconds) * 1000000 + td.microseconds
+		return fix
+	elif typ == 'date':
+		epoch = date(1970, 1, 1).toordinal()
+		return lambda v: nat if v is None else v.toordinal() - epoch
+	elif typ == 'time':
+		return lambda v: nat if v is None else ((v.hour * 60 + v.minute) * 60 + v.second) * 1000000 + v.microsecond
+	else:
+		return lambda v: 0 if v is None else v
+
+def _buffer_write(d, sliceno, col, fn):
+	"""Decompress col in slice sliceno of d to fn (and _buffer_none_fn(fn)
+	if there are None values)."""
+	from array import array
+	from itertools import islice
+	from compat import PY2
+	typ = d.columns[col].type
+	code = _buffer_formats[typ]
+	if code == '?':
+		code = 'B'
+	elif PY2 and code in 'qQ':
+		code = {'q': 'l', 'Q': 'L'}[code] # 8 bytes on all 64 bit unixes
+	fix = _buffer_value_fixer(typ)
+	none_fn = _buffer_none_fn(fn)
+	tmp_fn = '%s.%d.tmp' % (fn, os.getpid(),)
+	mask = bytearray()
+	# Giving the type explicitly makes sure we read the real column file.
+	it = d._column_iterator(sliceno, col, _type=d.columns[col].backing_type)
+	with open(tmp_fn, 'wb') as fh:
+		while True:
+			values = list(islice(it, 65536))
+			if not values:
+				break
+			mask.extend(v is None for v in values)
+			a = array(code, imap(fix, values))
+			fh.write(a.tostring() if PY2 else a.tobytes())
+	if any(mask):
+		with open(none_fn + '.tmp', 'wb') as fh:
+			fh.write(mask)
+		os.rename(none_fn + '.tmp', none_fn)
+	os.rename(tmp_fn, fn)
+
+def _buffer_none_fn(fn):
+	"""The None mask file for the cache file fn."""
+	return fn[:-len(_buffer_raw_ext)] + _buffer_none_ext
+
+def _buffer_evict(dirname, keep):
+	"""Remove the least recently used cached columns in dirname until
+	they fit in buffer_cache_size (but never keep). Only cache files
+	(named with _buffer_raw_ext and _buffer_none_ext) are touched."""
+	files = []
+	total = 0
+	for name in os.listdir(dirname):
+		if name.endswith(_buffer_raw_ext):
+			fn = os.path.join(dirname, name)
+			none_fn = _buffer_none_fn(fn)
+			try:
+				st = os.stat(fn)
+				size = st.st_size
+				if os.path.exists(none_fn):
+					size += os.stat(none_fn).st_size
+			except OSError:
+				continue # removed by someone else
+			files.append((st.st_mtime, fn, size,))
+			total += size
+	for _, fn, size in sorted(files):
+		if total <= buffer_cache_size:
+			break
+		if fn == keep:
+			continue
+		for rm_fn in (_buffer_none_fn(fn), fn,):
+			try:
+				os.unlink(rm_fn)
+			except OSError:
+				pass
+		total -= size
+
+def _buffer_name(d, col, sliceno):
+	"""The name (without extension) of the cache files for col in slice
+	sliceno of d. Merged files can have data from several datasets (see
+	_maybe_merge), so those are named by offset instead of slice."""
+	dc = d.columns[col]
+	if dc.segments:
+		jid, name = dc.segments.split('/', 1)
+		return '%s.%d' % (resolve_jobid_filename(jid, name), sliceno,)
+	if dc.offsets:
+		return '%s.@%d' % (d.column_filename(col, sliceno), dc.offsets[sliceno],)
+	return '%s.%d' % (d.column_filename(col, sliceno), sliceno,)
+
+def _buffer_map(d, sliceno, col):
+	"""(mmap or None if empty, none mask mmap or None) for col in
+	slice sliceno of d, creating the cache files if needed."""
+	from mmap import mmap, ACCESS_READ
+	from struct import calcsize
+	assert col in d.columns, "%s has no column %r" % (d, col,)
+	typ = d.columns[col].type
+	assert typ in _buffer_formats, "Column %s in %s has type %s, which is not fixed width" % (col, d, typ,)
+	lines = d.lines[sliceno]
+	if not lines:
+		return None, None
+	fn = _buffer_name(d, col, sliceno) + _buffer_raw_ext
+	want_size = lines * calcsize(_buffer_formats[typ])
+	if not os.path.exists(fn) or os.path.getsize(fn) != want_size:
+		try:
+			_buffer_write(d, sliceno, col, fn)
+		except (IOError, OSError):
+			# Probably not allowed to write there, use a cache directory
+			# in the current job (so eviction there only sees caches).
+			if not os.path.isdir(_buffer_fallback_dir):
+				try:
+					os.mkdir(_buffer_fallback_dir)
+				except OSError:
+					pass # made by another process
+			fn = os.path.join(_buffer_fallback_dir, '%s.%s%s' % (d.replace('/', '-'), os.path.basename(_buffer_name(d, col, sliceno)), _buffer_raw_ext,))
+			if not os.path.exists(fn) or os.path.getsize(fn) != want_size:
+				_buffer_write(d, sliceno, col, fn)
+		_buffer_evict(os.path.dirname(os.path.abspath(fn)), os.path.abspath(fn))
+	else:
+		os.utime(fn, None)
+	def map_file(fn):
+		with open(fn, 'rb') as fh:
+			return mmap(fh.fileno(), 0, access=ACCESS_READ)
+	none_fn = _buffer_none_fn(fn)
+	return map_file(fn), map_file(none_fn) if os.path.exists(none_fn) else None
+
+def _buffer_iterator(d, sliceno, col):
+	"""Iterator over an existing cache of col, or None."""
+	typ = d.columns[col].type
+	if not PY3 or typ not in _buffer_iterable_types or not d.lines[sliceno]:
+		return None
+	from mmap import mmap, ACCESS_READ
+	from struct import calcsize
+	fn = _buffer_name(d, col, sliceno) + _buffer_raw_ext
+	none_fn = _buffer_none_fn(fn)
+	try:
+		if os.path.getsize(fn) != d.lines[sliceno] * calcsize(_buffer_formats[typ]):
+			return None
+		with open(fn, 'rb') as fh:
+			values = memoryview(mmap(fh.fileno(), 0, access=ACCESS_READ)).cast(_buffer_formats[typ])
+		none_mm = None
+		if os.path.exists(none_fn):
+			with open(none_fn, 'rb') as fh:
+				none_mm = mmap(fh.fileno(), 0, access=ACCESS_READ)
+	except (IOError, OSError):
+		return None
+	if none_mm:
+		return (None if isnone else v for v, isnone in izip(values, memoryview(none_mm)))
+	return iter(values)
+
+def _rowsfixup(rows):
+	"""Accept a single (start, stop) or a list of them."""
+	if rows is None:
+		return None
+	rows = list(rows)
+	if len(rows) == 2 and not isinstance(rows[0], (tuple, list)):
+		rows = [rows]
+	res = []
+	for start, stop in rows:
+		assert not res or res[-1][1] <= start, "rows must be in order and not overlap"
+		res.append((start, stop,))
+	return res
+
+def _intersect_rows(a, b):
+	"""Intersection of two lists of (start, stop) row ranges (as given
+	to _column_iterator), where None means all rows."""
+	if a is None:
+		return b
+	if b is None:
+		return a
+	res = []
+	ix_a = ix_b = 0
+	while ix_a < len(a) and ix_b < len(b):
+		start = max(a[ix_a][0], b[ix_b][0])
+		stop = min(a[ix_a][1], b[ix_b][1])
+		if start < stop:
+			res.append((start, stop,))
+		if a[ix_a][1] < b[ix_b][1]:
+			ix_a += 1
+		else:
+			ix_b += 1
+	return res
+
+def _map_slice_part(a):
+	ds, sliceno, func, columns, rows, kw = a
+	return func(Dataset(ds).iterate(sliceno, columns, rows=rows, status_reporting=False, **kw))
+
+# Rows per message from the parallel iteration workers.
+_PARALLEL_BATCH = 4096
+
+def _parallel_worker(conn, to_iter, mkiter, worker, parallel):
+	"""Iterate every parallel:th entry in to_iter (starting at worker),
+	sending (ix, [row, ...]) for each batch and (ix, None) when entry
+	ix is done. Errors are sent as (None, traceback)."""
+	from itertools import islice
+	from signal import signal, SIGTERM, SIG_DFL
+	signal(SIGTERM, SIG_DFL)
+	try:
+		for ix in range(worker, len(to_iter), parallel):
+			it = mkiter(*to_iter[ix])
+			while True:
+				batch = list(islice(it, _PARALLEL_BATCH))
+				if batch:
+					conn.send((ix, batch,))
+				if len(batch) < _PARALLEL_BATCH:
+					break
+			conn.send((ix, None,))
+	except Exception:
+		from traceback import format_exc
+		conn.send((None, format_exc(),))
+	conn.close()
+
+# Totals for all prefetching iterations in this process.
+prefetch_stats = DotDict(hits=0, misses=0)
+
+def _column_file_parts(d, sliceno, rehash, columns):
+	"""[(filename, offset, length), ...] with the data for these columns.
+	length 0 means to the end of the file."""
+	from g import SLICES
+	slices = range(SLICES) if rehash else [sliceno]
+	res = []
+	for col in columns:
+		dc = d.columns.get(col)
+		if not dc:
+			continue
+		for sliceno in slices:
+			if dc.segments:
+				# We don't know where the segments end, so warm to the end of the file.
+				res.extend((fn, offset, 0) for fn, offset, _ in d.column_segments(col, sliceno))
+			else:
+				fn, offset = d.column_location(col, sliceno)
+				length = 0
+				if _in_container(dc):
+					length = _container_directory(fn)[col][1]
+				elif dc.offsets and sliceno + 1 < len(dc.offsets):
+					length = dc.offsets[sliceno + 1] - offset
+				res.append((fn, offset, length,))
+	return res
+
+def _warm_files(parts):
+	"""Get the data in parts (from _column_file_parts) into the disk
+	cache, either by asking the kernel to read it or by reading it ourselves."""
+	fadvise = getattr(os, 'posix_fadvise', None)
+	for fn, offset, length in parts:
+		with open(fn, 'rb') as fh:
+			if fadvise:
+				fadvise(fh.fileno(), offset, length, os.POSIX_FADV_WILLNEED)
+			else:
+				fh.seek(offset)
+				todo = length or -1
+				while todo:
+					data = fh.read(1048576 if todo < 0 else min(todo, 1048576))
+					if not data:
+						break
+					if todo > 0:
+						todo -= len(data)
+
+class _Prefetcher(object):
+	"""Warms the files of the (dataset, sliceno, rehash) entries in to_iter
+	in a background thread, staying at most depth entries ahead of the
+	one last passed to .starting(ix).
+
+	The file names are found in .starting (so in the iterating thread),
+	since that loads dataset metadata and uses caches that are not
+	thread safe. The background thread only reads files."""
+
+	def __init__(self, to_iter, columns, depth):
+		from threading import Thread, Condition
+		self.to_iter = to_iter
+		self.columns = columns
+		self.depth = depth
+		self.parts = {}
+		self.resolved = 0
+		self.done = set()
+		self.hits = self.misses = 0
+		self._stop = False
+		self._cond = Condition()
+		self._thread = Thread(target=self._run, name='prefetch')
+		self._thread.daemon = True
+		self._thread.start()
+
+	def _run(self):
+		for ix in range(len(self.to_iter)):
+			with self._cond:
+				while not self._stop and ix not in self.parts:
+					self._cond.wait()
+				if self._stop:
+					return
+				parts = self.parts.pop(ix)
+			try:
+				_warm_files(parts)
+			except Exception:
+				pass # This is only an optimisation, the iteration will find any real problems.
+			with self._cond:
+				self.done.add(ix)
+
+	def starting(self, ix):
+		new_parts = {}
+		while self.resolved < min(ix + self.depth + 1, len(self.to_iter)):
+			try:
+				new_parts[self.resolved] = _column_file_parts(*self.to_iter[self.resolved] + (self.columns,))
+			except Exception:
+				new_parts[self.resolved] = [] # The iteration will find any real problems.
+			self.resolved += 1
+		with self._cond:
+			if ix in self.done:
+				self.hits += 1
+				prefetch_stats.hits += 1
+			else:
+				self.misses += 1
+				prefetch_stats.misses += 1
+			self.parts.update(new_parts)
+			self._cond.notify()
+
+	def stop(self):
+		with self._cond:
+			self._stop = True
+			self._cond.notify()
 
 class _New_dataset_marker(unicode): pass
 _new_dataset_marker = _New_dataset_marker('new')
 _no_override = object()
 
-_ds_cache = {}
+class _LRUCache(object):
+	"""Keeps at most max_size (estimated) bytes of values, dropping the
+	least recently used first. Sizes are given by the caller."""
+
+	def __init__(self, max_size):
+		from collections import OrderedDict
+		self.max_size = max_size
+		self.size = 0
+		self._d = OrderedDict()
+
+	def __contains__(self, key):
+		return key in self._d
+
+	def __len__(self):
+		return len(self._d)
+
+	def get(self, key, default=None):
+		if key not in self._d:
+			return default
+		value, size = self._d.pop(key)
+		self._d[key] = (value, size,)
+		return value
+
+	def set(self, key, value, size):
+		self.pop(key)
+		self._d[key] = (value, size,)
+		self.size += size
+		self._shrink()
+
+	def pop(self, key, default=None):
+		if key not in self._d:
+			return default
+		value, size = self._d.pop(key)
+		self.size -= size
+		return value
+
+	def _shrink(self):
+		# Always keep the newest, even if it's too big on its own.
+		while self.size > self.max_size and len(self._d) > 1:
+			_, (_, size) = self._d.popitem(last=False)
+			self.size -= size
+
+# Loaded dataset pickles. The size of each is estimated as the size of
+# the pickle file, so the real memory use is a few times max_size.
+_ds_cache = _LRUCache(128 * 1024 * 1024)
+_rehash_indexes = {}
+_lookup_indexes = {}
+
+def set_cache_size(max_size):
+	"""Set how many bytes (of pickle files) of dataset metadata to
+	keep loaded. The default is 128MB."""
+	_ds_cache.max_size = max_size
+	_ds_cache._shrink()
+
+# Optional second tier, shared between processes: a directory (preferably
+# in memory, like /dev/shm) with one file per dataset, holding the data
+# from dataset.pickle after any version upgrades (and without the caches
+# older datasets have). Entries are checked against the size and mtime of
+# dataset.pickle. Use enable_shared_cache or set $BD_DS_SHARED_CACHE.
+# Datasets with a dataset.meta don't use this, loading that is about as
+# fast as loading from the shared cache.
+_shared_cache_dir = None
+
+def enable_shared_cache(path):
+	"""Share loaded dataset metadata through files in path (e.g. a
+	directory in /dev/shm) with other processes, like other analysis
+	slices and ds* commands. Pass None to turn it off again."""
+	global _shared_cache_dir
+	if path and not os.path.isdir(path):
+		try:
+			os.makedirs(path, 0o700)
+		except OSError:
+			if not os.path.isdir(path):
+				raise
+	_shared_cache_dir = path
+
+if os.environ.get('BD_DS_SHARED_CACHE'):
+	enable_shared_cache(os.environ['BD_DS_SHARED_CACHE'])
+
+def _shared_cache_name(fn):
+	from hashlib import sha1
+	if isinstance(fn, unicode):
+		fn = fn.encode('utf-8')
+	return os.path.join(_shared_cache_dir, sha1(fn).hexdigest())
+
+def _shared_cache_load(fn, st):
+	from pickle import load
+	try:
+		with open(_shared_cache_name(fn), 'rb') as fh:
+			key, data = load(fh)
+	except Exception:
+		return None
+	if key != (fn, st.st_size, st.st_mtime,):
+		return None
+	return data
+
+def _shared_cache_save(fn, st, data):
+	from pickle import dump
+	name = _shared_cache_name(fn)
+	tmp_name = '%s.%dtmp' % (name, os.getpid(),)
+	try:
+		with open(tmp_name, 'wb') as fh:
+			dump(((fn, st.st_size, st.st_mtime,), data,), fh, 2)
+		os.rename(tmp_name, name)
+	except Exception:
+		# Not having the shared cache is not a problem, just slower.
+		try:
+			os.unlink(tmp_name)
+		except Exception:
+			pass
+
+# dataset.meta is:
+#     _meta_magic
+#     header length (uint32 le)
+#     header, a pickled dict with everything except the columns, and
+#         _column_fields = DatasetColumn._fields (of the version that wrote it)
+#         _column_names = [name, ...]
+#     columns, a pickled list with a tuple per column (in _column_names order)
+#         of the values of the DatasetColumn (with stats as a tuple too).
+# The columns are only unpickled when used (see _LazyColumns), so just
+# looking at lines or previous in many datasets is fast. Plain tuples
+# are also a lot faster to unpickle than namedtuples.
+_meta_magic = b'ACCDSMD1'
+# (namedtuple fields are str, so bytes on python 2.)
+_column_fields = tuple(uni(f) for f in DatasetColumn._fields)
+_stats_ix = DatasetColumn._fields.index('stats')
+
+def _meta_save(data, fn):
+	from struct import pack
+	# (Keys set as attributes are str, so bytes on python 2.)
+	header = {uni(k): v for k, v in data.items() if k != 'columns'}
+	names = sorted(data.columns)
+	columns = []
+	for name in names:
+		dc = tuple(data.columns[name])
+		if dc[_stats_ix]:
+			dc = dc[:_stats_ix] + (tuple(dc[_stats_ix]),) + dc[_stats_ix + 1:]
+		columns.append(dc)
+	header['_column_fields'] = _column_fields
+	header['_column_names'] = names
+	header = pickle.dumps(header, 2)
+	tmp_fn = fn + '.tmp'
+	with open(tmp_fn, 'wb') as fh:
+		fh.write(_meta_magic + pack('<I', len(header)) + header + pickle.dumps(columns, 2))
+	os.rename(tmp_fn, fn)
+
+def _unpickle(data):
+	if PY3:
+		return pickle.loads(data, encoding='bytes')
+	else:
+		return pickle.loads(data)
+
+def _meta_load(fn):
+	"""The data from fn (a dataset.meta) or None if it's from a
+	(newer) version we don't understand."""
+	from struct import unpack
+	with open(fn, 'rb') as fh:
+		raw = fh.read()
+	if raw[:8] != _meta_magic:
+		return None
+	header_end = 12 + unpack('<I', raw[8:12])[0]
+	data = DotDict(_unpickle(raw[12:header_end]))
+	fields = data.pop('_column_fields')
+	names = data.pop('_column_names')
+	data.columns = _LazyColumns(raw[header_end:], fields, names)
+	data.version = _dataset_version
+	return data
+
+_undecoded = object()
+
+class _LazyColumns(MutableMapping):
+	"""{name: DatasetColumn} from a dataset.meta. The columns are
+	unpickled the first time one is used, and each DatasetColumn is
+	made the first time that column is used. Copies share this work
+	with the original (which is what's in _ds_cache)."""
+
+	def __init__(self, raw=None, fields=None, names=(), base=None):
+		if base is None:
+			self._raw = raw
+			self._fields = fields
+			self._names = names
+			self._values = None
+			self._d = dict.fromkeys(names, _undecoded)
+		else:
+			self._d = dict(base._d)
+		self._base = base
+		self._filled = False
+
+	def _unpickle(self):
+		if self._values is None:
+			values = _unpickle(self._raw)
+			if self._fields != _column_fields:
+				def upgrade(v):
+					fields = dict.fromkeys(_column_fields)
+					fields.update(izip(self._fields, v))
+					return tuple(fields[f] for f in _column_fields)
+				values = imap(upgrade, values)
+			self._values = dict(izip(self._names, values))
+			self._raw = None
+		return self._values
+
+	def _decode(self, name):
+		if self._base is not None:
+			return self._base[name]
+		v = self._unpickle()[name]
+		if v[_stats_ix]:
+			v = v[:_stats_ix] + (ColumnStats._make(v[_stats_ix]),) + v[_stats_ix + 1:]
+		return DatasetColumn._make(v)
+
+	def _fill(self):
+		"""Decode all columns, for when all of them are used."""
+		if self._filled:
+			return
+		d = self._d
+		if self._base is None:
+			mk = DatasetColumn._make
+			mkstats = ColumnStats._make
+			ix = _stats_ix
+			for name, v in iteritems(self._unpickle()):
+				if d.get(name) is _undecoded:
+					if v[ix]:
+						v = v[:ix] + (mkstats(v[ix]),) + v[ix + 1:]
+					d[name] = mk(v)
+		else:
+			self._base._fill()
+			src = self._base._d
+			for name, dc in d.items():
+				if dc is _undecoded:
+					d[name] = src[name]
+		self._filled = True
+
+	def __getitem__(self, name):
+		dc = self._d[name]
+		if dc is _undecoded:
+			dc = self._d[name] = self._decode(name)
+		return dc
+
+	def __setitem__(self, name, dc):
+		self._d[name] = dc
+
+	def __delitem__(self, name):
+		del self._d[name]
+
+	def __iter__(self):
+		return iter(self._d)
+
+	def __len__(self):
+		return len(self._d)
+
+	def __contains__(self, name):
+		return name in self._d
+
+	def items(self):
+		self._fill()
+		return self._d.items()
+
+	def values(self):
+		self._fill()
+		return self._d.values()
+
+	def copy(self):
+		return _LazyColumns(base=self if self._base is None else self._base)
+
 def _ds_load(obj):
 	n = unicode(obj)
-	if n not in _ds_cache:
-		_ds_cache[n] = _v2_columntypefix(blob.load(obj._name('pickle'), obj.jobid))
-		_ds_cache.update(_ds_cache[n].get('cache', ()))
-	return _ds_cache[n]
+	data = _ds_cache.get(n)
+	if data is None:
+		fn = resolve_jobid_filename(obj.jobid, obj._name('meta'))
+		try:
+			size = os.path.getsize(fn)
+			data = _meta_load(fn)
+		except (OSError, IOError):
+			pass
+		if data is not None:
+			_ds_cache.set(n, data, size)
+			return data
+		fn = resolve_jobid_filename(obj.jobid, obj._name('pickle'))
+		st = os.stat(fn)
+		if _shared_cache_dir:
+			data = _shared_cache_load(fn, st)
+		if data is None:
+			data = _columntypefix(blob.load(fn))
+			cache = data.pop('cache', ())
+			if _shared_cache_dir:
+				_shared_cache_save(fn, st, data)
+			# Datasets with caches are from an older version.
+			for k, v in cache:
+				_ds_cache.set(k, v, st.st_size // (len(cache) + 1))
+		_ds_cache.set(n, data, st.st_size)
+	return data
 
 _type_v2to3backing = dict(
 	ascii="_v2_ascii",
@@ -125,6 +904,10 @@ _type_v2to3backing = dict(
 	json="_v2_json",
 )
 _type_v2compattov3t = {v: uni(k) for k, v in _type_v2to3backing.items()}
+def _hash_type(dc):
+	"""The type to use for hashing values from dc."""
+	return dc.type if dc.dictionary else dc.backing_type
+
 def _dc_v2to3(dc):
 	return _DatasetColumn_3_0(
 		type=dc.type,
@@ -135,15 +918,27 @@ def _dc_v2to3(dc):
 		max=dc.max,
 		offsets=dc.offsets,
 	)
-def _v2_columntypefix(ds):
-	if ds.version[0] == 3:
+def _dc_upgrade(dc):
+	"""Convert an older version DatasetColumn to the current version,
+	with None for all the fields it didn't have."""
+	if isinstance(dc, DatasetColumn):
+		return dc
+	fields = dict.fromkeys(DatasetColumn._fields)
+	fields.update(dc._asdict())
+	return DatasetColumn(**fields)
+def _columntypefix(ds):
+	if tuple(ds.version) == _dataset_version:
 		return ds
-	assert ds.version[0] == 2 and ds.version[1] >= 2, "%s: Unsupported dataset pickle version %r" % (ds, ds.version,)
 	ds = DotDict(ds)
-	ds.columns = {name: _dc_v2to3(dc) for name, dc in ds.columns.items()}
+	if ds.version[0] == 2:
+		assert ds.version[1] >= 2, "%s: Unsupported dataset pickle version %r" % (ds, ds.version,)
+		ds.columns = {name: _dc_v2to3(dc) for name, dc in ds.columns.items()}
+	else:
+		assert ds.version[0] == 3, "%s: Unsupported dataset pickle version %r" % (ds, ds.version,)
+	ds.columns = {name: _dc_upgrade(dc) for name, dc in ds.columns.items()}
 	if 'cache' in ds:
-		ds.cache = [(k, _v2_columntypefix(v)) for k, v in ds.cache]
-	ds.version = (3, 0)
+		ds.cache = [(k, _columntypefix(v)) for k, v in ds.cache]
+	ds.version = _dataset_version
 	return ds
 
 class Dataset(unicode):
@@ -161,6 +956,9 @@ class Dataset(unicode):
 	passed to jid. This gives None if that option was unset.
 	
 	These decay to a (unicode) string when pickled.
+	
+	Nothing is loaded until you use something other than the name (like
+	.columns or .previous), so making a Dataset is cheap.
 	"""
 
 	def __new__(cls, jobid, name=None):
@@ -194,7 +992,7 @@ class Dataset(unicode):
 		obj.name = uni(name or 'default')
 		if jobid is _new_dataset_marker:
 			obj._data = DotDict({
-				'version': (3, 0,),
+				'version': _dataset_version,
 				'filename': None,
 				'hashlabel': None,
 				'caption': '',
@@ -206,11 +1004,23 @@ class Dataset(unicode):
 			obj.jobid = None
 		else:
 			obj.jobid = jobid
-			obj._data = DotDict(_ds_load(obj))
-			assert obj._data.version[0] == 3 and obj._data.version[1] >= 0, "%s/%s: Unsupported dataset pickle version %r" % (jobid, name, obj._data.version,)
-			obj._data.columns = dict(obj._data.columns)
+			# The metadata is loaded when first used (see __getattr__),
+			# but check that there is a dataset here.
+			if fullname not in _ds_cache:
+				fn = resolve_jobid_filename(jobid, obj._name('meta'))
+				if not os.path.exists(fn) and not os.path.exists(fn[:-4] + 'pickle'):
+					raise IOError(ENOENT, "No dataset %s" % (fullname,), fn[:-4] + 'pickle')
 		return obj
 
+	def __getattr__(self, name):
+		if name != '_data':
+			raise AttributeError(name)
+		data = DotDict(_ds_load(self))
+		assert data.version[0] == 3 and data.version[1] >= 0, "%s/%s: Unsupported dataset pickle version %r" % (self.jobid, self.name, data.version,)
+		data.columns = data.columns.copy()
+		self._data = data
+		return data
+
 	# Look like a string after pickling
 	def __reduce__(self):
 		return unicode, (unicode(self),)
@@ -271,22 +1081,38 @@ class Dataset(unicode):
 				# make sure it's valid
 				Dataset(override_previous)
 			d._data.previous = override_previous
-			d._update_caches()
+		d._update_caches()
 		d._data.parent = '%s/%s' % (d.jobid, d.name,)
 		d.jobid = uni(JOBID)
 		d.name = uni(name)
 		d._save()
 
-	def _column_iterator(self, sliceno, col, _type=None, **kw):
+	def _column_iterator(self, sliceno, col, _type=None, rows=None, **kw):
+		"""rows is an optional list of (start, stop) row ranges (in order,
+		not overlapping) to read. Columns with a block index only read
+		the blocks these ranges are in."""
 		from sourcedata import type2iter
 		dc = self.columns[col]
+		if dc.dictionary and not _type:
+			return self._dictionary_iterator(sliceno, col, rows, kw)
 		mkiter = partial(type2iter[_type or dc.backing_type], **kw)
 		def one_slice(sliceno):
-			fn = self.column_filename(col, sliceno)
+			if not kw and not _type:
+				it = _buffer_iterator(self, sliceno, col)
+				if it is not None:
+					return it
+			if dc.segments:
+				from itertools import chain
+				segments = self.column_segments(col, sliceno)
+				return chain.from_iterable(mkiter(fn, seek=offset, max_count=count) for fn, offset, count in segments)
+			fn, offset = self.column_location(col, sliceno)
 			if dc.offsets:
-				return mkiter(fn, seek=dc.offsets[sliceno], max_count=self.lines[sliceno])
+				return mkiter(fn, seek=offset, max_count=self.lines[sliceno])
 			else:
 				return mkiter(fn)
+		if rows is not None:
+			assert sliceno is not None, "Can only specify rows for a single slice"
+			return self._column_rows_iterator(sliceno, col, mkiter, one_slice, rows)
 		if sliceno is None:
 			from g import SLICES
 			from itertools import chain
@@ -294,12 +1120,419 @@ class Dataset(unicode):
 		else:
 			return one_slice(sliceno)
 
-	def _iterator(self, sliceno, columns=None):
+	def _dictionary_iterator(self, sliceno, col, rows, kw):
+		dc = self.columns[col]
+		if sliceno is None:
+			from g import SLICES
+			from itertools import chain
+			return chain(*[self._dictionary_iterator(s, col, None, kw) for s in range(SLICES)])
+		codes = self._column_iterator(sliceno, col, _type=dc.backing_type, rows=rows)
+		values = self.dictionary(sliceno, col)
+		if 'hashfilter' in kw:
+			# Hash each value once, and look the answer up by code.
+			h = typed_writer(dc.type).hash
+			want_slice, slices = kw['hashfilter']
+			values = [h(v) % slices == want_slice for v in values]
+		return imap(values.__getitem__, codes)
+
+	def dictionary(self, sliceno, column):
+		"""[value, ...] (indexed by code) for a dictionary encoded column
+		(written as "dict:type") in slice sliceno.
+		Iterating the column gives you these objects (not copies)."""
+		dc = self.columns[column]
+		assert dc.dictionary, "Column %s in %s is not dictionary encoded" % (column, self,)
+		if not hasattr(self, '_dictionaries'):
+			self._dictionaries = {}
+		if dc.dictionary not in self._dictionaries:
+			jid, name = dc.dictionary.split('/', 1)
+			self._dictionaries[dc.dictionary] = blob.load(name, jid)
+		return self._dictionaries[dc.dictionary][sliceno]
+
+	def iterate_codes(self, sliceno, column, rows=None):
+		"""Iterate the integer codes of a dictionary encoded column (see
+		.dictionary) in slice sliceno. Use this to filter or group on the
+		codes and only look at the values you need.
+		Codes are per slice, so the same value can have different codes
+		in different slices."""
+		dc = self.columns[column]
+		assert dc.dictionary, "Column %s in %s is not dictionary encoded" % (column, self,)
+		assert sliceno is not None, "Codes are per slice, so you need a sliceno"
+		return self._column_iterator(sliceno, column, _type=dc.backing_type, rows=_rowsfixup(rows))
+
+	def _column_rows_iterator(self, sliceno, col, mkiter, one_slice, rows):
+		from itertools import chain, islice
+		from bisect import bisect_right
+		lines = self.lines[sliceno]
+		rows = [(start, min(stop, lines)) for start, stop in rows if start < min(stop, lines)]
+		blocks = self._block_index(col)
+		if blocks:
+			blocks = blocks[sliceno]
+			starts = [b[0] for b in blocks]
+			fn, base = self.column_location(col, sliceno)
+			def parts():
+				# Keep reading from the same position when the next range
+				# starts in a block we have already started decompressing.
+				it = None
+				pos = 0
+				for start, stop in rows:
+					first_row, offset, _, _, _ = blocks[bisect_right(starts, start) - 1]
+					if it is None or first_row > pos:
+						it = mkiter(fn, seek=base + offset, max_count=lines - first_row)
+						pos = first_row
+					yield islice(it, start - pos, stop - pos)
+					pos = stop
+		else:
+			def parts():
+				it = one_slice(sliceno)
+				pos = 0
+				for start, stop in rows:
+					yield islice(it, start - pos, stop - pos)
+					pos = stop
+		return chain.from_iterable(parts())
+
+	def _block_index(self, col):
+		"""[[(start_row, offset, count, min, max), ...] per slice] or None
+		if this column was not written with a block index."""
+		dc = self.columns[col]
+		if not dc.blocks:
+			return None
+		if not hasattr(self, '_block_indexes'):
+			self._block_indexes = {}
+		if dc.blocks not in self._block_indexes:
+			jid, name = dc.blocks.split('/', 1)
+			res = []
+			for slice_blocks in blob.load(name, jid):
+				start_row = 0
+				lst = []
+				for offset, count, min_v, max_v in slice_blocks:
+					lst.append((start_row, offset, count, min_v, max_v,))
+					start_row += count
+				res.append(lst)
+			self._block_indexes[dc.blocks] = res
+		return self._block_indexes[dc.blocks]
+
+	def _block_rows(self, sliceno, col, keep_block):
+		"""Row ranges of the blocks in col that keep_block(min, max) wants,
+		or None if col has no block index. Adjacent blocks are merged into
+		one range."""
+		blocks = self._block_index(col)
+		if not blocks:
+			return None
+		res = []
+		for start_row, _, count, min_v, max_v in blocks[sliceno]:
+			if min_v is None or keep_block(min_v, max_v):
+				if res and res[-1][1] == start_row:
+					res[-1] = (res[-1][0], start_row + count,)
+				else:
+					res.append((start_row, start_row + count,))
+		return res
+
+	def split_slice(self, sliceno, parts, column=None):
+		"""Split slice sliceno in (at most) parts row ranges of about
+		the same size, [(start, stop), ...], for use as rows= in .iterate.
+
+		If the dataset was written with a block index (see block_size
+		in DatasetWriter) the ranges start on block boundaries (of column,
+		or the first column with an index), so each part only reads its
+		own blocks. Otherwise the parts have to read (and throw away)
+		everything before their start."""
+		from bisect import bisect_left
+		assert parts > 0, "parts must be positive"
+		lines = self.lines[sliceno]
+		starts = None
+		for col in ([column] if column else sorted(self.columns)):
+			blocks = self._block_index(col)
+			if blocks:
+				starts = [b[0] for b in blocks[sliceno]]
+				break
+		res = []
+		prev = 0
+		for ix in range(1, parts):
+			pos = lines * ix // parts
+			if starts:
+				bix = bisect_left(starts, pos)
+				candidates = starts[max(bix - 1, 0):bix + 1]
+				pos = min(candidates, key=lambda start: abs(start - pos))
+			if pos > prev:
+				res.append((prev, pos,))
+				prev = pos
+		if lines > prev:
+			res.append((prev, lines,))
+		return res
+
+	def map_slice(self, sliceno, func, columns=None, parts=None, **kw):
+		"""Run func(iterator) on parts (from .split_slice) of slice sliceno
+		in parallel processes, returning a list of the results in row order.
+		The iterator is .iterate(sliceno, columns, rows=part, **kw),
+		so you can use filters and translators as usual.
+
+		func (and anything it returns) must be picklable, so it can't be
+		a lambda or a local function. parts defaults to the number of cpus.
+		This is mostly useful for a slice that is much bigger than the
+		others, and works best if the dataset has a block index.
+		"""
+		if not parts:
+			from multiprocessing import cpu_count
+			parts = cpu_count()
+		args = [(self, sliceno, func, columns, rows, kw) for rows in self.split_slice(sliceno, parts)]
+		if len(args) < 2:
+			return [_map_slice_part(a) for a in args]
+		from safe_pool import Pool
+		pool = Pool(len(args))
+		try:
+			return pool.map(_map_slice_part, args, chunksize=1)
+		finally:
+			pool.close()
+			pool.join()
+
+	def column_buffer(self, sliceno, column):
+		"""Read-only memoryview of the values of fixed width column (see
+		_buffer_formats) in slice sliceno, backed by an uncompressed cache
+		file beside the column file. The cache is created the first time,
+		and then shared (through the page cache) with everyone else using
+		it. (Iterating the column also uses it if it exists.)
+
+		None values are NaN for floats, -2**63 for date/time types (which
+		are int64, like in .column_array) and 0 for the rest. Use
+		.column_array if you need to tell None from those.
+		On python 2 you get the mmap object instead.
+		"""
+		mm, _ = _buffer_map(self, sliceno, column)
+		if not PY3:
+			return mm or b''
+		return memoryview(mm or b'').cast(_buffer_formats[self.columns[column].type])
+
+	def column_array(self, sliceno, column):
+		"""Read-only numpy array of the values of fixed width column in
+		slice sliceno, without copying (see .column_buffer). dtypes and
+		None handling are as in .iterate_blocks_list. Requires numpy."""
+		import numpy
+		typ = self.columns[column].type
+		mm, none_mm = _buffer_map(self, sliceno, column)
+		if not mm:
+			return numpy.zeros(0, dtype=_type2dtype[typ])
+		a = numpy.frombuffer(mm, dtype=_type2dtype[typ])
+		if none_mm and typ in _none_masked_types:
+			return numpy.ma.masked_array(a, mask=numpy.frombuffer(none_mm, dtype='bool'))
+		return a
+
+	def get_rows(self, sliceno, row_indices, columns=None):
+		"""[row, ...] for the rows at positions row_indices (in that order,
+		repeats are fine) in slice sliceno. Rows are like from .iterate
+		(so columns can be a single name).
+
+		Only the requested rows are kept in memory. If the dataset was
+		written with a block index (see block_size in DatasetWriter) only
+		the blocks with requested rows are read, otherwise the slice is
+		read up to the last requested row.
+		"""
+		lines = self.lines[sliceno]
+		wanted = sorted(set(row_indices))
+		if not wanted:
+			return []
+		assert wanted[0] >= 0 and wanted[-1] < lines, "Row indices must be in range(%d) for %s slice %d" % (lines, self, sliceno,)
+		rows = []
+		for ix in wanted:
+			if rows and rows[-1][1] == ix:
+				rows[-1] = (rows[-1][0], ix + 1,)
+			else:
+				rows.append((ix, ix + 1,))
+		got = dict(izip(wanted, self.iterate(sliceno, columns, rows=rows, status_reporting=False)))
+		return [got[ix] for ix in row_indices]
+
+	def sample(self, sliceno, fraction=None, n=None, seed=0, columns=None):
+		"""A random sample of the rows in slice sliceno (or all slices if
+		sliceno is None), as a list of rows like from .iterate.
+
+		Specify either fraction or n. With fraction each block (from the
+		block index, see block_size in DatasetWriter) is included with
+		that probability, so you get runs of rows and only those blocks
+		are read. Without a block index each row is included with that
+		probability (and everything is read). With n you get n rows
+		(or all rows if there are fewer) picked uniformly, and (with a
+		block index) only the blocks containing them are read.
+
+		The same seed (an int) gives the same sample for the same data
+		and slicing. Rows are in the order they are in the dataset(s).
+		"""
+		return Dataset._sample_list(sliceno, [self], fraction, n, seed, columns)
+
+	def sample_chain(self, sliceno, fraction=None, n=None, seed=0, columns=None, length=-1, stop_ds=None):
+		"""Like .sample, but for the whole chain (see .chain). With n the
+		rows are picked uniformly from the whole chain."""
+		return Dataset._sample_list(sliceno, self.chain(length, stop_ds=stop_ds), fraction, n, seed, columns)
+
+	@staticmethod
+	def _sample_list(sliceno, datasets, fraction, n, seed, columns):
+		from random import Random
+		from bisect import bisect_left
+		from itertools import repeat
+		assert (fraction is None) != (n is None), "Specify exactly one of fraction and n"
+		if sliceno is None:
+			from g import SLICES
+			slices = builtins.range(SLICES)
+		else:
+			slices = [sliceno]
+		parts = [(d, s) for d in map(Dataset, datasets) for s in slices if d.lines[s]]
+		res = []
+		if n is not None:
+			assert n >= 0, "n must not be negative"
+			total = sum(d.lines[s] for d, s in parts)
+			n = min(n, total)
+			# Floyd's algorithm, to pick n of range(total) without making that list.
+			rnd = Random('%d:%s' % (seed, sliceno,))
+			picked = set()
+			for top in builtins.range(total - n, total):
+				ix = rnd.randint(0, top)
+				picked.add(top if ix in picked else ix)
+			picked = sorted(picked)
+			pos = 0
+			for d, s in parts:
+				lines = d.lines[s]
+				want = [ix - pos for ix in picked[bisect_left(picked, pos):bisect_left(picked, pos + lines)]]
+				if want:
+					res.extend(d.get_rows(s, want, columns))
+				pos += lines
+			return res
+		assert 0 <= fraction <= 1, "fraction must be between 0 and 1"
+		for d, s in parts:
+			rnd = Random('%d:%s:%d' % (seed, d, s,))
+			if isinstance(columns, str_types):
+				cols = [columns]
+			else:
+				cols = columns or sorted(d.columns)
+			blocks = None
+			for col in cols:
+				blocks = d._block_index(col)
+				if blocks:
+					break
+			if blocks:
+				rows = []
+				for start, _, count, _, _ in blocks[s]:
+					if rnd.random() < fraction:
+						if rows and rows[-1][1] == start:
+							rows[-1] = (rows[-1][0], start + count,)
+						else:
+							rows.append((start, start + count,))
+				if rows:
+					res.extend(d.iterate(s, columns, rows=rows, status_reporting=False))
+			else:
+				keep = (rnd.random() < fraction for _ in repeat(None, d.lines[s]))
+				res.extend(compress(d.iterate(s, columns, status_reporting=False), keep))
+		return res
+
+	def lookup(self, key, columns=None, use_index=True):
+		"""Rows where the hashlabel column is key. See .lookup_many."""
+		return self.lookup_many([key], columns, use_index)[key]
+
+	def lookup_many(self, keys, columns=None, use_index=True):
+		"""{key: [row, ...]} for the rows where the hashlabel column is key.
+		Rows are like from .iterate (so columns can be a single name).
+
+		Each key is only looked for in the slice it hashes to. With
+		use_index (the default) an index (value -> row numbers) is built
+		for each slice the first time it is needed and kept in memory (see
+		_lookup_index for when it is also saved). Then only the blocks with
+		the requested rows are read (if there is a block index). Without
+		use_index the slice is scanned.
+		"""
+		from g import SLICES
+		hashlabel = self.hashlabel
+		assert hashlabel, "%s has no hashlabel, so lookup can't know which slice to look in" % (self,)
+		h = typed_writer(_hash_type(self.columns[hashlabel])).hash
+		want_tuple = not isinstance(columns, str_types)
+		if want_tuple:
+			columns = list(columns or sorted(self.columns))
+		else:
+			columns = [columns]
+		res = {}
+		by_slice = {}
+		for key in keys:
+			res[key] = []
+			by_slice.setdefault(h(key) % SLICES, set()).add(key)
+		for sliceno, slice_keys in sorted(by_slice.items()):
+			if use_index:
+				index = self._lookup_index(sliceno)
+				row2key = {}
+				for key in slice_keys:
+					rows = index.get(key, ())
+					if isinstance(rows, int):
+						rows = (rows,)
+					for row in rows:
+						row2key[row] = key
+				if not row2key:
+					continue
+				rows = []
+				for row in sorted(row2key):
+					if rows and rows[-1][1] == row:
+						rows[-1] = (rows[-1][0], row + 1,)
+					else:
+						rows.append((row, row + 1,))
+				it = izip(sorted(row2key), self.iterate(sliceno, columns, rows=rows, status_reporting=False))
+				for row, values in it:
+					res[row2key[row]].append(values if want_tuple else values[0])
+			else:
+				it = self.iterate(sliceno, [hashlabel] + columns, filters={hashlabel: slice_keys.__contains__}, status_reporting=False)
+				for values in it:
+					res[values[0]].append(values[1:] if want_tuple else values[1])
+		return res
+
+	def _lookup_index(self, sliceno):
+		"""{hashlabel value: row number or [row numbers]} for sliceno.
+
+		The index is kept in memory in this process, so do the first
+		lookups in prepare if analysis needs them (like make_rehash_index).
+		If this dataset is from the current job the index is also saved
+		with it (as <column>.lookup.<sliceno>.pickle), and later jobs load
+		that. Only one process builds and saves it, others that need it at
+		the same time wait for that. Otherwise nothing is written.
+		"""
+		from g import JOBID
+		key = (unicode(self), sliceno,)
+		if key not in _lookup_indexes:
+			fn = '%s/%s.lookup.%d.pickle' % (self.name, self.columns[self.hashlabel].name, sliceno,)
+			index = None
+			if os.path.exists(resolve_jobid_filename(self.jobid, fn)):
+				index = blob.load(fn, self.jobid)
+			elif self.jobid == JOBID:
+				from fcntl import lockf, LOCK_EX
+				lock_fn = fn + '.lock'
+				with open(lock_fn, 'a') as lock_fh:
+					lockf(lock_fh, LOCK_EX)
+					# Someone else may have built it while we waited.
+					if not os.path.exists(fn):
+						index = self._build_lookup_index(sliceno)
+						blob.save(index, fn, temp=False)
+					try:
+						os.unlink(lock_fn)
+					except OSError:
+						pass
+				if index is None:
+					index = blob.load(fn)
+			else:
+				index = self._build_lookup_index(sliceno)
+			_lookup_indexes[key] = index
+		return _lookup_indexes[key]
+
+	def _build_lookup_index(self, sliceno):
+		index = {}
+		for row, value in enumerate(self._column_iterator(sliceno, self.hashlabel)):
+			if value in index:
+				rows = index[value]
+				if isinstance(rows, int):
+					index[value] = [rows, row]
+				else:
+					rows.append(row)
+			else:
+				index[value] = row
+		return index
+
+	def _iterator(self, sliceno, columns=None, rows=None):
 		res = []
 		not_found = []
 		for col in columns or sorted(self.columns):
 			if col in self.columns:
-				res.append(self._column_iterator(sliceno, col))
+				res.append(self._column_iterator(sliceno, col, rows=rows))
 			else:
 				not_found.append(col)
 		assert not not_found, 'Columns %r not found in %s/%s' % (not_found, self.jobid, self.name)
@@ -309,42 +1542,246 @@ class Dataset(unicode):
 		from g import SLICES
 		return compress(it, self._column_iterator(None, hashlabel, hashfilter=(sliceno, SLICES)))
 
+	def make_rehash_index(self, hashlabel):
+		"""Compute which slice each row would be in if this dataset was
+		hashed on hashlabel. With this index iterating with rehash=True
+		doesn't read (and hash) the hashlabel column, unless you ask for
+		that column.
+
+		Every slice still decompresses the other columns of every slice,
+		since rows hashing to different slices are mixed in the files.
+		(With a block index it skips blocks with no rows for the slice,
+		but that only happens when rows are grouped by hash, like when
+		sorted on hashlabel.) If you rehash the same dataset more than
+		once it is usually better to build a rehashed dataset (using the
+		dataset_rehash method).
+
+		This reads the hashlabel column once, so do it in prepare (analysis
+		inherits it) or synthesis. If this dataset is from the current job
+		the index is saved with it, and used by all later rehashing of it.
+		Otherwise it is only kept in memory.
+		"""
+		from g import SLICES, JOBID
+		hashlabel = uni(hashlabel)
+		index = self._rehash_index(hashlabel)
+		if index is not None:
+			return index
+		dc = self.columns[hashlabel]
+		h = getattr(typed_writer(_hash_type(dc)), 'hash', None)
+		assert h, "Can't hash %s columns" % (dc.type,)
+		if SLICES <= 256:
+			mk = bytearray
+		else:
+			from array import array
+			mk = partial(array, str('H'))
+		index = [mk(h(v) % SLICES for v in self._column_iterator(sliceno, hashlabel)) for sliceno in range(SLICES)]
+		_rehash_indexes[(unicode(self), hashlabel,)] = index
+		if self.jobid == JOBID:
+			fn = '%s/%s.rehash.pickle' % (self.name, dc.name,)
+			blob.save(index, fn, temp=False)
+			rehash_indexes = dict(self._data.get('rehash_indexes', {}))
+			rehash_indexes[hashlabel] = '%s/%s' % (self.jobid, fn,)
+			self._data.rehash_indexes = rehash_indexes
+			self._save()
+			_ds_cache.pop(unicode(self), None)
+		return index
+
+	def _rehash_index(self, hashlabel):
+		"""The index from make_rehash_index, or None if there isn't one."""
+		key = (unicode(self), hashlabel,)
+		if key not in _rehash_indexes:
+			location = self._data.get('rehash_indexes', {}).get(hashlabel)
+			if not location:
+				return None
+			jid, name = location.split('/', 1)
+			_rehash_indexes[key] = blob.load(name, jid)
+		return _rehash_indexes[key]
+
+	def _rehash_iterators(self, sliceno, hashlabel, columns):
+		"""Like _iterator, but with the rows from all slices that hash to
+		sliceno on hashlabel. Returns None if there is no rehash index."""
+		from itertools import chain
+		index = self._rehash_index(hashlabel)
+		if index is None:
+			return None
+		not_found = [col for col in columns if col not in self.columns]
+		assert not not_found, 'Columns %r not found in %s/%s' % (not_found, self.jobid, self.name)
+		blocks = None
+		for col in columns:
+			blocks = self._block_index(col)
+			if blocks:
+				break
+		parts = []
+		for src_sliceno, slice_index in enumerate(index):
+			rows = None
+			if blocks:
+				rows = []
+				for start_row, _, count, _, _ in blocks[src_sliceno]:
+					if sliceno in slice_index[start_row:start_row + count]:
+						if rows and rows[-1][1] == start_row:
+							rows[-1] = (rows[-1][0], start_row + count,)
+						else:
+							rows.append((start_row, start_row + count,))
+				if not rows:
+					continue
+			parts.append((src_sliceno, rows, slice_index,))
+		def mask(rows, slice_index):
+			if rows is None:
+				targets = slice_index
+			else:
+				targets = chain.from_iterable(slice_index[start:stop] for start, stop in rows)
+			return imap(partial(eq, sliceno), targets)
+		def column_iterator(col):
+			return chain.from_iterable(
+				compress(self._column_iterator(src_sliceno, col, rows=rows), mask(rows, slice_index))
+				for src_sliceno, rows, slice_index in parts
+			)
+		return [column_iterator(col) for col in columns]
+
 	def column_filename(self, colname, sliceno=None):
 		dc = self.columns[colname]
+		assert not dc.segments, "Column %s in %s is in several files, use .column_segments" % (colname, self,)
 		jid, name = dc.location.split('/', 1)
-		if dc.offsets:
+		if dc.offsets and not _in_container(dc):
 			return resolve_jobid_filename(jid, name)
 		else:
 			if sliceno is None:
 				sliceno = '%s'
 			return resolve_jobid_filename(jid, name % (sliceno,))
 
+	def column_location(self, colname, sliceno):
+		"""(filename, offset) where the data for colname in slice
+		sliceno starts. The offset is only non-zero for merged columns
+		and columns in containers, where several columns or slices share
+		a file. See also column_segments."""
+		dc = self.columns[colname]
+		return self.column_filename(colname, sliceno), dc.offsets[sliceno] if dc.offsets else 0
+
+	def chain_column_stats(self, colname, length=-1, stop_ds=None):
+		"""ColumnStats for colname over the chain (like .chain). The
+		distinct count is from the merged sketches, so values that are
+		in several datasets are only counted once. Anything that is
+		missing in some dataset is None."""
+		nulls = size = 0
+		sketch = None
+		for d in self.chain(length=length, stop_ds=stop_ds):
+			stats = d.columns[colname].stats
+			if not stats:
+				return ColumnStats(None, None, None, None)
+			if nulls is not None:
+				nulls = None if stats.nulls is None else nulls + stats.nulls
+			if size is not None:
+				size = None if stats.size is None else size + stats.size
+			if sketch is not False:
+				if stats.sketch:
+					slice_sketch = d._column_sketch(colname)
+					sketch = hll_merge(sketch, slice_sketch) if sketch else bytearray(slice_sketch)
+				else:
+					sketch = False
+		return ColumnStats(nulls, hll_estimate(sketch) if sketch else None, size, None)
+
+	def _column_sketch(self, colname):
+		dc = self.columns[colname]
+		jid, name = dc.stats.sketch.split('/', 1)
+		return blob.load(name, jid)[dc.name]
+
+	def column_segments(self, colname, sliceno):
+		"""[(filename, offset, count), ...] for the data of colname in
+		slice sliceno. Read count values from offset in each of them.
+		This is only more than one segment for columns written with
+		DatasetWriter.set_segments."""
+		dc = self.columns[colname]
+		if not dc.segments:
+			return [self.column_location(colname, sliceno) + (self.lines[sliceno],)]
+		if not hasattr(self, '_segment_lists'):
+			self._segment_lists = {}
+		if dc.segments not in self._segment_lists:
+			jid, name = dc.segments.split('/', 1)
+			self._segment_lists[dc.segments] = blob.load(name, jid)
+		res = []
+		for location, offset, count in self._segment_lists[dc.segments][sliceno]:
+			jid, name = location.split('/', 1)
+			res.append((resolve_jobid_filename(jid, name), offset, count,))
+		return res
+
 	def chain(self, length=-1, reverse=False, stop_ds=None):
+		return [self if e.id == self else Dataset(e.id) for e in self.chain_entries(length, reverse, stop_ds)]
+
+	def chain_entries(self, length=-1, reverse=False, stop_ds=None):
+		"""Like .chain, but gives a ChainEntry (id, previous, lines,
+		hashlabel, minmax) for each dataset instead of loading it.
+		minmax is {column: (min, max)}. This uses the chain indexes,
+		so it's fast even for very long chains."""
 		if stop_ds:
 			# resolve all formats to the same format
 			stop_ds = Dataset(stop_ds)
 		chain = []
-		current = self
-		while length != len(chain) and current != stop_ds:
-			chain.append(current)
-			if not current.previous:
-				break
-			current = Dataset(current.previous)
+		if length != 0 and self != stop_ds:
+			chain.append(_chain_entry(self))
+			for e in self._ancestors():
+				if length == len(chain) or e.id == stop_ds:
+					break
+				chain.append(e)
 		if not reverse:
 			chain.reverse()
 		return chain
 
-	def iterate_chain(self, sliceno, columns=None, length=-1, range=None, sloppy_range=False, reverse=False, hashlabel=None, stop_ds=None, pre_callback=None, post_callback=None, filters=None, translators=None, status_reporting=True, rehash=False):
+	def _ancestors(self):
+		"""ChainEntry for each dataset before this one, nearest first."""
+		current = self
+		while True:
+			entries = _chain_index_load(current)
+			if entries:
+				for e in entries:
+					yield e
+				if not entries[-1].previous:
+					return
+				current = entries[-1].id
+			else:
+				# No index, so it's an older dataset (or has no previous).
+				current = Dataset(current)
+				if not current.previous:
+					return
+				current = Dataset(current.previous)
+				yield _chain_entry(current)
+
+	def _chain_for_iteration(self, length, reverse, stop_ds, range, columns):
+		"""Like .chain (but only ids), without the datasets that range
+		would skip (so they never have to be loaded).
+		Returns (chain, columns), with columns from the first dataset in
+		the chain (as iterate_list would) if not specified, so this works
+		even if all datasets are skipped."""
+		chain = self.chain_entries(length, reverse, stop_ds)
+		if not columns and chain:
+			first = chain[0].id
+			columns = (self if first == self else Dataset(first)).columns
+		if range:
+			range_k, (range_bottom, range_top,) = next(iteritems(range))
+			def keep(e):
+				if sum(e.lines) == 0:
+					return False
+				mm = e.minmax.get(range_k)
+				if not mm or mm[0] is None:
+					return True
+				if range_top is not None and mm[0] >= range_top:
+					return False
+				if range_bottom is not None and mm[1] < range_bottom:
+					return False
+				return True
+			chain = filter(keep, chain)
+		return [self if e.id == self else e.id for e in chain], columns
+
+	def iterate_chain(self, sliceno, columns=None, length=-1, range=None, sloppy_range=False, reverse=False, hashlabel=None, stop_ds=None, pre_callback=None, post_callback=None, filters=None, translators=None, status_reporting=True, rehash=False, prefetch=0, parallel=0, ordered=True):
 		"""Iterate a list of datasets. See .chain and .iterate_list for details."""
-		chain = self.chain(length, reverse, stop_ds)
-		return self.iterate_list(sliceno, columns, chain, range=range, sloppy_range=sloppy_range, hashlabel=hashlabel, pre_callback=pre_callback, post_callback=post_callback, filters=filters, translators=translators, status_reporting=status_reporting, rehash=rehash)
+		chain, columns = self._chain_for_iteration(length, reverse, stop_ds, range, columns)
+		return self.iterate_list(sliceno, columns, chain, range=range, sloppy_range=sloppy_range, hashlabel=hashlabel, pre_callback=pre_callback, post_callback=post_callback, filters=filters, translators=translators, status_reporting=status_reporting, rehash=rehash, prefetch=prefetch, parallel=parallel, ordered=ordered)
 
-	def iterate(self, sliceno, columns=None, hashlabel=None, filters=None, translators=None, status_reporting=True, rehash=False):
+	def iterate(self, sliceno, columns=None, hashlabel=None, filters=None, translators=None, status_reporting=True, rehash=False, rows=None):
 		"""Iterate just this dataset. See .iterate_list for details."""
-		return self.iterate_list(sliceno, columns, [self], hashlabel=hashlabel, filters=filters, translators=translators, status_reporting=status_reporting, rehash=rehash)
+		return self.iterate_list(sliceno, columns, [self], hashlabel=hashlabel, filters=filters, translators=translators, status_reporting=status_reporting, rehash=rehash, rows=rows)
 
 	@staticmethod
-	def iterate_list(sliceno, columns, datasets, range=None, sloppy_range=False, hashlabel=None, pre_callback=None, post_callback=None, filters=None, translators=None, status_reporting=True, rehash=False):
+	def iterate_list(sliceno, columns, datasets, range=None, sloppy_range=False, hashlabel=None, pre_callback=None, post_callback=None, filters=None, translators=None, status_reporting=True, rehash=False, rows=None, prefetch=0, parallel=0, ordered=True):
 		"""Iterator over the specified columns from datasets
 		(iterable of dataset-specifiers, or single dataset-specifier).
 		callbacks are called before and after each dataset is iterated.
@@ -360,6 +1797,11 @@ class Dataset(unicode):
 		filters={'some_col': some_str.__eq__}
 		filters=lambda line: line[0] == line[1]
 
+		Filters in a dict are evaluated on just their column (when it is not
+		translated), and if the dataset has a block index the filters
+		some_value.__eq__, some_set.__contains__, some_dict.get and
+		range_check_function(bottom, top) also skip blocks that can't match.
+
 		translators transform data values. It can be a callable (called with the
 		candidate tuple and expected to return a tuple of the same length) or a
 		dict {name: translation}.
@@ -380,13 +1822,34 @@ class Dataset(unicode):
 		If you specify rehash=True such datasets will be rehashed during
 		iteration. You should usually build a new rehashed dataset (using
 		the dataset_rehash method), but this is available for when it makes
-		sense.
+		sense. If the dataset has a rehash index (see .make_rehash_index)
+		the hashlabel column is not read and hashed in every slice.
 
 		range limits which rows you see. Specify {colname: (start, stop)} and
 		only rows where start <= colvalue < stop will be returned.
 		If you set sloppy_range=True you may get all rows from datasets that
 		contain any rows you asked for. (This can be faster.)
 
+		rows limits which rows you see by position in the slice. Specify
+		(start, stop) or [(start, stop), ...] (in order, not overlapping).
+		This needs a sliceno (and no rehashing), and applies to each
+		dataset. Use .split_slice to get ranges that line up with the
+		block index (if there is one), so only those blocks are read.
+
+		prefetch=N starts a background thread that warms the disk cache
+		for the files of the next N datasets (or slices) while you iterate
+		the current one. This helps with long chains on cold disks. How
+		often this was in time is shown in ^T (and kept in prefetch_stats).
+
+		parallel=N uses N worker processes to read (and filter/translate)
+		the datasets (or slices, with sliceno=None) concurrently, sending
+		the rows back in batches. With ordered=True (the default) you get
+		the rows in the same order as without parallel, with ordered=False
+		you get each dataset (or slice) as soon as a worker has read it.
+		(Rows within a dataset or slice are always in order.) This is for
+		full scans in prepare/synthesis, and can't be used with callbacks.
+		The rows are pickled, so they must be picklable.
+
 		status_reporting should normally be left as True, which will give you
 		information about this iteration in ^T, but there is one case where you
 		need to turn it off:
@@ -395,6 +1858,60 @@ class Dataset(unicode):
 		and you will get warnings about incorrect ending order of statuses.)
 		"""
 
+		to_iter, columns, want_tuple, range, rows = Dataset._resolve_iteration(sliceno, columns, datasets, range, hashlabel, rehash, rows)
+		filter_func, column_filters = Dataset._resolve_filters(columns, filters, want_tuple)
+		translation_func, translators = Dataset._resolve_translators(columns, translators)
+		mkiter = Dataset._row_iterator_func(columns, filter_func, column_filters, translation_func, translators, want_tuple, range, sloppy_range, rows)
+		from itertools import chain
+		if parallel and len(to_iter) > 1:
+			assert not (pre_callback or post_callback), "Callbacks can't be used with parallel iteration"
+			return chain.from_iterable(Dataset._iterate_parallel(to_iter, mkiter, parallel, ordered, status_reporting))
+		return chain.from_iterable(Dataset._iterate_datasets(to_iter, mkiter, pre_callback, post_callback, status_reporting, prefetch, prefetch and columns + list(range or ())))
+
+	def iterate_blocks(self, sliceno, columns=None, block_size=65536, hashlabel=None, status_reporting=True, rehash=False, rows=None):
+		"""Iterate just this dataset in blocks. See .iterate_blocks_list for details."""
+		return self.iterate_blocks_list(sliceno, columns, [self], block_size=block_size, hashlabel=hashlabel, status_reporting=status_reporting, rehash=rehash, rows=rows)
+
+	def iterate_chain_blocks(self, sliceno, columns=None, block_size=65536, length=-1, range=None, sloppy_range=False, reverse=False, hashlabel=None, stop_ds=None, pre_callback=None, post_callback=None, status_reporting=True, rehash=False, prefetch=0):
+		"""Iterate a list of datasets in blocks. See .chain and .iterate_blocks_list for details."""
+		chain, columns = self._chain_for_iteration(length, reverse, stop_ds, range, columns)
+		return self.iterate_blocks_list(sliceno, columns, chain, block_size=block_size, range=range, sloppy_range=sloppy_range, hashlabel=hashlabel, pre_callback=pre_callback, post_callback=post_callback, status_reporting=status_reporting, rehash=rehash, prefetch=prefetch)
+
+	@staticmethod
+	def iterate_blocks_list(sliceno, columns, datasets, block_size=65536, range=None, sloppy_range=False, hashlabel=None, pre_callback=None, post_callback=None, status_reporting=True, rehash=False, rows=None, prefetch=0):
+		"""Like iterate_list, but gives you {column: numpy array} with
+		(at most) block_size rows at a time instead of one row at a time.
+		Requires numpy.
+
+		Only fixed width types are supported (see _type2dtype), and
+		the arrays get the corresponding numpy dtype. None values give
+		a masked array for integer and bool columns, and NaN/NaT for
+		float and date/time columns. time is given as timedelta64 since
+		midnight.
+
+		Blocks never span datasets (or slices), so pre_callback and
+		post_callback are called at the same points as with iterate_list.
+		range and rehash filter the blocks, so you may get blocks with
+		fewer than block_size rows. (But never empty blocks.)
+
+		There are no filters or translators, do that on the arrays.
+
+		rows and prefetch work as in iterate_list.
+		"""
+		assert block_size > 0, "block_size must be positive"
+		to_iter, columns, _, range, rows = Dataset._resolve_iteration(sliceno, columns, datasets, range, hashlabel, rehash, rows)
+		mkiter = Dataset._block_iterator_func(columns, block_size, range, sloppy_range, rows)
+		from itertools import chain
+		return chain.from_iterable(Dataset._iterate_datasets(to_iter, mkiter, pre_callback, post_callback, status_reporting, prefetch, prefetch and columns + list(range or ())))
+
+	@staticmethod
+	def _resolve_iteration(sliceno, columns, datasets, range, hashlabel, rehash, rows):
+		"""Common setup for iterate_list and iterate_blocks_list.
+		Returns (to_iter, columns, want_tuple, range, rows), where to_iter is
+		a list of (dataset, sliceno, rehash_on) to pass to _iterate_datasets."""
+		rows = _rowsfixup(rows)
+		if rows is not None:
+			assert sliceno is not None, "Can only specify rows for a single slice"
 		if isinstance(datasets, str_types + (Dataset, dict)):
 			datasets = [datasets]
 		datasets = [ds if isinstance(ds, Dataset) else Dataset(ds) for ds in datasets]
@@ -404,8 +1921,10 @@ class Dataset(unicode):
 			columns = [columns]
 			want_tuple = False
 		else:
-			if isinstance(columns, dict):
+			if isinstance(columns, MutableMapping):
 				columns = sorted(columns)
+			else:
+				columns = list(columns)
 			want_tuple = True
 		to_iter = []
 		if sliceno is None:
@@ -427,6 +1946,7 @@ class Dataset(unicode):
 			if hashlabel and d.hashlabel != hashlabel:
 				assert rehash, "%s has hashlabel %s, not %s" % (d, d.hashlabel, hashlabel,)
 				assert hashlabel in d.columns, "Can't rehash %s on non-existant column %s" % (d, hashlabel,)
+				assert rows is None, "Can't specify rows when rehashing %s" % (d,)
 				rehash_on = hashlabel
 			else:
 				rehash_on = False
@@ -436,20 +1956,19 @@ class Dataset(unicode):
 					to_iter.append((d, ix, False,))
 			else:
 				to_iter.append((d, sliceno, rehash_on,))
-		filter_func = Dataset._resolve_filters(columns, filters, want_tuple)
-		translation_func, translators = Dataset._resolve_translators(columns, translators)
-		if sloppy_range:
-			range = None
-		from itertools import chain
-		return chain.from_iterable(Dataset._iterate_datasets(to_iter, columns, pre_callback, post_callback, filter_func, translation_func, translators, want_tuple, range, status_reporting))
+		return to_iter, columns, want_tuple, range, rows
 
 	@staticmethod
 	def _resolve_filters(columns, filters, want_tuple):
+		"""Returns (filter_func, column_filters). column_filters is
+		[(column index, filter, keep_block or None), ...] for dict filters
+		(see _filter_keep_block), and None for a tuple filter."""
 		if filters and not callable(filters):
 			# Sort in column order, to allow selecting an efficient order.
 			filters = sorted((columns.index(name), f,) for name, f in filters.items())
+			column_filters = [(ix, f, _filter_keep_block(f),) for ix, f in filters]
 			if not want_tuple:
-				return filters[0][1] or bool
+				return filters[0][1] or bool, column_filters
 			# Build "lambda t: f0(t[0]) and f1(t[1]) and ..."
 			fs = []
 			arg_n = []
@@ -468,9 +1987,9 @@ class Dataset(unicode):
 			# (This is faster than putting them in "locals", you get
 			# LOAD_DEREF instead of LOAD_GLOBAL.)
 			f = 'lambda %s: %s' % (', '.join(arg_n), f)
-			return eval(f, {}, {})(*arg_v)
+			return eval(f, {}, {})(*arg_v), column_filters
 		else:
-			return filters
+			return filters, None
 
 	@staticmethod
 	def _resolve_translators(columns, translators):
@@ -487,7 +2006,252 @@ class Dataset(unicode):
 			return None, res
 
 	@staticmethod
-	def _iterate_datasets(to_iter, columns, pre_callback, post_callback, filter_func, translation_func, translators, want_tuple, range, status_reporting):
+	def _range_block_rows(d, sliceno, rehash, range):
+		"""Row ranges to read in d to get all rows in range, using the
+		block index of the range column. None means read everything."""
+		if not range or rehash:
+			return None
+		range_k, (range_bottom, range_top,) = next(iteritems(range))
+		def keep_block(min_v, max_v):
+			if range_top is not None and min_v >= range_top:
+				return False
+			if range_bottom is not None and max_v < range_bottom:
+				return False
+			return True
+		return d._block_rows(sliceno, range_k, keep_block)
+
+	@staticmethod
+	def _row_iterator_func(columns, filter_func, column_filters, translation_func, translators, want_tuple, range, sloppy_range, explicit_rows=None):
+		"""Returns a function (d, sliceno, rehash) -> row iterator,
+		for use with _iterate_datasets.
+
+		Filters on single (untranslated) columns are pushed down: They
+		are used to skip blocks (when possible), and are applied to just
+		their column. They only see rows in the range (and slice, when
+		rehashing), like other filters. With translators the resulting
+		mask is applied to each column, so only the selected rows are
+		translated."""
+		from itertools import tee
+		if column_filters and (translation_func or any(ix in translators for ix, _, _ in column_filters)):
+			column_filters = None
+		block_range = range
+		if sloppy_range:
+			range = None
+		if range:
+			range_k, (range_bottom, range_top,) = next(iteritems(range))
+			range_check = range_check_function(range_bottom, range_top)
+			if range_k in columns and range_k not in translators and not translation_func:
+				has_range_column = True
+				range_i = columns.index(range_k)
+				if want_tuple:
+					range_f = lambda t: range_check(t[range_i])
+				else:
+					range_f = range_check
+			else:
+				has_range_column = False
+		def mkiter(d, sliceno, rehash):
+			rows = _intersect_rows(explicit_rows, Dataset._range_block_rows(d, sliceno, rehash, block_range))
+			if column_filters and not rehash:
+				for ix, _, keep_block in column_filters:
+					if keep_block and columns[ix] in d.columns:
+						rows = _intersect_rows(rows, d._block_rows(sliceno, columns[ix], keep_block))
+			rehashed = rehash and d._rehash_iterators(sliceno, rehash, columns)
+			it = rehashed or d._iterator(None if rehash else sliceno, columns, rows=rows)
+			# With column filters the hashfilter and range are applied to
+			# the columns first, so the filters only see rows that would
+			# have reached them anyway.
+			hashfilter = rehash and not rehashed
+			filter_range_column = False
+			range_mask = None
+			pre_masks = [] # for the unfiltered rows
+			if column_filters and hashfilter:
+				from g import SLICES
+				pre_masks.append(d._column_iterator(None, rehash, hashfilter=(sliceno, SLICES)))
+				hashfilter = False
+			if range:
+				c = d.columns[range_k]
+				if c.min is not None and (not range_check(c.min) or not range_check(c.max)):
+					if has_range_column and column_filters:
+						it[range_i], range_it = tee(it[range_i])
+						pre_masks.append(imap(range_check, range_it))
+					elif has_range_column:
+						filter_range_column = True
+					else:
+						if rehashed:
+							filter_it = d._rehash_iterators(sliceno, rehash, [range_k])[0]
+						elif rehash:
+							filter_it = d._column_iterator(None, range_k)
+							if hashfilter:
+								filter_it = d._hashfilter(sliceno, rehash, filter_it)
+						else:
+							filter_it = d._column_iterator(sliceno, range_k, rows=rows)
+						if column_filters:
+							pre_masks.append(imap(range_check, filter_it))
+						else:
+							range_mask = imap(range_check, filter_it)
+			if pre_masks:
+				pre_mask = pre_masks[0] if len(pre_masks) == 1 else imap(all, izip(*pre_masks))
+				if len(it) == 1:
+					it = [compress(it[0], pre_mask)]
+				else:
+					it = [compress(col_it, col_mask) for col_it, col_mask in izip(it, tee(pre_mask, len(it)))]
+			masks = []
+			if column_filters:
+				for ix, f, _ in column_filters:
+					it[ix], mask_it = tee(it[ix])
+					if f is not None and f is not bool:
+						mask_it = imap(f, mask_it)
+					masks.append(mask_it)
+			mask = None
+			if masks:
+				mask = masks[0] if len(masks) == 1 else imap(all, izip(*masks))
+				if translators:
+					# Mask each column on its own, so only the rows that pass
+					# are translated. (Without translators it's faster to
+					# mask the tuples, unless almost all rows are filtered.)
+					if len(it) == 1:
+						it = [compress(it[0], mask)]
+					else:
+						it = [compress(col_it, col_mask) for col_it, col_mask in izip(it, tee(mask, len(it)))]
+					mask = None
+			for ix, trans in translators.items():
+				it[ix] = imap(trans, it[ix])
+			if want_tuple:
+				it = izip(*it)
+			else:
+				it = it[0]
+			if mask:
+				it = compress(it, mask)
+			if hashfilter:
+				it = d._hashfilter(sliceno, rehash, it)
+			if translation_func:
+				it = imap(translation_func, it)
+			if range_mask:
+				it = compress(it, range_mask)
+			if filter_range_column:
+				it = ifilter(range_f, it)
+			if filter_func and not column_filters:
+				it = ifilter(filter_func, it)
+			return it
+		return mkiter
+
+	@staticmethod
+	def _block_iterator_func(columns, block_size, range, sloppy_range, explicit_rows=None):
+		"""Returns a function (d, sliceno, rehash) -> iterator of
+		{column: numpy array}, for use with _iterate_datasets."""
+		import numpy
+		from itertools import islice
+		block_range = range
+		if sloppy_range:
+			range = None
+		if range:
+			range_k, (range_bottom, range_top,) = next(iteritems(range))
+			range_check = range_check_function(range_bottom, range_top)
+		def mkiter(d, sliceno, rehash):
+			names = list(columns)
+			for n in names:
+				if n in d.columns and d.columns[n].type not in _type2dtype:
+					raise Exception("Column %s in %s has type %s, which can not be iterated in blocks" % (n, d, d.columns[n].type,))
+			check_range = False
+			if range:
+				c = d.columns[range_k]
+				check_range = c.min is not None and (not range_check(c.min) or not range_check(c.max))
+				if check_range:
+					if range_k not in names:
+						names.append(range_k)
+					range_i = names.index(range_k)
+			rows = _intersect_rows(explicit_rows, Dataset._range_block_rows(d, sliceno, rehash, block_range))
+			rehashed = rehash and d._rehash_iterators(sliceno, rehash, names)
+			its = rehashed or d._iterator(None if rehash else sliceno, names, rows=rows)
+			hashfilter = rehash and not rehashed
+			if hashfilter:
+				from g import SLICES
+				hash_it = d._column_iterator(None, rehash, hashfilter=(sliceno, SLICES))
+			types = [d.columns[n].type for n in columns]
+			while True:
+				values = [list(islice(it, block_size)) for it in its]
+				count = len(values[0])
+				if not count:
+					return
+				mask = None
+				if hashfilter:
+					mask = numpy.fromiter(islice(hash_it, count), bool, count)
+				if check_range:
+					range_mask = numpy.fromiter(imap(range_check, values[range_i]), bool, count)
+					mask = range_mask if mask is None else mask & range_mask
+				if mask is not None and not mask.any():
+					continue
+				block = {}
+				for n, t, v in izip(columns, types, values):
+					a = _block_array(numpy, t, v)
+					if mask is not None:
+						a = a[mask]
+					block[n] = a
+				yield block
+		return mkiter
+
+	@staticmethod
+	def _iterate_parallel(to_iter, mkiter, parallel, ordered, status_reporting):
+		from multiprocessing import Process, Pipe
+		from select import select
+		if status_reporting:
+			from status import status
+		else:
+			from status import dummy_status as status
+		parallel = min(parallel, len(to_iter))
+		conns = []
+		procs = []
+		def recv(conn):
+			try:
+				ix, batch = conn.recv()
+			except EOFError:
+				raise Exception("A parallel iteration worker died")
+			if ix is None:
+				raise Exception("Parallel iteration failed:\n" + batch)
+			return ix, batch
+		msg_head = 'Iterating %s:%d to %s:%d in %d processes' % (to_iter[0][:2] + to_iter[-1][:2] + (parallel,))
+		with status(msg_head) as update:
+			try:
+				for worker in builtins.range(parallel):
+					r, w = Pipe(False)
+					p = Process(target=_parallel_worker, args=(w, to_iter, mkiter, worker, parallel,), name='iterate-%d' % (worker,))
+					p.daemon = True
+					p.start()
+					w.close()
+					conns.append(r)
+					procs.append(p)
+				if ordered:
+					for ix, (d, sliceno, _) in enumerate(to_iter):
+						update('%s, %d/%d (%s:%d)' % (msg_head, ix + 1, len(to_iter), d, sliceno,))
+						conn = conns[ix % parallel]
+						while True:
+							_, batch = recv(conn)
+							if batch is None:
+								break
+							yield batch
+				else:
+					live = list(conns)
+					done = 0
+					while live:
+						for conn in select(live, [], [])[0]:
+							ix, batch = recv(conn)
+							if batch is None:
+								done += 1
+								update('%s, %d/%d done' % (msg_head, done, len(to_iter),))
+								if ix + parallel >= len(to_iter):
+									live.remove(conn)
+							else:
+								yield batch
+			finally:
+				for conn in conns:
+					conn.close()
+				for p in procs:
+					if p.is_alive():
+						p.terminate()
+					p.join()
+
+	@staticmethod
+	def _iterate_datasets(to_iter, mkiter, pre_callback, post_callback, status_reporting, prefetch=0, prefetch_columns=()):
 		skip_ds = None
 		def argfixup(func, is_post):
 			if func:
@@ -507,18 +2271,6 @@ class Dataset(unicode):
 		post_callback, unsliced_post_callback = argfixup(post_callback, True)
 		if not to_iter:
 			return
-		if range:
-			range_k, (range_bottom, range_top,) = next(iteritems(range))
-			range_check = range_check_function(range_bottom, range_top)
-			if range_k in columns and range_k not in translators and not translation_func:
-				has_range_column = True
-				range_i = columns.index(range_k)
-				if want_tuple:
-					range_f = lambda t: range_check(t[range_i])
-				else:
-					range_f = range_check
-			else:
-				has_range_column = False
 		if status_reporting:
 			from status import status
 		else:
@@ -535,68 +2287,66 @@ class Dataset(unicode):
 		else:
 			msg_head = 'Iterating %s to %s' % (fmt_dsname(*to_iter[0]), fmt_dsname(*to_iter[-1]),)
 			def update_status(update, ix, d, sliceno, rehash):
-				update('%s, %d/%d (%s)' % (msg_head, ix, len(to_iter), fmt_dsname(d, sliceno, rehash)))
+				msg = '%s, %d/%d (%s)' % (msg_head, ix, len(to_iter), fmt_dsname(d, sliceno, rehash))
+				if prefetcher:
+					msg = '%s, prefetch %d hits %d misses' % (msg, prefetcher.hits, prefetcher.misses,)
+				update(msg)
+		prefetcher = None
+		if prefetch and len(to_iter) > 1:
+			prefetcher = _Prefetcher(to_iter, prefetch_columns, prefetch)
 		with status(msg_head) as update:
-			for ix, (d, sliceno, rehash) in enumerate(to_iter, 1):
-				if unsliced_post_callback:
-					try:
-						post_callback(d)
-					except StopIteration:
-						return
-				update_status(update, ix, d, sliceno, rehash)
-				if pre_callback:
-					if d == skip_ds:
-						continue
-					try:
-						pre_callback(d, sliceno)
-					except SkipSlice:
-						if unsliced_pre_callback:
+			try:
+				for ix, (d, sliceno, rehash) in enumerate(to_iter, 1):
+					if prefetcher:
+						prefetcher.starting(ix - 1)
+					if unsliced_post_callback:
+						try:
+							post_callback(d)
+						except StopIteration:
+							return
+					update_status(update, ix, d, sliceno, rehash)
+					if pre_callback:
+						if d == skip_ds:
+							continue
+						try:
+							pre_callback(d, sliceno)
+						except SkipSlice:
+							if unsliced_pre_callback:
+								skip_ds = d
+							continue
+						except SkipJob:
 							skip_ds = d
-						continue
-					except SkipJob:
-						skip_ds = d
-						continue
-					except StopIteration:
-						return
-				it = d._iterator(None if rehash else sliceno, columns)
-				for ix, trans in translators.items():
-					it[ix] = imap(trans, it[ix])
-				if want_tuple:
-					it = izip(*it)
-				else:
-					it = it[0]
-				if rehash:
-					it = d._hashfilter(sliceno, rehash, it)
-				if translation_func:
-					it = imap(translation_func, it)
-				if range:
-					c = d.columns[range_k]
-					if c.min is not None and (not range_check(c.min) or not range_check(c.max)):
-						if has_range_column:
-							it = ifilter(range_f, it)
-						else:
-							if rehash:
-								filter_it = d._hashfilter(sliceno, rehash, d._column_iterator(None, range_k))
-							else:
-								filter_it = d._column_iterator(sliceno, range_k)
-							it = compress(it, imap(range_check, filter_it))
-				if filter_func:
-					it = ifilter(filter_func, it)
-				yield it
-				if post_callback and not unsliced_post_callback:
+							continue
+						except StopIteration:
+							return
+					yield mkiter(d, sliceno, rehash)
+					if post_callback and not unsliced_post_callback:
+						try:
+							post_callback(d, sliceno)
+						except StopIteration:
+							return
+				if unsliced_post_callback:
 					try:
-						post_callback(d, sliceno)
+						post_callback(None)
 					except StopIteration:
 						return
-			if unsliced_post_callback:
-				try:
-					post_callback(None)
-				except StopIteration:
-					return
+			finally:
+				if prefetcher:
+					prefetcher.stop()
 
 	@staticmethod
-	def new(columns, filenames, lines, minmax={}, filename=None, hashlabel=None, caption=None, previous=None, name='default'):
-		"""columns = {"colname": "type"}, lines = [n, ...] or {sliceno: n}"""
+	def new(columns, filenames, lines, minmax={}, filename=None, hashlabel=None, caption=None, previous=None, name='default', blocks=None, compression={}, dictionaries={}, segments={}, stats={}, containers={}):
+		"""columns = {"colname": "type"}, lines = [n, ...] or {sliceno: n}
+		blocks = {sliceno: {"colname": [(offset, count, min, max), ...]}}
+		compression = {"colname": "compression"} (default "gzip")
+		dictionaries = {sliceno: {"colname": [value, ...]}} for dictionary
+		encoded columns (where the files have int32 codes).
+		segments = {sliceno: {"colname": [(filename, offset, count), ...]}}
+		for columns that are parts of other files (in this job).
+		stats = {sliceno: {"colname": (nulls, sketch)}} where sketch is a
+		HyperLogLog sketch (see gzwrite.GzWriteStats) or None.
+		containers = {sliceno: {"colname": (offset, size)}} for columns
+		that are in name/slice.<sliceno> (see _make_container)."""
 		columns = {uni(k): uni(v) for k, v in columns.items()}
 		if hashlabel:
 			hashlabel = uni(hashlabel)
@@ -604,7 +2354,7 @@ class Dataset(unicode):
 		res = Dataset(_new_dataset_marker, name)
 		res._data.lines = list(Dataset._linefixup(lines))
 		res._data.hashlabel = hashlabel
-		res._append(columns, filenames, minmax, filename, caption, previous, name)
+		res._append(columns, filenames, minmax, filename, caption, previous, name, blocks, compression, dictionaries, segments, stats, containers)
 		return res
 
 	@staticmethod
@@ -616,14 +2366,14 @@ class Dataset(unicode):
 		assert len(lines) == SLICES, "Lines must be specified for all slices"
 		return lines
 
-	def append(self, columns, filenames, lines, minmax={}, filename=None, hashlabel=None, hashlabel_override=False, caption=None, previous=None, name='default'):
+	def append(self, columns, filenames, lines, minmax={}, filename=None, hashlabel=None, hashlabel_override=False, caption=None, previous=None, name='default', blocks=None, compression={}, dictionaries={}, segments={}, stats={}, containers={}):
 		if hashlabel:
 			hashlabel = uni(hashlabel)
 			if not hashlabel_override:
 				assert self.hashlabel == hashlabel, 'Hashlabel mismatch %s != %s' % (self.hashlabel, hashlabel,)
 		assert self._linefixup(lines) == self.lines, "New columns don't have the same number of lines as parent columns"
 		columns = {uni(k): uni(v) for k, v in columns.items()}
-		self._append(columns, filenames, minmax, filename, caption, previous, name)
+		self._append(columns, filenames, minmax, filename, caption, previous, name, blocks, compression, dictionaries, segments, stats, containers)
 
 	def _minmax_merge(self, minmax):
 		def minmax_fixup(a, b):
@@ -642,9 +2392,9 @@ class Dataset(unicode):
 					res[name] = [min(mm[0], omm[0]), max(mm[1], omm[1])]
 		return res
 
-	def _append(self, columns, filenames, minmax, filename, caption, previous, name):
+	def _append(self, columns, filenames, minmax, filename, caption, previous, name, blocks=None, compression={}, dictionaries={}, segments={}, stats={}, containers={}):
 		from sourcedata import type2iter
-		from g import JOBID
+		from g import JOBID, SLICES
 		jobid = uni(JOBID)
 		name = uni(name)
 		filenames = {uni(k): uni(v) for k, v in filenames.items()}
@@ -659,66 +2409,175 @@ class Dataset(unicode):
 		for n in ('cache', 'cache_distance'):
 			if n in self._data: del self._data[n]
 		minmax = self._minmax_merge(minmax)
+		to_merge = []
+		sketches = {}
+		sketches_fn = self._name('sketches.pickle')
 		for n, t in sorted(columns.items()):
 			if t not in type2iter:
 				raise Exception('Unknown type %s on column %s' % (t, n,))
 			mm = minmax.get(n, (None, None,))
 			t = uni(t)
+			if blocks:
+				blocks_fn = '%s/%s.blocks.pickle' % (self.name, filenames[n],)
+				blob.save([blocks[sliceno][n] for sliceno in range(SLICES)], blocks_fn, temp=False)
+				blocks_location = '%s/%s' % (jobid, blocks_fn,)
+			else:
+				blocks_location = None
+			if any(n in d for d in dictionaries.values()):
+				dictionary_fn = '%s/%s.dict.pickle' % (self.name, filenames[n],)
+				blob.save([dictionaries.get(sliceno, {}).get(n, []) for sliceno in range(SLICES)], dictionary_fn, temp=False)
+				dictionary_location = '%s/%s' % (jobid, dictionary_fn,)
+				backing_type = 'int32'
+			else:
+				dictionary_location = None
+				backing_type = t
+			if any(n in s for s in segments.values()):
+				assert not blocks, "Can't have a block index with segments"
+				slice_segments = []
+				for sliceno in range(SLICES):
+					assert n in segments.get(sliceno, {}), "Segments for %s missing in slice %d" % (n, sliceno,)
+					lst = [('%s/%s' % (jobid, uni(fn),), offset, count,) for fn, offset, count in segments[sliceno][n]]
+					assert sum(count for _, _, count in lst) == self.lines[sliceno], "Segments for %s in slice %d don't add up to %d lines" % (n, sliceno, self.lines[sliceno],)
+					slice_segments.append(lst)
+				segments_fn = '%s/%s.segments.pickle' % (self.name, filenames[n],)
+				blob.save(slice_segments, segments_fn, temp=False)
+				segments_location = '%s/%s' % (jobid, segments_fn,)
+				location = None
+			else:
+				segments_location = None
+				location = '%s/%s/%%s.%s' % (jobid, self.name, filenames[n])
+			offsets = None
+			size = None
+			if any(n in c for c in containers.values()):
+				assert not segments_location, "Can't have segments in a container"
+				location = '%s/%s' % (jobid, _container_name(self.name),)
+				offsets = tuple(containers[sliceno][n][0] for sliceno in range(SLICES))
+				size = sum(containers[sliceno][n][1] for sliceno in range(SLICES))
+			elif not segments_location:
+				slice_fns = [location.split('/', 1)[1] % (sliceno,) for sliceno in range(SLICES)]
+				if all(os.path.exists(fn) for fn in slice_fns):
+					size = sum(os.path.getsize(fn) for fn in slice_fns)
+			column_stats = [stats.get(sliceno, {}).get(n) for sliceno in range(SLICES)]
+			if None in column_stats:
+				column_stats = ColumnStats(None, None, size, None)
+			else:
+				sketch = None
+				for _, slice_sketch in column_stats:
+					if slice_sketch is not None:
+						sketch = hll_merge(sketch, slice_sketch) if sketch else bytearray(slice_sketch)
+				if sketch:
+					sketches[filenames[n]] = bytes(sketch)
+				column_stats = ColumnStats(
+					nulls=sum(nulls for nulls, _ in column_stats),
+					distinct=hll_estimate(sketch) if sketch else None,
+					size=size,
+					sketch='%s/%s' % (jobid, sketches_fn,) if sketch else None,
+				)
 			self._data.columns[n] = DatasetColumn(
 				type=_type_v2compattov3t.get(t, t),
-				backing_type=t,
+				backing_type=backing_type,
 				name=filenames[n],
-				location='%s/%s/%%s.%s' % (jobid, self.name, filenames[n]),
+				location=location,
 				min=mm[0],
 				max=mm[1],
-				offsets=None,
+				offsets=offsets,
+				blocks=blocks_location,
+				compression=uni(compression.get(n) or 'gzip'),
+				dictionary=dictionary_location,
+				segments=segments_location,
+				stats=column_stats,
 			)
-			self._maybe_merge(n)
+			if location and not offsets:
+				to_merge.append(n)
+		if sketches:
+			if os.path.exists(sketches_fn): # appending to ourselves
+				old_sketches = blob.load(sketches_fn)
+				old_sketches.update(sketches)
+				sketches = old_sketches
+			blob.save(sketches, sketches_fn, temp=False)
+		self._maybe_merge(to_merge)
 		self._update_caches()
 		self._save()
 
 	def _update_caches(self):
+		"""Set chain_depth and make the chain index (which _save writes)."""
+		from itertools import islice
 		for k in ('cache', 'cache_distance',):
 			if k in self._data:
 				del self._data[k]
+		self._chain_index = None
+		depth = 1
 		if self.previous:
 			d = Dataset(self.previous)
-			cache_distance = d._data.get('cache_distance', 1) + 1
-			if cache_distance == 64:
-				cache_distance = 0
-				chain = self.chain(64)
-				self._data['cache'] = tuple((unicode(d), d._data) for d in chain[:-1])
-			self._data['cache_distance'] = cache_distance
-
-	def _maybe_merge(self, n):
+			depth = d._data.get('chain_depth', 0) + 1
+			self._chain_index = [_chain_entry(d)]
+			self._chain_index.extend(islice(d._ancestors(), (depth & -depth) - 1))
+		self._data.chain_depth = depth
+
+	def _maybe_merge(self, names):
+		"""Put the slices of each column in names that is small (see
+		set_merge_threshold) in one file. If the previous dataset is
+		from this job and has its column in a merged file, we append to
+		that file, so a chain built in one job has one file per column.
+		Columns are merged in parallel."""
 		from g import SLICES
-		if SLICES < 2:
+		if SLICES < 2 or not names:
 			return
-		fn = self.column_filename(n)
-		sizes = [os.path.getsize(fn % (sliceno,)) for sliceno in range(SLICES)]
-		if sum(sizes) / SLICES > 524288: # arbitrary guess of good size
+		threshold = _merge_threshold()
+		if not threshold:
 			return
-		offsets = []
-		pos = 0
-		with open(fn % ('m',), 'wb') as m_fh:
-			for sliceno, size in enumerate(sizes):
-				with open(fn % (sliceno,), 'rb') as p_fh:
-					data = p_fh.read()
-				assert len(data) == size, "Slice %d is %d bytes, not %d?" % (sliceno, len(data), size,)
-				os.unlink(fn % (sliceno,))
-				m_fh.write(data)
-				offsets.append(pos)
-				pos += size
-		c = self._data.columns[n]
-		self._data.columns[n] = c._replace(
-			offsets=offsets,
-			location=c.location % ('m',),
-		)
+		todo = []
+		for n in names:
+			fn = self.column_filename(n)
+			sizes = [os.path.getsize(fn % (sliceno,)) for sliceno in range(SLICES)]
+			if sum(sizes) / SLICES <= threshold:
+				target = self._merge_target(n)
+				if target:
+					todo.append((n, fn, sizes, target, True,))
+				else:
+					target = self._data.columns[n].location.split('/', 1)[1] % ('m',)
+					todo.append((n, fn, sizes, target, False,))
+		if not todo:
+			return
+		if len(todo) == 1:
+			res = [_merge_column_files(todo[0])]
+		else:
+			from multiprocessing.pool import ThreadPool
+			pool = ThreadPool(min(len(todo), 8))
+			try:
+				res = pool.map(_merge_column_files, todo)
+			finally:
+				pool.close()
+				pool.join()
+		for (n, _, _, target, _), offsets in zip(todo, res):
+			c = self._data.columns[n]
+			self._data.columns[n] = c._replace(
+				offsets=offsets,
+				location='%s/%s' % (self.jobid, target,),
+			)
+
+	def _merge_target(self, n):
+		"""The merged file of the same column in the previous dataset, if
+		that is in this job, or None."""
+		if not self.previous or not self.previous.startswith(self.jobid + '/'):
+			return None
+		prev_c = Dataset(self.previous).columns.get(n)
+		if not prev_c or not prev_c.offsets or not prev_c.location or _in_container(prev_c):
+			return None
+		jid, name = prev_c.location.split('/', 1)
+		if jid != self.jobid or not os.path.exists(name):
+			return None
+		return name
 
 	def _save(self):
 		if not os.path.exists(self.name):
 			os.mkdir(self.name)
-		blob.save(self._data, self._name('pickle'), temp=False)
+		data = DotDict(self._data)
+		data.columns = dict(data.columns)
+		blob.save(data, self._name('pickle'), temp=False)
+		_meta_save(data, self._name('meta'))
+		if getattr(self, '_chain_index', None):
+			blob.save([tuple(e) for e in self._chain_index], self._name('chain.pickle'), temp=False)
 		with open(self._name('txt'), 'w', encoding='utf-8') as fh:
 			nl = False
 			if self.hashlabel:
@@ -729,7 +2588,7 @@ class Dataset(unicode):
 				nl = True
 			if nl:
 				fh.write('\n')
-			col_list = sorted((k, c.type, c.location,) for k, c in self.columns.items())
+			col_list = sorted((k, c.type, c.location or c.segments,) for k, c in self.columns.items())
 			lens = tuple(max(minlen, max(len(t[i]) for t in col_list)) for i, minlen in ((0, 4), (1, 4), (2, 8)))
 			template = '%%%ds  %%%ds  %%-%ds\n' % lens
 			fh.write(template % ('name', 'type', 'location'))
@@ -740,8 +2599,160 @@ class Dataset(unicode):
 	def _name(self, thing):
 		return '%s/dataset.%s' % (self.name, thing,)
 
+def _merge_column_files(job):
+	"""Put the slice files of a column in target (after what is already
+	there if append), remove them, and return the offsets they ended
+	up at."""
+	_, fn, sizes, target, append = job
+	offsets = []
+	# Not O_APPEND, the kernel copy functions don't allow that.
+	out_fd = os.open(target, os.O_WRONLY | os.O_CREAT | (0 if append else os.O_TRUNC), 0o666)
+	try:
+		pos = os.lseek(out_fd, 0, os.SEEK_END)
+		for sliceno, size in enumerate(sizes):
+			in_fd = os.open(fn % (sliceno,), os.O_RDONLY)
+			try:
+				_copy_fd(in_fd, out_fd, size)
+			finally:
+				os.close(in_fd)
+			offsets.append(pos)
+			pos += size
+		assert os.fstat(out_fd).st_size == pos, "%s is not %d bytes after merging" % (target, pos,)
+	finally:
+		os.close(out_fd)
+	for sliceno in range(len(sizes)):
+		os.unlink(fn % (sliceno,))
+	return offsets
+
+def _copy_fd(in_fd, out_fd, size):
+	"""Copy size bytes from in_fd to out_fd (from and to the current
+	positions), letting the kernel do it when it can."""
+	for name in ('copy_file_range', 'sendfile',):
+		func = getattr(os, name, None)
+		if not func:
+			continue
+		try:
+			while size:
+				if name == 'sendfile':
+					copied = func(out_fd, in_fd, None, size)
+				else:
+					copied = func(in_fd, out_fd, size)
+				assert copied, "File shrunk while copying"
+				size -= copied
+			return
+		except OSError:
+			# Not supported for these files, try the next way (from where we are).
+			pass
+	while size:
+		data = os.read(in_fd, min(size, 1048576))
+		assert data, "File shrunk while copying"
+		while data:
+			written = os.write(out_fd, data)
+			data = data[written:]
+			size -= written
+
+_container_magic = b'ACCSLICE'
+
+def _container_name(name, sliceno='%s'):
+	"""Column files are "<sliceno>.<column>", so this can't collide."""
+	return '%s/slice.%s' % (name, sliceno,)
+
+def _in_container(dc):
+	return bool(dc.offsets and dc.location and '%s' in dc.location)
+
+def _make_container(job):
+	"""Put the files in parts ([(colname, filename), ...]) in target
+	followed by a directory (see _container_directory), remove them
+	and return the directory."""
+	from json import dumps
+	from struct import pack
+	target, parts = job
+	directory = {}
+	out_fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+	try:
+		pos = 0
+		for colname, fn in parts:
+			size = os.path.getsize(fn)
+			in_fd = os.open(fn, os.O_RDONLY)
+			try:
+				_copy_fd(in_fd, out_fd, size)
+			finally:
+				os.close(in_fd)
+			directory[colname] = (pos, size,)
+			pos += size
+		footer = dumps(directory, sort_keys=True).encode('utf-8')
+		footer += pack('<Q', len(footer)) + _container_magic
+		while footer:
+			footer = footer[os.write(out_fd, footer):]
+	finally:
+		os.close(out_fd)
+	for _, fn in parts:
+		os.unlink(fn)
+	return directory
+
+_container_directories = {}
+def _container_directory(fn):
+	"""{colname: (offset, size)} for the container in fn."""
+	if fn not in _container_directories:
+		from json import loads
+		from struct import unpack
+		with open(fn, 'rb') as fh:
+			fh.seek(-16, 2)
+			tail = fh.read(16)
+			assert tail[8:] == _container_magic, "%s is not a container" % (fn,)
+			length, = unpack('<Q', tail[:8])
+			fh.seek(-16 - length, 2)
+			directory = loads(fh.read(length).decode('utf-8'))
+		_container_directories[fn] = {k: tuple(v) for k, v in directory.items()}
+	return _container_directories[fn]
+
+class _Partitioner(object):
+	"""Splits batches of values over slices, by hashfunc(key) % slices
+	or round robin (continuing between batches) if hashfunc is None.
+
+	Calling it with the keys for a batch gives (sliceno, get) for each
+	slice that gets any rows, where get(values) gives that slice's part
+	of any column in the batch. The keys are hashed and counted once, and
+	each value is then picked once, so more slices does not mean more
+	passes over the keys or the columns.
+	"""
+	def __init__(self, slices, hashfunc=None):
+		self.slices = slices
+		self.hashfunc = hashfunc
+		self._next = 0
+
+	def __call__(self, keys):
+		from itertools import islice, repeat
+		from operator import mod
+		from collections import Counter
+		slices = self.slices
+		if not self.hashfunc:
+			start = self._next
+			self._next = (start + len(keys)) % slices
+			skips = [(sliceno, (sliceno - start) % slices) for sliceno in range(slices)]
+			return [(sliceno, lambda values, skip=skip: islice(values, skip, None, slices)) for sliceno, skip in skips if skip < len(keys)]
+		dest = list(imap(mod, imap(self.hashfunc, keys), repeat(slices)))
+		counter = Counter(dest)
+		counts = [counter[sliceno] for sliceno in range(slices)]
+		if max(counts) == len(dest):
+			# Everything goes to one slice (or there is nothing)
+			return [(sliceno, iter) for sliceno, count in enumerate(counts) if count]
+		order = sorted(range(len(dest)), key=dest.__getitem__)
+		res = []
+		pos = 0
+		for sliceno, count in enumerate(counts):
+			if count:
+				rows = order[pos:pos + count]
+				res.append((sliceno, lambda values, rows=rows: imap(values.__getitem__, rows)))
+				pos += count
+		return res
+
 _datasetwriters = {}
 
+# Time spent writing (summed over all processes) for each
+# dataset finished with write_behind in this job.
+write_behind_stats = {}
+
 _nodefault = object()
 
 class DatasetWriter(object):
@@ -781,6 +2792,10 @@ class DatasetWriter(object):
 	
 	These should of course be assigned to a local name for performance.
 	
+	To write many rows with one call there is dw.write_columns({column:
+	values}) and dw.get_split_write_columns()({column: values}), where
+	values are sequences (or numpy arrays) of the same length.
+	
 	It is permitted (but probably useless) to mix different write or
 	split functions, but you can only use either write functions or
 	split functions.
@@ -794,11 +2809,49 @@ class DatasetWriter(object):
 	In this case you also need to call dw.set_lines(sliceno, count)
 	before finishing. You should also call
 	dw.set_minmax(sliceno, {colname: (min, max)}) if you can.
+	Instead of writing files you can use dw.set_segments to make the
+	columns out of files that are already written in this job.
+	
+	If you set block_size every column is written in independently
+	compressed blocks of that many values, and the offset and min/max
+	of each block is saved. Iterating with range= can then skip blocks
+	that contain no matching values, and readers can seek to a row
+	without decompressing everything before it.
+	
+	compression (for all columns, or per column in add) is one of
+	gzwrite.compressions: "gzip" (the default), "gzip-1" to "gzip-9"
+	or "none". Use something fast (or "none") for intermediate datasets
+	that are read many times and don't need to be small.
+	
+	The types "dict:unicode", "dict:ascii" and "dict:bytes" are dictionary
+	encoded: each slice stores every distinct value once and a small
+	integer code per row. Use them for columns with few distinct values.
+	Readers get the values as usual (see Dataset.dictionary and
+	Dataset.iterate_codes for working with the codes).
+	
+	With write_behind=N the write functions only collect values, and N
+	processes write (and compress) them in batches of write_behind_batch
+	values. Each process has room for two waiting batches before writing
+	has to wait, so memory use stays bounded. This only helps when there
+	are idle CPUs for the writing processes (the values are pickled to
+	them, so otherwise it is slower). Errors from bad values are raised
+	later than usual (from a later write or when finishing). The time
+	spent writing is in the job profile (as write_behind).
+	
+	With stats=True every column also counts None values and keeps a
+	sketch for approximating the number of distinct values. These end
+	up in ds.columns[colname].stats (together with the size on disk,
+	which is always there). See also Dataset.chain_column_stats.
+	
+	With container=True all columns of a slice end up in one file
+	(name/slice.<sliceno>), for wide datasets where one file per
+	column and slice is too many files. Columns are still read on
+	their own, use ds.column_location to get (filename, offset).
 	"""
 
 	_split = _split_dict = _split_list = _allwriters_ = None
 
-	def __new__(cls, columns={}, filename=None, hashlabel=None, hashlabel_override=False, caption=None, previous=None, name='default', parent=None, meta_only=False, for_single_slice=None):
+	def __new__(cls, columns={}, filename=None, hashlabel=None, hashlabel_override=False, caption=None, previous=None, name='default', parent=None, meta_only=False, for_single_slice=None, block_size=None, compression=None, write_behind=0, write_behind_batch=4096, stats=False, container=False):
 		"""columns can be {'name': 'type'} or {'name': DatasetColumn}
 		to simplify basing your dataset on another."""
 		name = uni(name)
@@ -806,7 +2859,7 @@ class DatasetWriter(object):
 		from g import running
 		if running == 'analysis':
 			assert name in _datasetwriters, 'Dataset with name "%s" not created' % (name,)
-			assert not columns and not filename and not hashlabel and not caption and not parent and for_single_slice is None, "Don't specify any arguments (except optionally name) in analysis"
+			assert not columns and not filename and not hashlabel and not caption and not parent and for_single_slice is None and block_size is None and compression is None and not write_behind and not stats and not container, "Don't specify any arguments (except optionally name) in analysis"
 			return _datasetwriters[name]
 		else:
 			assert name not in _datasetwriters, 'Duplicate dataset name "%s"' % (name,)
@@ -823,6 +2876,21 @@ class DatasetWriter(object):
 			obj.columns = {}
 			obj.meta_only = meta_only
 			obj._for_single_slice = for_single_slice
+			assert not (meta_only and block_size), "block_size does nothing with meta_only"
+			obj.block_size = block_size
+			if compression:
+				compression_kw(compression) # gives error for unknown compressions
+			obj.compression = compression or 'gzip'
+			obj._compression = {}
+			assert not (meta_only and write_behind), "write_behind does nothing with meta_only"
+			obj.write_behind = write_behind
+			obj.write_behind_batch = write_behind_batch
+			obj._pool = None
+			obj._write_behind_time = {}
+			assert not (meta_only and stats), "stats does nothing with meta_only"
+			obj.stats = stats
+			obj._stats = {}
+			obj.container = container
 			obj._clean_names = {}
 			if parent:
 				obj._pcolumns = Dataset(parent).columns
@@ -833,6 +2901,9 @@ class DatasetWriter(object):
 			obj._started = False
 			obj._lens = {}
 			obj._minmax = {}
+			obj._blocks = {}
+			obj._dictionaries = {}
+			obj._segments = {}
 			obj._order = []
 			for k, v in sorted(columns.items()):
 				if isinstance(v, tuple):
@@ -841,7 +2912,7 @@ class DatasetWriter(object):
 			_datasetwriters[name] = obj
 			return obj
 
-	def add(self, colname, coltype, default=_nodefault):
+	def add(self, colname, coltype, default=_nodefault, compression=None):
 		from g import running
 		assert running == self._running, "Add all columns in the same step as creation"
 		assert not self._started, "Add all columns before setting slice"
@@ -850,7 +2921,10 @@ class DatasetWriter(object):
 		assert colname not in self.columns, colname
 		assert colname
 		typed_writer(coltype) # gives error for unknown types
+		compression = uni(compression or self.compression)
+		compression_kw(compression) # gives error for unknown compressions
 		self.columns[colname] = (coltype, default)
+		self._compression[colname] = compression
 		self._order.append(colname)
 		if colname in self._pcolumns:
 			self._clean_names[colname] = self._pcolumns[colname].name
@@ -894,17 +2968,30 @@ class DatasetWriter(object):
 		for colname, (coltype, default) in self.columns.items():
 			wt = typed_writer(coltype)
 			kw = {} if default is _nodefault else {'default': default}
+			kw.update(compression_kw(self._compression[colname]))
 			fn = self.column_filename(colname, sliceno)
+			if self.block_size:
+				if coltype.startswith('dict:'):
+					wt = partial(wt, block_size=self.block_size)
+				else:
+					wt = partial(GzWriteBlocked, wt, block_size=self.block_size)
+			if self.stats:
+				wt = partial(GzWriteStats, wt)
 			if filtered and colname == self.hashlabel:
 				from g import SLICES
 				w = wt(fn, hashfilter=(sliceno, SLICES), **kw)
 				self.hashcheck = w.hashcheck
+			elif self.write_behind:
+				if not self._pool:
+					self._pool = WriteBehindPool(self.write_behind)
+				w = GzWriteBehind(wt, fn, self._pool, batch_size=self.write_behind_batch, **kw)
 			else:
 				w = wt(fn, **kw)
 			writers[colname] = w
 		return writers
 
 	def _mkwritefuncs(self, discard=False):
+		self._hash_discard = discard
 		hl = self.hashlabel
 		w_l = [self.writers[c].write for c in self._order]
 		w = {k: w.write for k, w in self.writers.items()}
@@ -967,6 +3054,71 @@ class DatasetWriter(object):
 	def get_split_write_dict(self):
 		return self._split_dict or self._mksplit()['split_dict']
 
+	def _columns_values(self, data):
+		"""{column: list of values} from what write_columns got."""
+		assert set(data) == set(self.columns), "Specify all columns (missing %r, unknown %r)" % (set(self.columns) - set(data), set(data) - set(self.columns),)
+		values = {}
+		for k, v in iteritems(data):
+			if hasattr(v, 'tolist'): # numpy, array.array
+				v = v.tolist()
+			values[uni(k)] = v
+		assert len(set(len(v) for v in values.values())) <= 1, "Not all columns have the same length"
+		return values
+
+	def write_columns(self, data):
+		"""Write many rows at once. data is {column: values} where values
+		are sequences (or numpy arrays) of the same length. The values are
+		passed directly to the column writers, so there is no python code
+		running per row.
+		With hashlabel, rows that do not belong in this slice are an error
+		unless you called enable_hash_discard."""
+		from collections import deque
+		assert self._started == 1, "Call set_slice before write_columns (or use get_split_write_columns)"
+		values = self._columns_values(data)
+		hl = self.hashlabel
+		if hl:
+			keep = list(imap(self.hashcheck, values[hl]))
+			if not all(keep):
+				assert self._hash_discard, "Attempted to write data for wrong slice"
+			for k, w in iteritems(self.writers):
+				deque(imap(w.write, compress(values[k], keep)), 0)
+		else:
+			for k, w in iteritems(self.writers):
+				deque(imap(w.write, values[k]), 0)
+
+	def get_split_write_columns(self):
+		"""Like get_split_write, but the returned function writes many rows
+		at once, like write_columns. Rows are split over the slices by
+		the same hash as the other split writers, or round robin if there
+		is no hashlabel."""
+		import g
+		from collections import deque
+		if g.running == 'analysis':
+			assert self._for_single_slice == g.sliceno, "Only use dataset in designated slice"
+		assert self._started != 1, "Don't use both a split writer and set_slice"
+		allwriters = self._allwriters
+		hl = self.hashlabel
+		partition = _Partitioner(len(allwriters), allwriters[0][hl].hash if hl else None)
+		def split_write_columns(data):
+			values = self._columns_values(data)
+			for sliceno, get in partition(values[hl or self._order[0]]):
+				for k, w in iteritems(allwriters[sliceno]):
+					deque(imap(w.write, get(values[k])), 0)
+		return split_write_columns
+
+	def get_split_write_rows(self):
+		"""Like get_split_write_list, but the returned function takes a
+		list of rows and writes them all with one call."""
+		split_write_columns = self.get_split_write_columns()
+		order = self._order
+		empty = {k: () for k in order}
+		def split_write_rows(rows):
+			if rows:
+				split_write_columns(dict(izip(order, izip(*rows))))
+			else:
+				split_write_columns(empty)
+		return split_write_rows
+
 	def _mksplit(self):
 		import g
 		if g.running == 'analysis':
@@ -1011,14 +3163,42 @@ class DatasetWriter(object):
 	def _close(self, sliceno, writers):
 		lens = {}
 		minmax = {}
+		blocks = {}
+		dictionaries = {}
+		stats = {}
 		for k, w in writers.items():
 			lens[k] = w.count
 			minmax[k] = (w.min, w.max,)
 			w.close()
+			if self.block_size:
+				blocks[k] = w.blocks
+			if hasattr(w, 'values'):
+				dictionaries[k] = w.values
+			if self.stats:
+				stats[k] = (w.nulls, w.sketch,)
 		len_set = set(lens.values())
 		assert len(len_set) == 1, "Not all columns have the same linecount in slice %d: %r" % (sliceno, lens)
 		self._lens[sliceno] = len_set.pop()
 		self._minmax[sliceno] = minmax
+		if self.block_size:
+			self._blocks[sliceno] = blocks
+		if dictionaries:
+			self._dictionaries[sliceno] = dictionaries
+		if stats:
+			self._stats[sliceno] = stats
+
+	def _slice_state(self):
+		"""What analysis needs to send back to the main process to finish."""
+		return dict(lens=self._lens, minmax=self._minmax, blocks=self._blocks, dictionaries=self._dictionaries, segments=self._segments, stats=self._stats, write_behind_time=self._write_behind_time)
+
+	def _merge_slice_state(self, state):
+		self._lens.update(state['lens'])
+		self._minmax.update(state['minmax'])
+		self._blocks.update(state['blocks'])
+		self._dictionaries.update(state['dictionaries'])
+		self._segments.update(state['segments'])
+		self._stats.update(state['stats'])
+		self._write_behind_time.update(state['write_behind_time'])
 
 	def close(self):
 		if self._started == 2:
@@ -1028,11 +3208,20 @@ class DatasetWriter(object):
 			if hasattr(self, 'writers'):
 				self._close(self.sliceno, self.writers)
 				del self.writers
-
-	def discard(self):
+		if self._pool:
+			# Keyed by pid so the times from all processes can be merged.
+			pid = os.getpid()
+			self._pool.close()
+			self._write_behind_time[pid] = self._write_behind_time.get(pid, 0) + self._pool.time
+			self._pool = None
+
+	def discard(self, keep_files=False):
+		"""Don't make a dataset from this writer. keep_files is for when
+		another dataset uses the files (see set_segments)."""
 		del _datasetwriters[self.name]
-		from shutil import rmtree
-		rmtree(self.name)
+		if not keep_files:
+			from shutil import rmtree
+			rmtree(self.name)
 
 	def set_lines(self, sliceno, count):
 		assert self.meta_only, "Don't try to set lines for writers that actually write"
@@ -1042,6 +3231,40 @@ class DatasetWriter(object):
 		assert self.meta_only, "Don't try to set minmax for writers that actually write"
 		self._minmax[sliceno] = minmax
 
+	def set_dictionary(self, sliceno, colname, values):
+		"""For meta_only writers with "dict:type" columns, where you wrote
+		int32 codes to the column file. values is [value, ...] by code."""
+		assert self.meta_only, "Don't try to set dictionaries for writers that actually write"
+		assert self.columns[colname][0].startswith('dict:'), "Column %s is not dictionary encoded" % (colname,)
+		self._dictionaries.setdefault(sliceno, {})[colname] = list(values)
+
+	def set_segments(self, sliceno, colname, segments):
+		"""For meta_only writers: use [(filename, offset, count), ...] as
+		the data for colname in slice sliceno instead of writing a file.
+		The files must be in this job (e.g. from column_filename on other
+		writers) and are read in order, count values from offset in each.
+		This lets you combine files into a dataset without copying them."""
+		assert self.meta_only, "Don't try to set segments for writers that actually write"
+		assert colname in self.columns, "Unknown column %s" % (colname,)
+		self._segments.setdefault(sliceno, {})[colname] = [(uni(fn), offset, count,) for fn, offset, count in segments]
+
+	def _make_containers(self):
+		"""Put all columns (except segmented ones) of each slice in one
+		file, slices in parallel. Gives the containers for Dataset.new."""
+		from g import SLICES
+		names = sorted(n for n in self.columns if not any(n in s for s in self._segments.values()))
+		if not names:
+			return {}
+		todo = [(_container_name(self.name, sliceno), [(n, self.column_filename(n, sliceno)) for n in names]) for sliceno in range(SLICES)]
+		from multiprocessing.pool import ThreadPool
+		pool = ThreadPool(min(SLICES, 8))
+		try:
+			res = pool.map(_make_container, todo)
+		finally:
+			pool.close()
+			pool.join()
+		return dict(enumerate(res))
+
 	def finish(self):
 		"""Normally you don't need to call this, but if you want to
 		pass yourself as a dataset to a subjob you need to call
@@ -1050,6 +3273,7 @@ class DatasetWriter(object):
 		assert running == self._running or running == 'synthesis', "Finish where you started or in synthesis"
 		self.close()
 		assert len(self._lens) == SLICES, "Not all slices written, missing %r" % (set(range(SLICES)) - set(self._lens),)
+		containers = self._make_containers() if self.container else {}
 		args = dict(
 			columns={k: v[0].split(':')[-1] for k, v in self.columns.items()},
 			filenames=self._clean_names,
@@ -1060,6 +3284,12 @@ class DatasetWriter(object):
 			caption=self.caption,
 			previous=self.previous,
 			name=self.name,
+			blocks=self._blocks,
+			compression=self._compression,
+			dictionaries=self._dictionaries,
+			segments=self._segments,
+			stats=self._stats,
+			containers=containers,
 		)
 		if self.parent:
 			res = Dataset(self.parent)
@@ -1068,23 +3298,66 @@ class DatasetWriter(object):
 		else:
 			res = Dataset.new(**args)
 		del _datasetwriters[self.name]
+		if self._write_behind_time:
+			write_behind_stats[self.name] = sum(self._write_behind_time.values())
 		return res
 
 def range_check_function(bottom, top):
-	"""Returns a function that checks if bottom <= arg < top, allowing bottom and/or top to be None"""
+	"""Returns a function that checks if bottom <= arg < top, allowing bottom and/or top to be None
+	(Using this as a filter lets iteration skip blocks, see _filter_keep_block.)"""
 	import operator
 	if top is None:
 		if bottom is None:
 			# Can't currently happen (checked before calling this), but let's do something reasonable
-			return lambda _: True
+			range_f = lambda _: True
 		else:
-			return partial(operator.le, bottom)
+			range_f = partial(operator.le, bottom)
 	elif bottom is None:
-		return partial(operator.gt, top)
+		range_f = partial(operator.gt, top)
 	else:
 		def range_f(v):
 			return v >= bottom and v < top
-		return range_f
+	range_f._range = (bottom, top,)
+	return range_f
+
+def _filter_keep_block(f):
+	"""If filter f is one we can understand (value.__eq__, some_set.__contains__,
+	some_dict.get or from range_check_function) this returns a keep_block(min, max)
+	function for _block_rows. Otherwise None."""
+	from bisect import bisect_left
+	if hasattr(f, '_range'):
+		bottom, top = f._range
+		def keep_block(min_v, max_v):
+			if top is not None and min_v >= top:
+				return False
+			if bottom is not None and max_v < bottom:
+				return False
+			return True
+		return keep_block
+	name = getattr(f, '__name__', None)
+	obj = getattr(f, '__self__', None)
+	if obj is None:
+		return None
+	if name == '__eq__':
+		def keep_block(min_v, max_v):
+			try:
+				return min_v <= obj <= max_v
+			except TypeError:
+				return True
+		return keep_block
+	if (name == '__contains__' and isinstance(obj, (set, frozenset, dict))) or (name == 'get' and isinstance(obj, dict)):
+		try:
+			values = sorted(obj)
+		except TypeError:
+			return None
+		def keep_block(min_v, max_v):
+			try:
+				ix = bisect_left(values, min_v)
+				return ix < len(values) and values[ix] <= max_v
+			except TypeError:
+				return True
+		return keep_block
+	return None
 
 class SkipJob(Exception):
 	"""Raise this in pre_callback to skip iterating the coming job
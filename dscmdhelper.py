@@ -48,7 +48,7 @@ def name2ds(n):
 	if exists(n):
 		# it's a path - dig out parts, maybe update WORKSPACES
 		n = realpath(n)
-		if n.endswith("/dataset.pickle"):
+		if n.endswith(("/dataset.pickle", "/dataset.meta",)):
 			n = n.rsplit("/", 1)[0]
 		if exists(join(n, "dataset.pickle")):
 			# includes ds name
@@ -46,6 +46,17 @@ for n in sys.argv[1:]:
 			backing_type = c.backing_type
 		else:
 			backing_type = ""
+		if c.compression not in (None, "gzip"):
+			backing_type = (backing_type + " " + c.compression).strip()
+		if c.stats:
+			stats = []
+			if c.stats.size is not None:
+				stats.append("{0:n} bytes".format(c.stats.size))
+			if c.stats.nulls is not None:
+				stats.append("{0:n} None".format(c.stats.nulls))
+			if c.stats.distinct is not None:
+				stats.append("~{0:n} distinct".format(c.stats.distinct))
+			backing_type = "  ".join([backing_type] + stats).strip()
 		if n == ds.hashlabel:
 			print(template.format(n, c.type, backing_type, "\x1b[1m*", "\x1b[m"))
 		else:
@@ -53,6 +64,6 @@ for n in sys.argv[1:]:
 	print("{0:n} columns".format(len(ds.columns)))
 	print("{0:n} lines".format(sum(ds.lines)))
 	if ds.previous:
-		chain = ds.chain()
-		print("Chain length {0:n}, from {1} to {2}".format(len(chain), chain[0], chain[-1]))
-		print("{0:n} total lines".format(sum(sum(ds.lines) for ds in chain)))
+		chain = ds.chain_entries()
+		print("Chain length {0:n}, from {1} to {2}".format(len(chain), chain[0].id, chain[-1].id))
+		print("{0:n} total lines".format(sum(sum(e.lines) for e in chain)))
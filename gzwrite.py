@@ -20,11 +20,17 @@
 from __future__ import print_function
 from __future__ import division
 
+import os
+from functools import partial
+from time import time
+
 import gzutil
-from compat import str_types, PY3
+from compat import str_types, unicode, imap, PY3
 
 GzWrite = gzutil.GzWrite
 
+_nodefault = object()
+
 _convfuncs = {
 	'number'   : gzutil.GzWriteNumber,
 	'float64'  : gzutil.GzWriteFloat64,
@@ -53,6 +59,25 @@ _convfuncs = {
 	'_v2_unicode'  : gzutil.GzWriteUnicodeLines,
 }
 
+# How column files can be compressed, as the mode to give the writer
+# (or None for the default). These are all zlib modes, so the normal
+# readers handle them all. ("T" is uncompressed, which zlib reads
+# transparently.)
+compressions = {
+	'gzip': None,
+	'none': 'wT',
+}
+for _level in range(1, 10):
+	compressions['gzip-%d' % (_level,)] = 'wb%d' % (_level,)
+del _level
+
+def compression_kw(compression):
+	"""The extra arguments a writer needs for this compression."""
+	if compression not in compressions:
+		raise ValueError("Unknown compression %r (use one of %s)" % (compression, ', '.join(sorted(compressions)),))
+	mode = compressions[compression]
+	return {'mode': mode} if mode else {}
+
 def typed_writer(typename):
 	if typename not in _convfuncs:
 		raise ValueError("Unknown writer for type %s" % (typename,))
@@ -94,3 +119,501 @@ class GzWriteParsedJson(GzWriteJson):
 		self.count += 1
 		self.fh.write(dumps(o, ensure_ascii=False))
 _convfuncs['parsed:json'] = GzWriteParsedJson
+
+class GzWriteBlocked(object):
+	"""Wraps a typed writer so that every block_size values are written
+	as a separate gzip member. The result is a normal column file (the
+	readers don't care about member boundaries), but each block can also
+	be read on its own by seeking to its offset and reading count values.
+
+	Each block is written by a new writer appending to the file.
+
+	.blocks is [(offset, count, min, max), ...] (complete after close).
+	"""
+	def __init__(self, writer, name, block_size, **kw):
+		assert block_size > 0, "block_size must be positive"
+		self._writer = writer
+		self._kw = dict(kw)
+		# Append mode (with the same compression), so each block is a new member.
+		self._kw['mode'] = 'a' + kw.get('mode', 'wb')[1:]
+		self.name = name
+		self.block_size = block_size
+		self.blocks = []
+		self._count = 0
+		self._min = self._max = None
+		self._offset = 0
+		self._closed = False
+		open(name, 'wb').close()
+		self._new_block()
+		if hasattr(writer, 'hash'):
+			self.hash = writer.hash
+		if 'hashfilter' in kw:
+			self.hashcheck = self._hashcheck
+
+	def _new_block(self):
+		self._w = self._writer(self.name, **self._kw)
+		self._write = self._w.write
+
+	def _finish_block(self):
+		w = self._w
+		count, self._min, self._max = self.count, self.min, self.max
+		w.close()
+		self._w = None
+		if w.count:
+			self.blocks.append((self._offset, w.count, w.min, w.max,))
+		self._count = count
+		self._offset = os.path.getsize(self.name)
+
+	def _hashcheck(self, value):
+		# The current writer, the earlier ones are closed.
+		return self._w.hashcheck(value)
+
+	@property
+	def count(self):
+		if self._w:
+			return self._count + self._w.count
+		return self._count
+
+	def _current(self, name, pick):
+		a = getattr(self, name)
+		b = getattr(self._w, name[1:]) if self._w else None
+		if a is None:
+			return b
+		if b is None:
+			return a
+		return pick(a, b)
+
+	@property
+	def min(self):
+		return self._current('_min', min)
+
+	@property
+	def max(self):
+		return self._current('_max', max)
+
+	def write(self, value):
+		res = self._write(value)
+		if self._w.count == self.block_size:
+			self._finish_block()
+			self._new_block()
+		return res
+
+	def close(self):
+		if not self._closed:
+			self._finish_block()
+			self._closed = True
+	def __enter__(self):
+		return self
+	def __exit__(self, type, value, traceback):
+		self.close()
+
+class WriteBehindPool(object):
+	"""Processes that do the actual writing (and so compressing) for
+	GzWriteBehind writers. (Processes and not threads since the writers
+	don't release the GIL.) Each writer is always handled by the same
+	process, so its batches are written in order. The values are pickled
+	to the processes.
+
+	Each process has at most queue_size batches waiting, after that
+	submitting blocks until the process catches up. .time is the total
+	time spent writing (summed over the processes, known after .close).
+	"""
+	def __init__(self, processes, queue_size=2):
+		from multiprocessing import Process, Pipe
+		assert processes > 0, "Need at least one process"
+		assert queue_size > 0, "queue_size must be positive"
+		self.queue_size = queue_size
+		self.time = 0.0
+		self._conns = []
+		self._procs = []
+		self._outstanding = [0] * processes
+		self._errors = {}
+		self._next_id = 0
+		for ix in range(processes):
+			conn, child_conn = Pipe()
+			p = Process(target=_write_behind_worker, args=(child_conn,), name='write_behind-%d' % (ix,))
+			p.daemon = True
+			p.start()
+			child_conn.close()
+			self._conns.append(conn)
+			self._procs.append(p)
+
+	def new_writer(self):
+		"""(process, id) for a new writer."""
+		wid = self._next_id
+		self._next_id += 1
+		return wid % len(self._procs), wid
+
+	def _recv(self, process):
+		try:
+			wid, error, res = self._conns[process].recv()
+		except EOFError:
+			raise Exception("A write_behind process died")
+		self._outstanding[process] -= 1
+		if error is not None and wid not in self._errors:
+			self._errors[wid] = error
+		return res
+
+	def send(self, process, op, wid, arg=None):
+		while self._outstanding[process] >= self.queue_size:
+			self._recv(process)
+		self._conns[process].send((op, wid, arg,))
+		self._outstanding[process] += 1
+
+	def call(self, process, op, wid, arg=None):
+		"""Like send, but waits for (and returns) the result."""
+		self.send(process, op, wid, arg)
+		while self._outstanding[process] > 1:
+			self._recv(process)
+		return self._recv(process)
+
+	def error(self, wid):
+		"""The first error from writer wid, or None."""
+		return self._errors.get(wid)
+
+	def close(self):
+		if self._procs:
+			for process in range(len(self._procs)):
+				self.time += self.call(process, 'exit', None)
+			for conn in self._conns:
+				conn.close()
+			for p in self._procs:
+				p.join()
+			self._procs = []
+
+def _write_behind_worker(conn):
+	"""Runs the writers for a WriteBehindPool. Every message gets a reply,
+	(writer id, error or None, result)."""
+	from signal import signal, SIGTERM, SIG_DFL
+	signal(SIGTERM, SIG_DFL)
+	writers = {}
+	failed = set()
+	total = 0.0
+	while True:
+		op, wid, arg = conn.recv()
+		if op == 'exit':
+			conn.send((None, None, total,))
+			conn.close()
+			return
+		t = time()
+		error = res = None
+		try:
+			if op == 'getattr':
+				w = writers[wid]
+				res = (hasattr(w, arg), getattr(w, arg, None),)
+			elif wid in failed:
+				pass # The error has already been reported.
+			elif op == 'open':
+				writer, name, kw = arg
+				writers[wid] = writer(name, **kw)
+			elif op == 'write':
+				write = writers[wid].write
+				for v in arg:
+					write(v)
+			elif op == 'close':
+				writers[wid].close()
+		except Exception as e:
+			failed.add(wid)
+			error = e
+		total += time() - t
+		try:
+			conn.send((wid, error, res,))
+		except Exception:
+			# Probably not picklable
+			from traceback import format_exc
+			conn.send((wid, Exception(format_exc()), None,))
+
+# HyperLogLog sketches for approximate distinct counts (see GzWriteStats).
+# 2**HLL_P one byte registers, for about 1.6% standard error.
+HLL_P = 12
+
+def hll_merge(a, b):
+	"""The sketch of everything in sketch a and sketch b."""
+	return bytearray(imap(max, bytearray(a), bytearray(b)))
+
+def hll_estimate(sketch):
+	"""Approximate number of distinct values added to sketch."""
+	from math import log
+	m = len(sketch)
+	alpha = 0.7213 / (1 + 1.079 / m)
+	estimate = alpha * m * m / sum(2.0 ** -r for r in sketch)
+	zeros = sketch.count(b'\0')
+	if zeros and estimate <= 2.5 * m:
+		estimate = m * log(m / zeros)
+	return int(round(estimate))
+
+class GzWriteStats(object):
+	"""Wraps a typed writer, counting None values (.nulls) and keeping
+	a HyperLogLog sketch (.sketch, see hll_estimate) of the other values.
+	The sketch uses the hash of the writer, so it is None for types that
+	can't be hashed (json).
+	"""
+	def __init__(self, writer, name, **kw):
+		self._w = writer(name, **kw)
+		self._write = self._w.write
+		self._hash = getattr(self._w, 'hash', None)
+		if self._hash:
+			self.hash = self._hash
+			self.sketch = bytearray(1 << HLL_P)
+		else:
+			self.sketch = None
+		self.name = name
+		self.nulls = 0
+
+	def write(self, v):
+		res = self._write(v)
+		if res is not False: # False is from a hashfilter
+			if v is None:
+				self.nulls += 1
+			elif self._hash:
+				try:
+					h = self._hash(v)
+				except (ValueError, TypeError, OverflowError):
+					# Probably a bad value that the writer defaulted
+					return res
+				# The writer hashes are for slicing, mix them well
+				# enough for the sketch too (murmur3 fmix64).
+				h &= 0xffffffffffffffff
+				h ^= h >> 33
+				h = (h * 0xff51afd7ed558ccd) & 0xffffffffffffffff
+				h ^= h >> 33
+				h = (h * 0xc4ceb9fe1a85ec53) & 0xffffffffffffffff
+				h ^= h >> 33
+				ix = h & ((1 << HLL_P) - 1)
+				h >>= HLL_P
+				rank = (h & -h).bit_length() if h else 64 - HLL_P
+				if rank > self.sketch[ix]:
+					self.sketch[ix] = rank
+		return res
+
+	@property
+	def count(self):
+		return self._w.count
+
+	@property
+	def min(self):
+		return self._w.min
+
+	@property
+	def max(self):
+		return self._w.max
+
+	def __getattr__(self, name):
+		# Things like .blocks, .values and .hashcheck from the wrapped writer
+		if name.startswith('_'):
+			raise AttributeError(name)
+		return getattr(self._w, name)
+
+	def close(self):
+		self._w.close()
+	def __enter__(self):
+		return self
+	def __exit__(self, type, value, traceback):
+		self.close()
+
+def _writer_hash(writer):
+	"""The hash function of a writer (class, or partial of one as used
+	by DatasetWriter) without making one. None if it can't hash."""
+	while isinstance(writer, partial):
+		if writer.func is GzWriteDict:
+			writer = _convfuncs[writer.args[0]]
+		elif writer.func in (GzWriteBlocked, GzWriteStats,):
+			writer = writer.args[0]
+		else:
+			writer = writer.func
+	return getattr(writer, 'hash', None)
+
+class GzWriteBehind(object):
+	"""Wraps a typed writer so that values are only collected in .write,
+	and written in batch_size batches by a process in pool (a
+	WriteBehindPool). This moves compression away from the process that
+	produces the values.
+
+	Errors (e.g. a value of the wrong type) are raised from a later call
+	to .write or from .close, not from the .write with the bad value.
+	(So this can't be used for writers with a hashfilter, those have to
+	answer when the value is written.)
+	"""
+	def __init__(self, writer, name, pool, batch_size=4096, **kw):
+		assert 'hashfilter' not in kw, "GzWriteBehind can't filter"
+		assert batch_size > 0, "batch_size must be positive"
+		self._pool = pool
+		self._process, self._id = pool.new_writer()
+		self._closed = False
+		self._send('open', (writer, name, kw,))
+		h = _writer_hash(writer)
+		if h:
+			self.hash = h
+		self.name = name
+		self.batch_size = batch_size
+		self._buf = []
+		self._count = 0
+
+	def _check(self):
+		error = self._pool.error(self._id)
+		if error is not None:
+			raise error
+
+	def _send(self, op, arg=None):
+		self._check()
+		self._pool.send(self._process, op, self._id, arg)
+
+	def _call(self, op, arg=None):
+		self._check()
+		res = self._pool.call(self._process, op, self._id, arg)
+		self._check()
+		return res
+
+	def _flush(self):
+		if self._buf:
+			self._send('write', self._buf)
+			self._buf = []
+
+	def write(self, value):
+		self._buf.append(value)
+		self._count += 1
+		if len(self._buf) == self.batch_size:
+			self._flush()
+		return True
+
+	@property
+	def count(self):
+		return self._count
+
+	def _getattr(self, name):
+		self._flush()
+		found, value = self._call('getattr', name)
+		if not found:
+			raise AttributeError(name)
+		return value
+
+	@property
+	def min(self):
+		return self._getattr('min')
+
+	@property
+	def max(self):
+		return self._getattr('max')
+
+	def __getattr__(self, name):
+		# Things like .blocks and .values from the wrapped writer
+		if name.startswith('_'):
+			raise AttributeError(name)
+		return self._getattr(name)
+
+	def close(self):
+		if not self._closed:
+			self._flush()
+			self._closed = True
+			self._call('close')
+	def __enter__(self):
+		return self
+	def __exit__(self, type, value, traceback):
+		self.close()
+
+def _dict_check_unicode(v):
+	if not isinstance(v, unicode):
+		raise ValueError("Not unicode: %r" % (v,))
+	return v
+
+def _dict_check_ascii(v):
+	if not isinstance(v, str_types):
+		raise ValueError("Not ascii: %r" % (v,))
+	if isinstance(v, unicode):
+		v.encode('ascii')
+	else:
+		v.decode('ascii')
+	return str(v)
+
+def _dict_check_bytes(v):
+	if not isinstance(v, bytes):
+		raise ValueError("Not bytes: %r" % (v,))
+	return v
+
+class GzWriteDict(object):
+	"""Dictionary encodes values of valuetype (bytes, ascii or unicode).
+	Each new value gets the next integer code, and the codes are written
+	as an int32 column. .values is the dictionary (code -> value).
+
+	With block_size the codes are written with GzWriteBlocked, and .blocks
+	has the min and max of the values (not the codes) in each block.
+	"""
+	def __init__(self, valuetype, name, default=_nodefault, hashfilter=None, block_size=None, **kw):
+		self._check = _dict_checks[valuetype]
+		self.hash = _convfuncs[valuetype].hash
+		if block_size:
+			self._w = GzWriteBlocked(gzutil.GzWriteInt32, name, block_size, **kw)
+		else:
+			self._w = gzutil.GzWriteInt32(name, **kw)
+		self._write = self._w.write
+		self.name = name
+		self.default = default
+		self.block_size = block_size
+		self.hashfilter = hashfilter
+		self.values = []
+		self._codes = {}
+		self.min = self.max = None
+		self._block_minmax = []
+		self._bmin = self._bmax = None
+
+	def hashcheck(self, v):
+		return self.hash(v) % self.hashfilter[1] == self.hashfilter[0]
+
+	@property
+	def count(self):
+		return self._w.count if self._w else self._count
+
+	def write(self, v):
+		if self.hashfilter and not self.hashcheck(v):
+			return False
+		if v is not None:
+			try:
+				v = self._check(v)
+			except (ValueError, UnicodeError):
+				if self.default is _nodefault:
+					raise
+				v = self.default
+		code = self._codes.get(v)
+		if code is None:
+			code = self._codes[v] = len(self.values)
+			self.values.append(v)
+		self._write(code)
+		if v is not None:
+			if self.min is None or v < self.min:
+				self.min = v
+			if self.max is None or v > self.max:
+				self.max = v
+			if self._bmin is None or v < self._bmin:
+				self._bmin = v
+			if self._bmax is None or v > self._bmax:
+				self._bmax = v
+		if self.block_size and self._w.count % self.block_size == 0:
+			self._end_block()
+		return True
+
+	def _end_block(self):
+		self._block_minmax.append((self._bmin, self._bmax,))
+		self._bmin = self._bmax = None
+
+	def close(self):
+		if self._w:
+			if self.block_size and self._w.count % self.block_size:
+				self._end_block()
+			self._w.close()
+			if self.block_size:
+				self.blocks = [(offset, count, bmin, bmax) for (offset, count, _, _), (bmin, bmax) in zip(self._w.blocks, self._block_minmax)]
+			self._count = self._w.count
+			self._w = None
+	def __enter__(self):
+		return self
+	def __exit__(self, type, value, traceback):
+		self.close()
+
+_dict_checks = {
+	'unicode': _dict_check_unicode,
+	'ascii'  : _dict_check_ascii,
+	'bytes'  : _dict_check_bytes,
+}
+for _valuetype in _dict_checks:
+	_convfuncs['dict:' + _valuetype] = partial(GzWriteDict, _valuetype)
+del _valuetype
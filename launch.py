@@ -93,18 +93,16 @@ def call_analysis(analysis_func, sliceno_, q, preserve_result, parent_pid, **kw)
 					blob.save(False, "Analysis.tuple", temp=True)
 				save(res, "Analysis.")
 		from extras import saved_files
-		dw_lens = {}
-		dw_minmax = {}
+		dw_state = {}
 		for name, dw in dataset._datasetwriters.items():
 			if dw._for_single_slice in (None, sliceno_,):
 				dw.close()
-				dw_lens[name] = dw._lens
-				dw_minmax[name] = dw._minmax
+				dw_state[name] = dw._slice_state()
 		status._end()
-		q.put((sliceno_, time(), saved_files, dw_lens, dw_minmax, None,))
+		q.put((sliceno_, time(), saved_files, dw_state, None,))
 	except:
 		status._end()
-		q.put((sliceno_, time(), {}, {}, {}, fmt_tb(1),))
+		q.put((sliceno_, time(), {}, {}, fmt_tb(1),))
 		print_exc()
 		sleep(5) # give launcher time to report error (and kill us)
 		exitfunction()
@@ -136,7 +134,7 @@ def fork_analysis(slices, analysis_func, kw, preserve_result):
 		# No need to handle that very quickly though, 10 seconds is fine.
 		# (Typically this is caused by running out of memory.)
 		try:
-			s_no, s_t, s_temp_files, s_dw_lens, s_dw_minmax, s_tb = q.get(timeout=10)
+			s_no, s_t, s_temp_files, s_dw_state, s_tb = q.get(timeout=10)
 		except QueueEmpty:
 			if not children:
 				# No children left, so they must have all sent their messages.
@@ -152,10 +150,8 @@ def fork_analysis(slices, analysis_func, kw, preserve_result):
 			exitfunction()
 		per_slice.append((s_no, s_t))
 		temp_files.update(s_temp_files)
-		for name, lens in s_dw_lens.items():
-			dataset._datasetwriters[name]._lens.update(lens)
-		for name, minmax in s_dw_minmax.items():
-			dataset._datasetwriters[name]._minmax.update(minmax)
+		for name, state in s_dw_state.items():
+			dataset._datasetwriters[name]._merge_slice_state(state)
 	g.update_top_status("Waiting for all slices to finish cleanup")
 	for p in children:
 		p.join()
@@ -305,6 +301,9 @@ def execute_process(workdir, jobid, slices, result_directory, common_directory,
 					dataset._datasetwriters[name].finish()
 	t = time() - t
 	prof['synthesis'] = t
+	if dataset.write_behind_stats:
+		# Not a number, so it is not counted in the total (it overlaps the other times).
+		prof['write_behind'] = dict(dataset.write_behind_stats)
 
 	from subjobs import _record
 	status._end()
@@ -23,7 +23,7 @@ description = r'''
 Rewrite a dataset (or chain to previous) with new hashlabel.
 '''
 
-from shutil import copyfileobj
+from itertools import islice
 
 from extras import OptionString, job_params
 from dataset import DatasetWriter
@@ -80,14 +80,18 @@ def analysis(sliceno, prepare_res):
 		stop_ds=prev_source,
 		length=options.length,
 	)
-	write = dws[sliceno].get_split_write_list()
-	for values in it:
-		write(values)
+	write = dws[sliceno].get_split_write_rows()
+	while True:
+		rows = list(islice(it, 65536))
+		if not rows:
+			break
+		write(rows)
 
 def synthesis(prepare_res, params):
 	if not options.as_chain:
-		# If we don't want a chain we abuse our knowledge of dataset internals
-		# to avoid recompressing. Don't do this stuff yourself.
+		# If we don't want a chain we make one dataset that uses the
+		# files from all the per slice writers as segments, so nothing
+		# has to be copied or recompressed.
 		dws, names, prev_source, caption, filename = prepare_res
 		merged_dw = DatasetWriter(
 			caption=caption,
@@ -102,11 +106,6 @@ def synthesis(prepare_res, params):
 			for dwno, dw in enumerate(dws):
 				merged_dw.set_minmax((sliceno, dwno), dw._minmax[sliceno])
 			for n in names:
-				fn = merged_dw.column_filename(n, sliceno=sliceno)
-				with open(fn, "wb") as out_fh:
-					for dw in dws:
-						fn = dw.column_filename(n, sliceno=sliceno)
-						with open(fn, "rb") as in_fh:
-							copyfileobj(in_fh, out_fh)
+				merged_dw.set_segments(sliceno, n, [(dw.column_filename(n, sliceno=sliceno), 0, dw._lens[sliceno]) for dw in dws])
 		for dw in dws:
-			dw.discard()
+			dw.discard(keep_files=True)
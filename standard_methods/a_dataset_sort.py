@@ -27,17 +27,26 @@ You'll have to type the sort column(s) approprietly.
 
 None and NaN values will sort the same as the smallest/largest
 value possible in a comparable type.
+
+Normally all values in a slice (or the whole dataset with
+sort_across_slices) are kept in memory while sorting. Set memory_limit
+(in bytes, per process) to instead sort runs of about that size, write
+them to disk and merge them. With sort_across_slices the runs are made
+by one process per slice, and then merged in one process.
 '''
 
 from functools import partial
+from itertools import islice, chain
+from heapq import heapify, heappop, heapreplace
 import datetime
+import os
 from math import isnan
 
-from compat import PY2, izip
+from compat import PY2, izip, imap, pickle
 
 from extras import OptionEnum, OptionString
 from dataset import Dataset, DatasetWriter
-from status import status
+from status import status, dummy_status
 
 OrderEnum = OptionEnum('ascending descending')
 
@@ -45,11 +54,12 @@ options = {
 	'sort_columns'           : [OptionString],
 	'sort_order'             : OrderEnum.ascending,
 	'sort_across_slices'     : False, # normally only sort within slices
+	'memory_limit'           : 0, # bytes per process, 0 to sort in memory
 }
 datasets = ('source', 'previous',)
 
 equivalent_hashes = {
-	'ce570db13771cab84f48535c07100bb5fd2212c4': ('23453401ad533eb3bc9019319e7eac70934f9730',)
+	'59f6b53e6e4443e35572223efa75ea74e30e6ad6': ('23453401ad533eb3bc9019319e7eac70934f9730', 'd983270a526af47013208cb76d949d823c2dbcd5', 'fbedd7b1217f6ece34ba6616b84249f29df16564', '7711d9a14969025c5b1912eede757863642170d2', '1ab065f36ebbed439c760f006688cb3ab5c8d616',)
 }
 
 # These types don't need/can't use any special handling of None-values.
@@ -58,27 +68,37 @@ if PY2:
 	# These types sort None before everything else on py2.
 	nononehandling_types += ('bytes', 'ascii', 'unicode', 'int64', 'int32', 'bool',)
 
-def filter_unsortable(column, it):
+# What None becomes for types that don't sort None the way we want.
+# (Other types that need handling are floats, where None sorts first and
+# NaN last.)
+none_values = {
+	'bytes'   : b'',
+	'ascii'   : u'',
+	'unicode' : u'',
+	'int64'   : float('-inf'),
+	'int32'   : float('-inf'),
+	'bool'    : -1,
+	'datetime': datetime.datetime.max,
+	'date'    : datetime.date.max,
+	'time'    : datetime.time.max,
+}
+
+def unsortable_fixer(column):
+	"""A function replacing unsortable values (None and NaN) with
+	sortable ones, or None if column doesn't need that."""
 	coltype = datasets.source.columns[column].type
-	if coltype == 'bytes':
-		nonev = b''
-	elif coltype in ('ascii', 'unicode',):
-		nonev = u''
-	elif coltype in ('int64', 'int32',):
-		nonev = float('-inf')
-	elif coltype == 'bool':
-		nonev = -1
-	elif coltype == 'datetime':
-		nonev = datetime.datetime.max
-	elif coltype == 'date':
-		nonev = datetime.date.max
-	elif coltype == 'time':
-		nonev = datetime.time.max
-	else:
-		nanv = float('inf')
-		nonev = float('-inf')
-		return (nonev if v is None else nanv if isnan(v) else v for v in it)
-	return (nonev if v is None else v for v in it)
+	if coltype in nononehandling_types:
+		return None
+	if coltype in none_values:
+		nonev = none_values[coltype]
+		return lambda v: nonev if v is None else v
+	nanv = float('inf')
+	nonev = float('-inf')
+	return lambda v: nonev if v is None else nanv if isnan(v) else v
+
+def filter_unsortable(column, it):
+	fixer = unsortable_fixer(column)
+	return imap(fixer, it) if fixer else it
 
 def sort(columniter):
 	with status('Determining sort order'):
@@ -108,11 +128,169 @@ def sort(columniter):
 		with status('Creating sort list'):
 			return sorted(range(len(lst)), key=lst.__getitem__, reverse=reverse)
 
+# Rows are pickled this many at a time in the run files.
+RUN_BATCH = 256
+
+def row_key(columns):
+	"""A function giving the sort key (like in sort) for a row of columns."""
+	positions = [columns.index(column) for column in options.sort_columns]
+	fixers = [unsortable_fixer(column) or (lambda v: v) for column in options.sort_columns]
+	if len(positions) == 1:
+		pos, fix = positions[0], fixers[0]
+		return lambda row: fix(row[pos])
+	pairs = list(izip(fixers, positions))
+	return lambda row: tuple([fix(row[pos]) for fix, pos in pairs])
+
+def row_size(rows):
+	"""Approximate bytes of memory per row (in a list)."""
+	from sys import getsizeof
+	if not rows:
+		return 64
+	total = sum(getsizeof(row) + sum(getsizeof(v) for v in row) for row in rows)
+	# The list slot, and a key for each row while sorting.
+	return total / len(rows) * 1.5 + 16
+
+def write_run(fn, rows, batch):
+	it = iter(rows)
+	with open(fn, 'wb') as fh:
+		while True:
+			rows = list(islice(it, batch))
+			if not rows:
+				break
+			pickle.dump(rows, fh, 2)
+
+def read_run(fn):
+	with open(fn, 'rb') as fh:
+		while True:
+			try:
+				rows = pickle.load(fh)
+			except EOFError:
+				return
+			for row in rows:
+				yield row
+
+class _Reversed(object):
+	"""Sorts the other way, for descending merges."""
+	__slots__ = ('v',)
+	def __init__(self, v):
+		self.v = v
+	def __lt__(self, other):
+		return other.v < self.v
+	def __eq__(self, other):
+		return self.v == other.v
+
+def merge_runs(fns, key, reverse):
+	"""Merge the (sorted) runs in fns. Equal rows come in the order of
+	fns, so this is stable when the runs are in input order."""
+	wrap = _Reversed if reverse else lambda v: v
+	its = [read_run(fn) for fn in fns]
+	heap = []
+	for run_no, it in enumerate(its):
+		for row in it:
+			heap.append((wrap(key(row)), run_no, row,))
+			break
+	heapify(heap)
+	while heap:
+		_, run_no, row = heap[0]
+		yield row
+		for row in its[run_no]:
+			heapreplace(heap, (wrap(key(row)), run_no, row,))
+			break
+		else:
+			heappop(heap)
+
+def run_params(first, memory_limit):
+	"""(run_rows, batch, fan_in) for sorting rows like first using about
+	memory_limit bytes."""
+	run_rows = max(1, int(memory_limit // row_size(first)))
+	batch = min(RUN_BATCH, run_rows)
+	# Each run being merged has a batch in memory.
+	fan_in = max(2, run_rows // batch)
+	return run_rows, batch, fan_in
+
+def new_run_name(prefix, created):
+	fn = '%s.%d' % (prefix, len(created),)
+	created.append(fn)
+	return fn
+
+def write_runs(chunk, it, key, reverse, run_rows, batch, new_name, status=status):
+	"""Sort chunk, and then every run_rows rows from it, writing each as
+	a run. Returns the names of the runs (in input order)."""
+	runs = []
+	while chunk:
+		with status('Sorting run %d' % (len(runs) + 1,)):
+			chunk.sort(key=key, reverse=reverse)
+		fn = new_name()
+		with status('Writing run %d' % (len(runs) + 1,)):
+			write_run(fn, chunk, batch)
+		runs.append(fn)
+		chunk = list(islice(it, run_rows))
+	return runs
+
+def merge_down(runs, key, reverse, fan_in, batch, new_name):
+	"""Merge groups of fan_in runs until there are at most fan_in runs.
+	Groups are consecutive, so this stays stable."""
+	while len(runs) > fan_in:
+		with status('Merging %d runs' % (len(runs),)):
+			merged = []
+			for ix in range(0, len(runs), fan_in):
+				group = runs[ix:ix + fan_in]
+				fn = new_name()
+				write_run(fn, merge_runs(group, key, reverse), batch)
+				for old_fn in group:
+					os.unlink(old_fn)
+				merged.append(fn)
+			runs = merged
+	return runs
+
+def external_sort(rows, key, reverse, memory_limit, prefix):
+	"""Stable sort of rows (tuples) using about memory_limit bytes.
+	Sorted runs are written to prefix.N files which are then merged
+	(in several passes if there are too many runs to read from at once).
+	Returns an iterator of the sorted rows, which removes the files."""
+	it = iter(rows)
+	first = list(islice(it, 1000))
+	run_rows, batch, fan_in = run_params(first, memory_limit)
+	chunk = first + list(islice(it, max(0, run_rows - len(first)) + 1))
+	if len(chunk) <= run_rows:
+		# Everything fits, no need to use the disk.
+		chunk.sort(key=key, reverse=reverse)
+		return iter(chunk)
+	# Put back what didn't fit in the first run.
+	it = chain(chunk[run_rows:], it)
+	chunk = chunk[:run_rows]
+	created = []
+	new_name = partial(new_run_name, prefix, created)
+	try:
+		runs = write_runs(chunk, it, key, reverse, run_rows, batch, new_name)
+		runs = merge_down(runs, key, reverse, fan_in, batch, new_name)
+	except BaseException:
+		remove_runs(created)
+		raise
+	return _final_merge(runs, key, reverse, created)
+
+def remove_runs(fns):
+	for fn in fns:
+		try:
+			os.unlink(fn)
+		except OSError:
+			pass
+
+def _final_merge(runs, key, reverse, created):
+	try:
+		for row in merge_runs(runs, key, reverse):
+			yield row
+	finally:
+		remove_runs(created)
+
 def prepare(params):
 	d = datasets.source
 	ds_list = d.chain(stop_ds={datasets.previous: 'source'})
-	if options.sort_across_slices:
-		columniter = partial(Dataset.iterate_list, None, datasets=ds_list)
+	if options.sort_across_slices and options.memory_limit:
+		sort_idx = split_sorted(ds_list, params)
+	elif options.sort_across_slices:
+		# Read the slices in parallel, this is otherwise a long serial scan.
+		columniter = partial(Dataset.iterate_list, None, datasets=ds_list, parallel=params.slices)
 		sort_idx = sort(columniter)
 	else:
 		sort_idx = None
@@ -132,8 +310,95 @@ def prepare(params):
 	)
 	return dw, ds_list, sort_idx
 
+def sort_part(args):
+	"""Sort one slice of one dataset into runs, for split_sorted.
+	Runs in a pool process, so no status reporting."""
+	part, d, sliceno, columns = args
+	it = Dataset(d).iterate(sliceno, columns, status_reporting=False)
+	first = list(islice(it, 1000))
+	run_rows, batch, _ = run_params(first, options.memory_limit)
+	it = chain(first, it)
+	reverse = (options.sort_order == 'descending')
+	created = []
+	new_name = partial(new_run_name, 'sort.run.%d' % (part,), created)
+	try:
+		runs = write_runs(list(islice(it, run_rows)), it, row_key(columns), reverse, run_rows, batch, new_name, status=dummy_status)
+	except BaseException:
+		remove_runs(created)
+		raise
+	return runs, run_rows
+
+def split_sorted(ds_list, params):
+	"""Sort all rows (across slices) and write them to one file per
+	output slice, for analysis to read. Each slice of each dataset is
+	sorted into runs in parallel, and then the runs are merged here.
+	Runs are merged in input order, so this is stable."""
+	from safe_pool import Pool
+	columns = sorted(datasets.source.columns)
+	parts = [(d, sliceno,) for d in ds_list for sliceno in range(params.slices) if d.lines[sliceno]]
+	parts = [(part, d, sliceno, columns,) for part, (d, sliceno) in enumerate(parts)]
+	key = row_key(columns)
+	reverse = (options.sort_order == 'descending')
+	runs = []
+	run_rows = 1
+	if parts:
+		pool = Pool(min(len(parts), params.slices))
+		try:
+			with status('Sorting %d parts into runs' % (len(parts),)):
+				res = pool.map(sort_part, parts, chunksize=1)
+		except BaseException:
+			from glob import glob
+			remove_runs(glob('sort.run.*'))
+			raise
+		finally:
+			pool.close()
+			pool.join()
+		for part_runs, part_run_rows in res:
+			runs.extend(part_runs)
+		# Use the smallest run size, so the merge stays within memory_limit.
+		run_rows = min(part_run_rows for _, part_run_rows in res)
+	batch = min(RUN_BATCH, run_rows)
+	# Each run being merged has a batch in memory.
+	fan_in = max(2, run_rows // batch)
+	created = list(runs)
+	try:
+		runs = merge_down(runs, key, reverse, fan_in, batch, partial(new_run_name, 'sort.run.m', created))
+		it = merge_runs(runs, key, reverse)
+		total = sum(sum(d.lines) for d in ds_list)
+		per_slice = total // params.slices
+		fns = []
+		for sliceno in range(params.slices):
+			fn = 'sort.slice.%d' % (sliceno,)
+			with status('Writing slice %d' % (sliceno,)):
+				if sliceno + 1 == params.slices:
+					write_run(fn, it, RUN_BATCH)
+				else:
+					write_run(fn, islice(it, per_slice), RUN_BATCH)
+			fns.append(fn)
+	finally:
+		remove_runs(created)
+	return fns
+
+def write_rows(dw, columns, rows):
+	writers = [dw.writers[column].write for column in columns]
+	for row in rows:
+		for w, v in izip(writers, row):
+			w(v)
+
 def analysis(sliceno, params, prepare_res):
 	dw, ds_list, sort_idx = prepare_res
+	if options.memory_limit:
+		columns = sorted(datasets.source.columns)
+		if options.sort_across_slices:
+			fn = sort_idx[sliceno]
+			write_rows(dw, columns, read_run(fn))
+			os.unlink(fn)
+		else:
+			rows = Dataset.iterate_list(sliceno, columns, ds_list)
+			reverse = (options.sort_order == 'descending')
+			prefix = 'sort.run.%d' % (sliceno,)
+			write_rows(dw, columns, external_sort(rows, row_key(columns), reverse, options.memory_limit, prefix))
+		return
 	if options.sort_across_slices:
 		columniter = partial(Dataset.iterate_list, None, datasets=ds_list)
 		per_slice = len(sort_idx) // params.slices
@@ -28,7 +28,7 @@ from mmap import mmap, PROT_READ
 from compat import NoneType, unicode, imap, iteritems, itervalues, PY2
 
 from extras import OptionEnum, json_save, DotDict
-from gzwrite import typed_writer
+from gzwrite import typed_writer, GzWriteDict
 from dataset import DatasetWriter
 from report import report
 from . import dataset_typing
@@ -49,8 +49,19 @@ Convert one or more columns in a dataset from bytes/ascii/unicode to any type.
 #
 # If you need to preserve unconverted columns with filter_bad, specify them
 # as converted to bytes.
+#
+# Types that give bytes, ascii or unicode can be prefixed with "dict:"
+# (e.g. "dict:unicode:utf-8") to get a dictionary encoded column.
+
+byteslike_types = ('bytes', 'ascii', 'unicode',)
+
+def _dict_types():
+	for key in dataset_typing.convfuncs:
+		shorttype = key.split(':', 1)[0]
+		if dataset_typing.typerename.get(shorttype, shorttype) in byteslike_types:
+			yield 'dict:' + key
 
-TYPENAME = OptionEnum(dataset_typing.convfuncs.keys())
+TYPENAME = OptionEnum(list(dataset_typing.convfuncs.keys()) + list(_dict_types()))
 
 options = {
 	'column2type'               : {'COLNAME': TYPENAME},
@@ -65,11 +76,9 @@ options = {
 datasets = ('source', 'previous',)
 
 equivalent_hashes = {
-	'6693c50364efe831b9e445f080ba189daba7efde': ('91105dcfc1d399ac33d50ee1ab8197d675dbf3af', '9ec658f76813db0afba412297ae3277a0a3edfb3', '9bc49140b0c16dfd88e5c312d2a3225787c937f0', '56ee025d30cce4cc7a7bffd8bfde09702cec1aa6', '10065d3baeb571890001fd90a38d5ae06b162d0d', 'f9667a4809ae8f5140c7b7887966403849e32cad', '41ebc06a7e99e1e67b95ab6b798930aaf76e61a8',)
+	'dc9dd9157db82dfffc1aecb6700bcb06313854da': ('91105dcfc1d399ac33d50ee1ab8197d675dbf3af', '9ec658f76813db0afba412297ae3277a0a3edfb3', '9bc49140b0c16dfd88e5c312d2a3225787c937f0', '56ee025d30cce4cc7a7bffd8bfde09702cec1aa6', '10065d3baeb571890001fd90a38d5ae06b162d0d', 'f9667a4809ae8f5140c7b7887966403849e32cad', '41ebc06a7e99e1e67b95ab6b798930aaf76e61a8', '9aa96e43fe4cb1bb5c0733290d2942ea123cf652', '6bfdc8cea3214ff60d6e9f91827e69ee22d342a9', '914f2330b3a83b77df1348419fc2bbe16e08a320', '917479efbe08f56507f4a7295f024f068a99281d',)
 }
 
-byteslike_types = ('bytes', 'ascii', 'unicode',)
-
 ffi = cffi.FFI()
 convert_template = r'''
 %(proto)s
@@ -777,8 +786,12 @@ def prepare():
 	columns = {}
 	for colname, coltype in iteritems(options.column2type):
 		assert d.columns[colname].type in byteslike_types, colname
+		assert not d.columns[colname].dictionary, "Can't type dictionary encoded column " + colname
+		prefix = ''
+		if coltype.startswith('dict:'):
+			prefix, coltype = 'dict:', coltype[5:]
 		coltype = coltype.split(':', 1)[0]
-		columns[options.rename.get(colname, colname)] = dataset_typing.typerename.get(coltype, coltype)
+		columns[options.rename.get(colname, colname)] = prefix + dataset_typing.typerename.get(coltype, coltype)
 	if options.filter_bad or options.discard_untyped:
 		assert options.discard_untyped is not False, "Can't keep untyped when filtering bad"
 		parent = None
@@ -848,6 +861,12 @@ def analysis_lap(sliceno, badmap_fh, first_lap):
 	dw = DatasetWriter()
 	for colname, coltype in iteritems(options.column2type):
 		out_fn = dw.column_filename(options.rename.get(colname, colname))
+		dict_fn = None
+		if coltype.startswith('dict:'):
+			# Convert as usual to a temporary file, then encode that.
+			coltype = coltype[5:]
+			dict_fn = out_fn
+			out_fn = out_fn + '.plain'
 		fmt = fmt_b = None
 		if coltype in dataset_typing.convfuncs:
 			shorttype = coltype
@@ -889,13 +908,23 @@ def analysis_lap(sliceno, badmap_fh, first_lap):
 			backing_format = 2
 		else:
 			backing_format = 3
-		in_fn = d.column_filename(colname, sliceno)
-		if d.columns[colname].offsets:
-			offset = d.columns[colname].offsets[sliceno]
-			max_count = d.lines[sliceno]
+		segments = d.columns[colname].segments
+		offset = 0
+		max_count = -1
+		if segments:
+			if cfunc:
+				# The C code reads one file, so put the segments together first.
+				# (The python func uses _column_iterator, which reads segments.)
+				in_fn = out_fn + '.source'
+				backing_type = d.columns[colname].backing_type
+				with typed_writer(backing_type)(in_fn) as fh:
+					for v in d._column_iterator(sliceno, colname, _type=backing_type):
+						fh.write(v)
 		else:
-			offset = 0
-			max_count = -1
+			in_fn = d.column_filename(colname, sliceno)
+			if d.columns[colname].offsets:
+				offset = d.columns[colname].offsets[sliceno]
+				max_count = d.lines[sliceno]
 		if cfunc:
 			default_value = options.defaults.get(colname, ffi.NULL)
 			default_len = 0
@@ -913,6 +942,8 @@ def analysis_lap(sliceno, badmap_fh, first_lap):
 			c = getattr(backend, 'convert_column_' + cfunc)
 			res = c(*bytesargs(in_fn, out_fn, minmax_fn, default_value, default_len, default_value_is_None, fmt, fmt_b, record_bad, skip_bad, badmap_fd, badmap_size, bad_count, default_count, offset, max_count, backing_format))
 			assert not res, 'Failed to convert ' + colname
+			if segments:
+				unlink(in_fn)
 			res_bad_count[colname] = bad_count[0]
 			res_default_count[colname] = default_count[0]
 			coltype = coltype.split(':', 1)[0]
@@ -970,6 +1001,13 @@ def analysis_lap(sliceno, badmap_fh, first_lap):
 			res_bad_count[colname] = bad_count
 			res_default_count[colname] = default_count
 			res_minmax[colname] = [col_min, col_max]
+		if dict_fn:
+			real_coltype = dataset_typing.typerename.get(coltype, coltype)
+			with type2iter[real_coltype](out_fn) as in_fh, GzWriteDict(real_coltype, dict_fn) as out_fh:
+				for v in in_fh:
+					out_fh.write(v)
+			dw.set_dictionary(sliceno, options.rename.get(colname, colname), out_fh.values)
+			unlink(out_fn)
 	return res_bad_count, res_default_count, res_minmax, link_candidates
 
 def synthesis(params, analysis_res, prepare_res):
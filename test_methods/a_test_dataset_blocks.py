@@ -0,0 +1,217 @@
+############################################################################
+#                                                                          #
+# Copyright (c) 2019 Carl Drougge                                          #
+#                                                                          #
+# Licensed under the Apache License, Version 2.0 (the "License");          #
+# you may not use this file except in compliance with the License.         #
+# You may obtain a copy of the License at                                  #
+#                                                                          #
+#  http://www.apache.org/licenses/LICENSE-2.0                              #
+#                                                                          #
+# Unless required by applicable law or agreed to in writing, software      #
+# distributed under the License is distributed on an "AS IS" BASIS,        #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. #
+# See the License for the specific language governing permissions and      #
+# limitations under the License.                                           #
+#                                                                          #
+############################################################################
+
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+
+description = r'''
+Test DatasetWriter with block_size, and that range iteration
+over the block index gives the same result as without it.
+Also tests iterating parts of a slice (rows, split_slice and map_slice),
+random access (get_rows), sampling,
+rehashing using a rehash index, filters that can skip blocks,
+and uncompressed column buffers.
+'''
+
+import os
+from datetime import date, datetime, time
+
+from compat import PY3
+import dataset
+from dataset import Dataset, DatasetWriter, range_check_function
+
+def prepare():
+	dw_blocked = DatasetWriter(name="blocked", block_size=10)
+	dw_plain = DatasetWriter(name="plain")
+	for dw in (dw_blocked, dw_plain,):
+		dw.add("num", "int32")
+		dw.add("str", "ascii")
+	dw_fixed = DatasetWriter(name="fixed")
+	for typ in ("float64", "int64", "bool", "datetime", "date", "time"):
+		dw_fixed.add(typ, typ)
+	return dw_blocked, dw_plain, dw_fixed
+
+fixed_values = [
+	(0.5, 17, True, datetime(1970, 1, 2, 0, 0, 1, 5), date(1970, 1, 11), time(0, 0, 2, 7)),
+	(None, None, None, None, None, None),
+	(-1e100, -5, False, datetime(1969, 12, 31, 23, 59, 59), date(1969, 12, 31), time(23, 59, 59)),
+]
+fixed_raw = [
+	(0.5, 17, True, 86401000005, 10, 2000007),
+	(None, 0, False, -2 ** 63, -2 ** 63, -2 ** 63),
+	(-1e100, -5, False, -1000000, -1, 86399000000),
+]
+
+def analysis(sliceno, prepare_res):
+	for dw in prepare_res[:2]:
+		# A few complete blocks and one partial
+		for ix in range(sliceno * 1000, sliceno * 1000 + 95):
+			dw.write(ix, str(ix))
+	if sliceno == 1:
+		for values in fixed_values:
+			prepare_res[2].write(*values)
+
+def sum_num(it):
+	return sum(num for num, _ in it)
+
+def synthesis(params, prepare_res):
+	blocked, plain, fixed = (dw.finish() for dw in prepare_res)
+	assert blocked.columns["num"].blocks
+	assert not plain.columns["num"].blocks
+	for sliceno in range(params.slices):
+		for r in ((None, None), (sliceno * 1000 + 33, sliceno * 1000 + 57), (None, 5), (sliceno * 1000 + 90, None), (-10, -5)):
+			for columns in (None, "str", ["str", "num"]):
+				def get(ds, sloppy):
+					return list(Dataset.iterate_list(sliceno, columns, ds, range={"num": r}, sloppy_range=sloppy))
+				want = get(plain, False)
+				assert get(blocked, False) == want, "range %r gave different data from %s and %s" % (r, blocked, plain,)
+				# sloppy may give extra rows, but blocked should give no more than plain.
+				sloppy = get(blocked, True)
+				assert set(want) <= set(sloppy) <= set(get(plain, True)), "sloppy range %r gave bad data from %s" % (r, blocked,)
+		rows = [(3, 5), (12, 31), (90, 200)]
+		want = [sliceno * 1000 + ix for ix in list(range(3, 5)) + list(range(12, 31)) + list(range(90, 95))]
+		for ds in (blocked, plain):
+			got = list(ds._column_iterator(sliceno, "num", rows=rows))
+			assert got == want, "rows %r in %s gave %r" % (rows, ds, got,)
+		# Splitting a slice should give block aligned parts when possible
+		parts = blocked.split_slice(sliceno, 4)
+		assert parts == [(0, 20), (20, 50), (50, 70), (70, 95)], parts
+		assert plain.split_slice(sliceno, 4) == [(0, 23), (23, 47), (47, 71), (71, 95)]
+		assert plain.split_slice(sliceno, 200)[-1] == (94, 95)
+		for ds in (blocked, plain,):
+			whole = list(ds.iterate(sliceno))
+			assert whole == sum((list(ds.iterate(sliceno, rows=part)) for part in parts), [])
+			assert list(ds.iterate(sliceno, rows=rows)) == [(num, str(num)) for num in want]
+			assert list(ds.iterate(sliceno, "num", rows=(60, 70), filters={"num": lambda v: v % 2})) == [num for num in range(sliceno * 1000 + 60, sliceno * 1000 + 70) if num % 2]
+			assert ds.map_slice(sliceno, sum_num, ["num", "str"], parts=3) == [sum(v[0] for v in whole[a:b]) for a, b in ds.split_slice(sliceno, 3)]
+			indices = [94, 3, 4, 3, 57, 0, 10, 9, 11, 60]
+			assert ds.get_rows(sliceno, indices) == [whole[ix] for ix in indices]
+			assert ds.get_rows(sliceno, indices, "str") == [whole[ix][1] for ix in indices]
+			assert ds.get_rows(sliceno, []) == []
+			sample = ds.sample(sliceno, n=10, seed=sliceno)
+			assert len(sample) == 10 and sample == sorted(sample) and set(sample) <= set(whole)
+			assert sample == ds.sample(sliceno, n=10, seed=sliceno)
+			assert ds.sample(sliceno, fraction=0) == []
+			assert ds.sample(sliceno, fraction=1) == whole
+			assert ds.sample(sliceno, n=1000) == whole
+			sample = ds.sample(sliceno, fraction=0.4, seed=1, columns="num")
+			assert sample == ds.sample(sliceno, fraction=0.4, seed=1, columns="num")
+			assert set(sample) <= set(v[0] for v in whole)
+			try:
+				ds.get_rows(sliceno, [95])
+				raise Exception("get_rows allowed a row outside the slice")
+			except AssertionError:
+				pass
+		# n picks the same rows regardless of block index, fraction picks whole blocks.
+		assert blocked.sample(sliceno, n=7, seed=3) == plain.sample(sliceno, n=7, seed=3)
+		for num in blocked.sample(sliceno, fraction=0.3, seed=2, columns="num"):
+			assert num - num % 10 in blocked.sample(sliceno, fraction=0.3, seed=2, columns="num")
+		got = list(Dataset.iterate_list(sliceno, "num", blocked, range={"num": (sliceno * 1000 + 15, None)}, rows=[(0, 25), (40, 45)]))
+		assert got == list(range(sliceno * 1000 + 15, sliceno * 1000 + 25)) + list(range(sliceno * 1000 + 40, sliceno * 1000 + 45))
+	assert blocked.sample(None, n=10, seed=5) == plain.sample(None, n=10, seed=5)
+	assert len(blocked.sample(None, n=10, seed=5)) == 10
+	# Rehashing with an index should give the same result as without one.
+	want = [list(plain.iterate(sliceno, hashlabel="num", rehash=True)) for sliceno in range(params.slices)]
+	for ds in (blocked, plain,):
+		assert [list(ds.iterate(sliceno, hashlabel="num", rehash=True)) for sliceno in range(params.slices)] == want
+		ds.make_rehash_index("num")
+		assert ds._rehash_index("num") is not None
+		for sliceno in range(params.slices):
+			assert list(ds.iterate(sliceno, hashlabel="num", rehash=True)) == want[sliceno], "Rehashing %s with index is broken (slice %d)" % (ds, sliceno,)
+			assert list(ds.iterate(sliceno, "str", hashlabel="num", rehash=True)) == [s for num, s in want[sliceno]]
+			got = list(ds.iterate_list(sliceno, "str", ds, hashlabel="num", rehash=True, range={"num": (None, 1050)}))
+			assert got == [s for num, s in want[sliceno] if num < 1050]
+	# Filters that can use the block index, alone and combined with other
+	# filters, translators, range and rehashing.
+	for sliceno in range(params.slices):
+		base = sliceno * 1000
+		everything = list(plain.iterate(sliceno, ["num", "str"]))
+		rehashed = list(plain.iterate(sliceno, ["num", "str"], hashlabel="num", rehash=True))
+		for filters, check in (
+			({"num": {base + 17: True}.get}, lambda num, s: num == base + 17),
+			({"num": {base + 3, base + 77, 5000}.__contains__}, lambda num, s: num in (base + 3, base + 77)),
+			({"num": {base + 40: "x"}.get, "str": None}, lambda num, s: num == base + 40),
+			({"num": range_check_function(base + 25, base + 42)}, lambda num, s: base + 25 <= num < base + 42),
+			({"num": range_check_function(base + 25, None), "str": lambda s: s.endswith("3")}, lambda num, s: num >= base + 25 and s.endswith("3")),
+			({"str": lambda s: s.endswith("7")}, lambda num, s: s.endswith("7")),
+		):
+			want = [t for t in everything if check(*t)]
+			for ds in (blocked, plain,):
+				def get(columns="num str", **kw):
+					return list(ds.iterate_list(sliceno, columns.split(), ds, filters=filters, **kw))
+				assert get() == want, "%r on %s gave %r" % (filters, ds, get(),)
+				if list(filters) == ["num"]:
+					assert list(ds.iterate(sliceno, "num", filters=filters)) == [num for num, _ in want]
+				assert get("str num") == [(s, num) for num, s in want]
+				assert get(translators={"str": lambda s: s + "7"}) == [(num, s + "7") for num, s in everything if check(num, s + "7")]
+				assert get(range={"num": (base + 30, base + 80)}) == [(num, s) for num, s in want if base + 30 <= num < base + 80]
+				assert get(hashlabel="num", rehash=True) == [t for t in rehashed if check(*t)]
+				if list(filters) == ["str"]:
+					# range on a column we don't get
+					assert get("str", range={"num": (base + 30, base + 80)}) == [(s,) for num, s in want if base + 30 <= num < base + 80]
+					assert get("str", hashlabel="num", rehash=True, range={"num": (None, 1500)}) == [(s,) for num, s in rehashed if check(num, s) and num < 1500]
+	test_buffers(fixed)
+
+def raw_fn(ds, col, sliceno):
+	return dataset._buffer_name(ds, col, sliceno) + dataset._buffer_raw_ext
+
+def test_buffers(fixed):
+	assert fixed.column_buffer(0, "int64").tolist() == [] if PY3 else fixed.column_buffer(0, "int64") == b""
+	for ix, col in enumerate(("float64", "int64", "bool", "datetime", "date", "time")):
+		want = [raw[ix] for raw in fixed_raw]
+		buf = fixed.column_buffer(1, col)
+		assert os.path.exists(raw_fn(fixed, col, 1))
+		if PY3:
+			got = buf.tolist()
+			assert buf.readonly
+			if col == "float64":
+				assert got[1] != got[1] # NaN
+				got[1] = None
+			assert got == want, "%s: %r != %r" % (col, got, want,)
+		else:
+			assert len(buf) == 3 * (1 if col == "bool" else 8)
+		# Iterating uses the buffer (for some types), but should still give None.
+		assert list(fixed.iterate(1, col)) == [values[ix] for values in fixed_values]
+		try:
+			import numpy
+		except ImportError:
+			continue
+		a = fixed.column_array(1, col)
+		assert len(a) == 3 and not a.flags.writeable
+	try:
+		fixed.column_buffer(1, "nonexistant")
+		raise Exception("column_buffer on a missing column worked")
+	except AssertionError:
+		pass
+	# With no room only the newest cache file is kept, and files that
+	# are not caches are never removed.
+	others = [os.path.join(os.path.dirname(raw_fn(fixed, "date", 1)), name) for name in ("other.raw", "other.none",)]
+	for fn in others:
+		with open(fn, "wb") as fh:
+			fh.write(b"not a cache")
+	dataset.set_buffer_cache_size(0)
+	os.unlink(raw_fn(fixed, "float64", 1))
+	fixed.column_buffer(1, "float64")
+	assert not os.path.exists(raw_fn(fixed, "date", 1))
+	assert os.path.exists(raw_fn(fixed, "float64", 1))
+	for fn in others:
+		assert os.path.exists(fn), "Eviction removed " + fn
+		os.unlink(fn)
+	assert list(fixed.iterate(1, "float64")) == [values[0] for values in fixed_values]
+	dataset.set_buffer_cache_size(4 * 1024 * 1024 * 1024)
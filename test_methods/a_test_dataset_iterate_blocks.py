@@ -0,0 +1,129 @@
+############################################################################
+#                                                                          #
+# Copyright (c) 2019 Carl Drougge                                          #
+#                                                                          #
+# Licensed under the Apache License, Version 2.0 (the "License");          #
+# you may not use this file except in compliance with the License.         #
+# You may obtain a copy of the License at                                  #
+#                                                                          #
+#  http://www.apache.org/licenses/LICENSE-2.0                              #
+#                                                                          #
+# Unless required by applicable law or agreed to in writing, software      #
+# distributed under the License is distributed on an "AS IS" BASIS,        #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. #
+# See the License for the specific language governing permissions and      #
+# limitations under the License.                                           #
+#                                                                          #
+############################################################################
+
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+
+description = r'''
+Test that iterate_blocks (and iterate_chain_blocks, iterate_blocks_list)
+give the same values as iterate when flattened, for all slices and single
+slices, with range, rehashing and callbacks. Filters and translators are
+done on the arrays and compared to the same filters/translators in iterate.
+Does nothing if numpy is not available.
+'''
+
+from datetime import date
+from math import isnan
+
+from dataset import DatasetWriter
+
+columns = ["num", "int", "float", "bool", "date"]
+
+def prepare(params):
+	dws = []
+	previous = None
+	for name in ("first", "second",):
+		dw = DatasetWriter(name=name, previous=previous, block_size=5)
+		dw.add("num", "int32")
+		dw.add("int", "int64")
+		dw.add("float", "float64")
+		dw.add("bool", "bool")
+		dw.add("date", "date")
+		dws.append(dw)
+		previous = "%s/%s" % (params.jobid, name,)
+	return dws
+
+def analysis(sliceno, prepare_res):
+	for dsno, dw in enumerate(prepare_res):
+		for ix in range(23 + sliceno):
+			num = dsno * 10000 + sliceno * 100 + ix
+			if ix % 7 == 3:
+				dw.write(num, None, None, None, None)
+			else:
+				dw.write(num, ix, num / 4, bool(ix % 3), date(2000 + sliceno, 1, 1 + ix))
+
+def pyvalues(a):
+	"""Values in an array the way iterate gives them."""
+	values = a.tolist()
+	if a.dtype.kind == "f":
+		# iterate gives None for None, the arrays have NaN.
+		values = [None if isnan(v) else v for v in values]
+	return values
+
+def flatten(blocks, columns=columns, allow_empty=False):
+	rows = []
+	for block in blocks:
+		assert allow_empty or len(block[columns[0]]), "Got an empty block"
+		rows.extend(zip(*[pyvalues(block[n]) for n in columns]))
+	return rows
+
+def synthesis(params, prepare_res):
+	try:
+		import numpy
+	except ImportError:
+		print("No numpy, not testing iterate_blocks")
+		return
+	first, second = (dw.finish() for dw in prepare_res)
+	for sliceno in [None] + list(range(params.slices)):
+		want = list(second.iterate(sliceno, columns))
+		for block_size in (1, 4, 5, 1000,):
+			got = flatten(second.iterate_blocks(sliceno, columns, block_size=block_size))
+			assert got == want, "iterate_blocks(%r, block_size=%d) gave different values from iterate" % (sliceno, block_size,)
+		# Columns can be a tuple
+		assert flatten(second.iterate_blocks(sliceno, tuple(columns))) == list(second.iterate(sliceno, columns))
+		assert flatten(second.iterate_chain_blocks(sliceno, tuple(columns), prefetch=1)) == list(second.iterate_chain(sliceno, columns))
+		# Columns default to all columns
+		assert flatten(second.iterate_blocks(sliceno), sorted(second.columns)) == list(second.iterate(sliceno))
+		want = list(second.iterate_chain(sliceno, columns))
+		assert flatten(second.iterate_chain_blocks(sliceno, columns, block_size=4)) == want
+		assert flatten(second.iterate_blocks_list(sliceno, columns, [first, second], block_size=4)) == want
+		# range, also when it's not one of the columns
+		for r in ((None, None), (105, 10110), (None, 50), (10000, None), (-10, -5),):
+			for cols in (columns, ["float", "date"],):
+				want = list(second.iterate_chain(sliceno, cols, range={"num": r}))
+				got = flatten(second.iterate_chain_blocks(sliceno, cols, block_size=4, range={"num": r}), cols)
+				assert got == want, "range %r in slice %r gave different values" % (r, sliceno,)
+		assert list(second.iterate_chain_blocks(sliceno, range={"num": (-10, -5)})) == []
+		# Filters and translators on the arrays
+		want = list(second.iterate_chain(sliceno, columns, filters={"int": lambda v: v is not None and v % 2 == 0, "bool": None}))
+		got = []
+		for block in second.iterate_chain_blocks(sliceno, columns, block_size=4):
+			mask = numpy.ma.filled(block["bool"] & (block["int"] % 2 == 0), False)
+			got.extend(flatten([{n: a[mask] for n, a in block.items()}], allow_empty=True))
+		assert got == want, "Filtered arrays gave different values in slice %r" % (sliceno,)
+		want = list(second.iterate_chain(sliceno, "float", translators={"float": lambda v: None if v is None else v * 2}))
+		got = [v for block in second.iterate_chain_blocks(sliceno, "float") for v in pyvalues(block["float"] * 2)]
+		assert got == want, "Translated arrays gave different values in slice %r" % (sliceno,)
+		# Callbacks are called at the same points.
+		def record(calls, event):
+			def cb(d, sliceno):
+				calls.append((event, d.name, sliceno,))
+			return cb
+		def callbacks(iterate, **kw):
+			calls = []
+			for item in iterate(sliceno, columns, pre_callback=record(calls, "pre"), post_callback=record(calls, "post"), **kw):
+				calls.append("data")
+			return [c for ix, c in enumerate(calls) if c != "data" or calls[ix - 1] != "data"]
+		assert callbacks(second.iterate_chain_blocks, block_size=1000) == callbacks(second.iterate_chain)
+	# Rehashing
+	for sliceno in range(params.slices):
+		want = list(second.iterate_chain(sliceno, columns, hashlabel="num", rehash=True))
+		for block_size in (1, 4, 1000,):
+			got = flatten(second.iterate_chain_blocks(sliceno, columns, block_size=block_size, hashlabel="num", rehash=True))
+			assert got == want, "Rehashed iterate_chain_blocks gave different values in slice %d" % (sliceno,)
@@ -0,0 +1,114 @@
+############################################################################
+#                                                                          #
+# Copyright (c) 2019 Carl Drougge                                          #
+#                                                                          #
+# Licensed under the Apache License, Version 2.0 (the "License");          #
+# you may not use this file except in compliance with the License.         #
+# You may obtain a copy of the License at                                  #
+#                                                                          #
+#  http://www.apache.org/licenses/LICENSE-2.0                              #
+#                                                                          #
+# Unless required by applicable law or agreed to in writing, software      #
+# distributed under the License is distributed on an "AS IS" BASIS,        #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. #
+# See the License for the specific language governing permissions and      #
+# limitations under the License.                                           #
+#                                                                          #
+############################################################################
+
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+
+description = r'''
+Test that dataset.meta has the same data as dataset.pickle and that Dataset
+objects only load it when needed, with options.datasets links to one
+dataset with options.columns columns.
+
+With at least 1000 datasets (e.g. datasets=10000, columns=50) it also
+times loading both, which is too slow to do by default.
+'''
+
+from datetime import date
+from time import time
+
+import dataset
+import blob
+from dataset import Dataset, DatasetWriter
+from jobid import resolve_jobid_filename
+
+options = dict(datasets=20, columns=10)
+
+def load_pickle(fn):
+	return dataset._columntypefix(blob.load(fn))
+
+def load_meta(fn):
+	return dataset._meta_load(fn)
+
+def synthesis(params):
+	dw = DatasetWriter(name="source", hashlabel="num", block_size=10, stats=True)
+	types = ["int32", "ascii", "bytes", "date", "dict:unicode"]
+	for ix in range(options.columns):
+		dw.add("col %d" % (ix,), types[ix % len(types)])
+	dw.add("num", "number")
+	write = dw.get_split_write_dict()
+	for ix in range(100):
+		values = [ix, str(ix), str(ix).encode("ascii"), date(2000 + ix, 1, 1), "abc"[ix % 3]]
+		row = {"col %d" % (c,): values[c % len(types)] for c in range(options.columns)}
+		row["num"] = ix
+		write(row)
+	source = dw.finish()
+	assert options.datasets >= 2, "Need at least two links"
+	names = [source.name] + ["link %d" % (ix,) for ix in range(options.datasets)]
+	for name in names[1:]:
+		source.link_to_here(name)
+	names = [(params.jobid, name) for name in names]
+	def fn(name, ext):
+		return resolve_jobid_filename(params.jobid, "%s/dataset.%s" % (name[1], ext,))
+	# The meta has exactly what the pickle has, for new and linked datasets.
+	for name in names[:2]:
+		meta = load_meta(fn(name, "meta"))
+		pickle = load_pickle(fn(name, "pickle"))
+		assert isinstance(meta.columns, dataset._LazyColumns)
+		assert dict(meta.columns) == pickle.columns
+		assert dict(meta, columns=None) == dict(pickle, columns=None)
+		stats = meta.columns["col 0"].stats
+		assert isinstance(stats, dataset.ColumnStats) and stats.nulls == 0
+	assert Dataset(names[-1]).parent == "%s/source" % (params.jobid,)
+	# Copies don't affect each other (or what is cached)
+	a, b = Dataset(names[1]), Dataset(names[1])
+	del a.columns["num"]
+	assert "num" in b.columns and "num" in Dataset(names[1]).columns
+	assert sorted(b.columns) == sorted(source.columns)
+	# Nothing is loaded until it's needed, but missing datasets are still an error.
+	dataset._ds_cache.pop(names[2])
+	lazy = Dataset(names[2])
+	assert "_data" not in vars(lazy)
+	assert lazy.name == "link 1" and lazy == "%s/link 1" % (params.jobid,)
+	assert "_data" not in vars(lazy)
+	assert lazy.lines == source.lines and "_data" in vars(lazy)
+	try:
+		Dataset(params.jobid, "no such dataset")
+		raise Exception("Dataset accepted a dataset that doesn't exist")
+	except IOError:
+		pass
+	if options.datasets < 1000:
+		return
+	def bench(what, load, ext, use=None):
+		fns = [fn(name, ext) for name in names]
+		t0 = time()
+		for f in fns:
+			data = load(f)
+			if use:
+				use(data)
+		t = time() - t0
+		print("%-35s %8.3fs (%.1f us per dataset)" % (what, t, t * 1000000 / len(fns),))
+		return t
+	print("Loading %d datasets with %d columns:" % (len(names), len(source.columns),))
+	res = dict(
+		pickle=bench("dataset.pickle", load_pickle, "pickle"),
+		meta_header=bench("dataset.meta (lines and previous)", load_meta, "meta", lambda d: (d.lines, d.previous)),
+		meta_one=bench("dataset.meta (one column)", load_meta, "meta", lambda d: d.columns["num"]),
+		meta_all=bench("dataset.meta (all columns)", load_meta, "meta", lambda d: dict(d.columns.items())),
+	)
+	return res
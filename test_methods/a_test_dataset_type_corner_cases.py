@@ -327,10 +327,20 @@ def test_filter_bad_across_types():
 		add_want(data[6])
 		want.sort() # adding them out of order, int32_10 sorts correctly.
 
+def test_dict():
+	data = [b'foo', b'bar', b'foo', b' foo', b'bar']
+	want = {
+		'dict:unicode:utf-8': ['foo', 'bar', 'foo', ' foo', 'bar'],
+		'dict:ascii': ['foo', 'bar', 'foo', ' foo', 'bar'],
+		'dict:bytesstrip': [b'foo', b'bar', b'foo', b'foo', b'bar'],
+	}
+	verify('dict', list(want), data, want)
+
 def synthesis():
 	test_bytes()
 	test_ascii()
 	test_unicode()
+	test_dict()
 	test_numbers()
 	test_datetimes()
 
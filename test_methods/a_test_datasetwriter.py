@@ -22,7 +22,10 @@ from __future__ import unicode_literals
 
 description = r'''
 Test DatasetWriter, exercising the different ways to create,
-pass and populate the dataset.
+pass and populate the dataset, per column compression,
+dictionary encoded columns, write_behind, the batch writers
+(write_columns, get_split_write_columns and get_split_write_rows),
+column stats and containers.
 '''
 
 from datetime import date
@@ -73,3 +76,216 @@ def synthesis(prepare_res, params):
 		dw_synthesis_manual.write(sliceno)
 		dw_nonetest.set_slice(sliceno)
 		dw_nonetest.write(**{k: v[0] if k in test_data.not_none_capable else None for k, v in test_data.data.items()})
+	test_compression(params)
+	test_dictionary(params)
+	test_write_behind(params)
+	test_write_columns(params)
+	test_stats(params)
+	test_container(params)
+
+def test_compression(params):
+	dw = DatasetWriter(name="compressed", compression="none")
+	dw.add("raw", "int32")
+	dw.add("fast", "ascii", compression="gzip-1")
+	dw.add("default", "number", compression="gzip")
+	try:
+		dw.add("bad", "int32", compression="snappy")
+		raise Exception("Unknown compression was accepted")
+	except ValueError:
+		pass
+	for sliceno in range(params.slices):
+		dw.set_slice(sliceno)
+		for ix in range(100):
+			dw.write(ix, str(ix), sliceno)
+	ds = dw.finish()
+	assert {n: c.compression for n, c in ds.columns.items()} == {"raw": "none", "fast": "gzip-1", "default": "gzip"}
+	for sliceno in range(params.slices):
+		assert list(ds.iterate(sliceno, ["raw", "fast", "default"])) == [(ix, str(ix), sliceno) for ix in range(100)]
+
+def test_dictionary(params):
+	dw = DatasetWriter(name="bad_dictionary", columns={"code": "dict:ascii"})
+	dw.set_slice(0)
+	try:
+		dw.write(7)
+		raise Exception("dict:ascii accepted an int")
+	except (ValueError, TypeError):
+		pass
+	dw.discard()
+	values = ["red", "green", None, "blue", "green", "red", "red"] * 5
+	want = [(ix, v, v and v[0], b"default" if ix == 3 else v and v.encode("ascii")) for ix, v in enumerate(values)]
+	dw = DatasetWriter(name="dictionary", hashlabel="colour", block_size=3)
+	dw.add("ix", "int32")
+	dw.add("colour", "dict:unicode")
+	dw.add("code", "dict:ascii")
+	dw.add("blob", "dict:bytes", default=b"default")
+	write = dw.get_split_write()
+	for ix, v in enumerate(values):
+		write(ix, v, v and v[0], 42 if ix == 3 else v and v.encode("ascii"))
+	ds = dw.finish()
+	assert ds.columns["colour"].type == "unicode" and ds.columns["colour"].backing_type == "int32"
+	assert ds.columns["colour"].dictionary and not ds.columns["ix"].dictionary
+	assert sorted(ds.iterate(None, ["ix", "colour", "code", "blob"])) == want
+	for sliceno in range(params.slices):
+		rows = list(ds.iterate(sliceno, ["colour", "ix"]))
+		dictionary = ds.dictionary(sliceno, "colour")
+		assert sorted(dictionary, key=str) == sorted(set(v for v, _ in rows), key=str)
+		codes = list(ds.iterate_codes(sliceno, "colour"))
+		assert [dictionary[code] for code in codes] == [v for v, _ in rows]
+		# Values are shared objects from the dictionary
+		for v, _ in rows:
+			assert any(v is d for d in dictionary)
+		assert list(ds.iterate(sliceno, ["colour", "ix"], filters={"colour": {"red"}.__contains__})) == [t for t in rows if t[0] == "red"]
+		assert list(ds.iterate(sliceno, ["colour", "ix"], filters={"colour": lambda v: v is not None and v >= "green"})) == [t for t in rows if t[0] is not None and t[0] >= "green"]
+		assert list(ds.iterate(sliceno, "ix", rows=(2, 5))) == [ix for _, ix in rows[2:5]]
+		assert list(ds.iterate(sliceno, "ix", hashlabel="colour")) == [ix for _, ix in rows]
+	assert sorted(ds.lookup("green", "ix")) == [ix for ix, v in enumerate(values) if v == "green"]
+	rehashed = [list(ds.iterate(sliceno, ["ix", "code"], hashlabel="ix", rehash=True)) for sliceno in range(params.slices)]
+	assert sorted(sum(rehashed, [])) == [t[::2] for t in want]
+
+def test_write_behind(params):
+	import dataset
+	want = [(ix, str(ix), "abc"[ix % 3]) for ix in range(1000)]
+	for kw in (dict(), dict(hashlabel="num"), dict(block_size=64),):
+		dw = DatasetWriter(name="write_behind %r" % (sorted(kw),), write_behind=2, write_behind_batch=100, **kw)
+		dw.add("num", "int32")
+		dw.add("str", "ascii")
+		dw.add("letter", "dict:unicode")
+		write = dw.get_split_write()
+		for t in want:
+			write(*t)
+		ds = dw.finish()
+		assert sorted(ds.iterate(None, ["num", "str", "letter"])) == want
+		assert ds.columns["num"].min == 0 and ds.columns["num"].max == 999
+		assert dw.name in dataset.write_behind_stats
+	dw = DatasetWriter(name="write_behind set_slice", hashlabel="num", write_behind=1, write_behind_batch=7)
+	dw.add("num", "int32")
+	dw.add("str", "ascii")
+	for sliceno in range(params.slices):
+		dw.set_slice(sliceno)
+		dw.enable_hash_discard()
+		for t in want:
+			dw.write(*t[:2])
+	ds = dw.finish()
+	assert sorted(ds.iterate(None, ["num", "str"])) == [t[:2] for t in want]
+	assert list(ds.iterate(None, "num", hashlabel="num")) == list(ds.iterate(None, "num"))
+	# Bad values give an error later, but they do give an error.
+	dw = DatasetWriter(name="write_behind bad", write_behind=1, write_behind_batch=10)
+	dw.add("letter", "dict:ascii")
+	dw.set_slice(0)
+	try:
+		for v in "abcde":
+			dw.write(v)
+		dw.write(7)
+		dw.close()
+		raise Exception("write_behind lost an error")
+	except ValueError:
+		pass
+	dw.discard()
+
+def test_write_columns(params):
+	from array import array
+	nums = list(range(1000))
+	strs = [str(v) for v in nums]
+	# Compare against the normal split writer
+	for hashlabel in (None, "num",):
+		ref = DatasetWriter(name="write_columns ref %s" % (hashlabel,), hashlabel=hashlabel)
+		dw = DatasetWriter(name="write_columns %s" % (hashlabel,), hashlabel=hashlabel)
+		dw_rows = DatasetWriter(name="write_rows %s" % (hashlabel,), hashlabel=hashlabel)
+		for w in (ref, dw, dw_rows,):
+			w.add("num", "int32")
+			w.add("str", "ascii")
+		write = ref.get_split_write()
+		for t in zip(nums, strs):
+			write(*t)
+		write_columns = dw.get_split_write_columns()
+		write_columns({"num": array("i", nums[:17]), "str": strs[:17]})
+		write_columns({"num": nums[17:17], "str": ()})
+		write_columns({"num": nums[17:18], "str": strs[17:18]})
+		write_columns({"str": strs[18:], "num": nums[18:]})
+		write_rows = dw_rows.get_split_write_rows()
+		rows = list(zip(nums, strs))
+		for a, b in ((0, 1), (1, 1), (1, 500), (500, 1000)):
+			write_rows(rows[a:b])
+		ref, ds, ds_rows = ref.finish(), dw.finish(), dw_rows.finish()
+		for sliceno in range(params.slices):
+			want = list(ref.iterate(sliceno, ["num", "str"]))
+			assert list(ds.iterate(sliceno, ["num", "str"])) == want
+			assert list(ds_rows.iterate(sliceno, ["num", "str"])) == want
+	dw = DatasetWriter(name="write_columns set_slice", hashlabel="num")
+	dw.add("num", "int32")
+	dw.add("str", "ascii")
+	for sliceno in range(params.slices):
+		dw.set_slice(sliceno)
+		try:
+			dw.write_columns({"num": nums})
+			raise Exception("write_columns accepted missing columns")
+		except AssertionError:
+			pass
+		try:
+			dw.write_columns({"num": nums, "str": strs})
+			raise Exception("write_columns wrote to the wrong slice")
+		except AssertionError:
+			pass
+		dw.set_slice(sliceno)
+		dw.enable_hash_discard()
+		dw.write_columns({"num": nums, "str": strs})
+	ds = dw.finish()
+	assert sorted(ds.iterate(None, ["num", "str"])) == list(zip(nums, strs))
+	assert list(ds.iterate(None, "num", hashlabel="num")) == list(ds.iterate(None, "num"))
+
+def test_stats(params):
+	previous = None
+	for part in range(2):
+		dw = DatasetWriter(name="stats %d" % (part,), previous=previous, stats=True, write_behind=part)
+		dw.add("num", "int32")
+		dw.add("json", "json")
+		write = dw.get_split_write()
+		# 1350 distinct values (every tenth is None instead)
+		for ix in range(5000):
+			v = None if ix % 10 == 0 else part * 1000 + ix % 1500
+			write(v, {"v": v})
+		previous = dw.finish()
+		stats = previous.columns["num"].stats
+		assert stats.nulls == 500, stats
+		assert stats.size > 0
+		assert 1250 < stats.distinct < 1450, stats
+		assert previous.columns["json"].stats.nulls == 0
+		assert previous.columns["json"].stats.distinct is None
+	stats = previous.chain_column_stats("num")
+	assert stats.nulls == 1000, stats
+	assert stats.size == sum(d.columns["num"].stats.size for d in previous.chain())
+	# 2250 distinct values, the overlapping ones should only count once
+	assert 2100 < stats.distinct < 2400, stats
+	# Size is always there, the rest only with stats=True
+	dw = DatasetWriter(name="no stats", columns={"num": "int32"})
+	dw.get_split_write()(1)
+	stats = dw.finish().columns["num"].stats
+	assert stats.size > 0 and stats.nulls is None and stats.distinct is None
+	assert previous.chain_column_stats("num", stop_ds=previous.previous).nulls == 500
+
+def test_container(params):
+	import os
+	names = ["col %d" % (ix,) for ix in range(20)]
+	rows = [tuple(ix * 100 + c for c in range(20)) for ix in range(1000)]
+	previous = None
+	for part in range(2):
+		dw = DatasetWriter(name="container %d" % (part,), hashlabel="col 0", previous=previous, block_size=64, container=True, stats=True)
+		for n in names:
+			dw.add(n, "int32")
+		write = dw.get_split_write()
+		for t in rows:
+			write(*t)
+		ds = dw.finish()
+		# (The block indexes are still one file per column.)
+		assert sorted(fn for fn in os.listdir(ds.name) if not fn.endswith(".pickle") and not fn.startswith("dataset.")) == ["slice.%d" % (sliceno,) for sliceno in range(params.slices)]
+		assert sorted(ds.iterate(None, names)) == rows
+		assert ds.columns["col 3"].stats.size > 0
+		for sliceno in range(params.slices):
+			got = list(ds.iterate(sliceno, names))
+			assert list(ds.iterate(sliceno, "col 0", hashlabel="col 0")) == [t[0] for t in got]
+			assert list(ds.iterate(sliceno, "col 7", rows=(70, 140))) == [t[7] for t in got[70:140]]
+			fn, offset = ds.column_location("col 5", sliceno)
+			assert fn == ds.column_filename("col 5", sliceno) and offset == ds.columns["col 5"].offsets[sliceno]
+			assert fn.endswith("/slice.%d" % (sliceno,))
+		previous = ds
+	assert sorted(ds.iterate_chain(None, "col 2", prefetch=2)) == sorted([t[2] for t in rows] * 2)
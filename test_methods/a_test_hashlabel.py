@@ -22,10 +22,13 @@ from __future__ import unicode_literals
 
 description = r'''
 Test that hashlabel does what it says in both split_write and hashcheck.
-Then test that rehashing gives the expected result, and that using the
-wrong hashlabel without rehashing is not allowed.
+Then test that rehashing gives the expected result (also with a rehash
+index), that lookup finds the right rows, and that using the wrong
+hashlabel without rehashing is not allowed.
 '''
 
+import os
+
 from dataset import DatasetWriter, Dataset
 from extras import DotDict
 from gzwrite import typed_writer
@@ -126,11 +129,56 @@ def synthesis(prepare_res, params):
 	up = Dataset((params.jobid, "up_checked"))
 	down = Dataset((params.jobid, "down_checked"))
 	unhashed = Dataset((params.jobid, "unhashed_manual"))
+	rehashed = []
 	for sliceno in range(params.slices):
 		a = list(up.iterate(sliceno))
 		b = list(down.iterate(sliceno, hashlabel="up", rehash=True))
 		c = list(unhashed.iterate(sliceno, hashlabel="up", rehash=True))
 		assert sorted(a) == sorted(b) == sorted(c), "Rehashing is broken (slice %d)" % (sliceno,)
+		rehashed.append((b, c,))
+
+	# Rehashing with a rehash index should give exactly the same result.
+	down.make_rehash_index("up")
+	unhashed.make_rehash_index("up")
+	for name in ("down_checked", "unhashed_manual"):
+		assert "up" in Dataset((params.jobid, name))._data.rehash_indexes, "Rehash index not saved in " + name
+	for sliceno in range(params.slices):
+		b = list(down.iterate(sliceno, hashlabel="up", rehash=True))
+		c = list(unhashed.iterate(sliceno, hashlabel="up", rehash=True))
+		assert (b, c,) == rehashed[sliceno], "Rehashing with index is broken (slice %d)" % (sliceno,)
+
+	# Verify that lookup finds the right rows (with and without index),
+	# and nothing for keys that are not there.
+	for use_index in (True, False):
+		for up_v in (0, 1, 4711, 9999):
+			assert up.lookup(up_v, use_index=use_index) == [(9999 - up_v, up_v)]
+			assert down.lookup(up_v, "up", use_index=use_index) == [9999 - up_v]
+		assert up.lookup(10000, use_index=use_index) == []
+		got = down.lookup_many([1, 2, 3, -1], ["up", "down"], use_index=use_index)
+		assert got == {1: [(9998, 1)], 2: [(9997, 2)], 3: [(9996, 3)], -1: []}, got
+	# Several processes looking up at the same time all get the right rows,
+	# and don't leave any lock files. The index is saved with the dataset
+	# (it's from this job), not loose in the job directory.
+	from multiprocessing import Process
+	split = Dataset((params.jobid, "up_split"))
+	def lookups():
+		for up_v in (0, 1, 4711, 9999):
+			assert split.lookup(up_v) == [(9999 - up_v, up_v)]
+	procs = [Process(target=lookups) for _ in range(4)]
+	for p in procs:
+		p.start()
+	for p in procs:
+		p.join()
+		assert p.exitcode == 0, "Concurrent lookup failed"
+	assert not [fn for fn in os.listdir("up_split") if fn.endswith(".lock")], "lookup left lock files"
+	assert [fn for fn in os.listdir("up_split") if ".lookup." in fn], "lookup index not saved with the dataset"
+	assert not [fn for fn in os.listdir(".") if fn.startswith("lookup.")], "lookup index saved in the job directory"
+	try:
+		unhashed.lookup(1)
+	except AssertionError:
+		pass
+	else:
+		assert False, "lookup allowed without a hashlabel"
 
 	# And finally verify that we are not allowed to specify the wrong hashlabel
 	good = True
@@ -23,7 +23,7 @@ from __future__ import unicode_literals
 description = r'''
 Test re-using datasets (from test_selfchain) in new
 chains, and verify that the old chain still works.
-Also tests that the dataset cache is updated correctly
+Also tests that the chain index is updated correctly
 on re-chaining.
 '''
 
@@ -49,29 +49,36 @@ def synthesis(jobid):
 	# check that the original chain is unhurt
 	assert manual_chain == manual_chain[-1].chain()
 
-	# So far so good, now make a chain long enough to have a cache.
+	# So far so good, now make a chain long enough to use several levels
+	# of chain index (each dataset indexes lowbit(depth) previous datasets).
 	prev = None
-	ix = 0
-	going = True
-	while going:
-		if prev and "cache" in Dataset(prev)._data:
-			going = False
+	for ix in range(70):
 		name = "longchain%d" % (ix,)
 		dw = DatasetWriter(name=name, previous=prev)
 		dw.add("ix", "number")
 		dw.get_split_write()(ix)
 		dw.finish()
 		prev = (jobid, name,)
-		ix += 1
-	# we now have a chain that goes one past the first cache point
-	full_chain = Dataset(prev).chain()
-	assert "cache" in full_chain[-2]._data # just to check the above logic is correct
-	assert "cache" not in full_chain[-1]._data # just to be sure..
-	full_chain[-2].link_to_here("nocache", override_previous=None)
-	full_chain[-1].link_to_here("withcache", override_previous=full_chain[-3])
-	assert "cache" not in Dataset(jobid, "nocache")._data
-	assert "cache" in Dataset(jobid, "withcache")._data
-	# And make sure they both get the right data too.
-	assert list(Dataset(prev).iterate_chain(None, "ix")) == list(range(ix))
-	assert list(Dataset(jobid, "nocache").iterate_chain(None, "ix")) == [ix - 2]
-	assert list(Dataset(jobid, "withcache").iterate_chain(None, "ix")) == list(range(ix - 2)) + [ix - 1]
+	last = Dataset(prev)
+	full_chain = last.chain()
+	assert full_chain == [Dataset(jobid, "longchain%d" % (ix,)) for ix in range(70)]
+	assert [ds._data.chain_depth for ds in full_chain] == list(range(1, 71))
+	# check against walking .previous manually
+	walked = [last]
+	while walked[-1].previous:
+		walked.append(Dataset(walked[-1].previous))
+	assert walked == full_chain[::-1]
+	assert last.chain(length=40, reverse=True) == walked[:40]
+	assert last.chain(stop_ds=full_chain[5]) == full_chain[6:]
+	assert [e.id for e in last.chain_entries()] == full_chain
+	assert [sum(e.lines) for e in last.chain_entries()] == [1] * 70
+	full_chain[-2].link_to_here("noprev", override_previous=None)
+	full_chain[-1].link_to_here("rechained", override_previous=full_chain[-3])
+	assert Dataset(jobid, "noprev").chain() == [Dataset(jobid, "noprev")]
+	assert Dataset(jobid, "rechained").chain() == full_chain[:-2] + [Dataset(jobid, "rechained")]
+	assert Dataset(jobid, "rechained")._data.chain_depth == 69
+	# And make sure they all get the right data too.
+	assert list(last.iterate_chain(None, "ix")) == list(range(70))
+	assert list(Dataset(jobid, "noprev").iterate_chain(None, "ix")) == [68]
+	assert list(Dataset(jobid, "rechained").iterate_chain(None, "ix")) == list(range(68)) + [69]
+	assert list(last.iterate_chain(None, "ix", range={"ix": (30, 33)})) == [30, 31, 32]
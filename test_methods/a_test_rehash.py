@@ -22,6 +22,7 @@ from __future__ import unicode_literals
 
 description = r'''
 Verify the dataset_rehash method with various options.
+Also tests datasets with segments (which dataset_rehash makes).
 '''
 
 import subjobs
@@ -106,3 +107,25 @@ def synthesis(params):
 	a = verify(params.slices, data, ds, hashlabel="date")
 	b = verify(params.slices, data + bonus_data, bonus_ds, hashlabel="date", previous=a)
 	assert b.chain() == [a, b], "chain of %s is not [%s, %s] as expected" % (b, a, b)
+	test_segments(params, b)
+
+def test_segments(params, ds):
+	# dataset_rehash (without as_chain) doesn't copy the per slice files together.
+	assert all(c.segments for c in ds.columns.values())
+	for sliceno in range(params.slices):
+		segments = ds.column_segments("number", sliceno)
+		assert len(segments) == params.slices
+		assert sum(count for _, _, count in segments) == ds.lines[sliceno]
+		whole = list(ds.iterate(sliceno, ["number", "date"]))
+		assert list(ds.iterate(sliceno, ["number", "date"], rows=(1, 3))) == whole[1:3]
+		indices = list(range(len(whole)))[::-1]
+		assert ds.get_rows(sliceno, indices, ["number", "date"]) == whole[::-1]
+		assert list(Dataset.iterate_list(sliceno, "number", [ds], prefetch=1)) == [t[0] for t in whole]
+		if whole:
+			ds.column_buffer(sliceno, "number")
+			assert list(ds.iterate(sliceno, "number")) == [t[0] for t in whole]
+	try:
+		ds.column_filename("number", 0)
+		raise Exception("column_filename worked on a column with segments")
+	except AssertionError:
+		pass
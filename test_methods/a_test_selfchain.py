@@ -23,11 +23,20 @@ from __future__ import unicode_literals
 description = r'''
 Tests creating several chained datasets in one job.
 Exercises DatasetWriter.finish and the chaining logic
-including callbacks with SkipJob.
+including callbacks with SkipJob, prefetching and parallel iteration.
+Also tests the dataset metadata cache (with a size limit
+and with the shared tier), and that small columns in a chain
+built in one job are merged into one file.
 '''
 
-from dataset import DatasetWriter, SkipJob
+import os
+from tempfile import mkdtemp
+from shutil import rmtree
+
+import dataset
+from dataset import Dataset, DatasetWriter, SkipJob
 from extras import DotDict
+from jobid import resolve_jobid_filename
 
 def prepare(params):
 	dws = {}
@@ -60,10 +69,12 @@ def synthesis(prepare_res, params):
 	last = ds.h
 	assert last.chain() == sorted(ds.values())
 	ds.last = last
-	test_partial_chains(ds)
+	test_partial_chains(ds, params)
 	test_filters(ds)
+	test_cache(ds)
+	test_merge(ds, params)
 
-def test_partial_chains(ds):
+def test_partial_chains(ds, params):
 	alles = list(ds.last.iterate_chain(None))
 	part1 = list(ds.b.iterate_chain(None))
 	part2 = list(ds.e.iterate_chain(None, length=3))
@@ -77,6 +88,33 @@ def test_partial_chains(ds):
 	assert seen == ds.g.chain(length=2)
 	part4 = list(ds.last.iterate(None))
 	assert alles == part1 + part2 + part3 + part4
+	before = dict(dataset.prefetch_stats)
+	assert list(ds.last.iterate_chain(None, prefetch=2)) == alles
+	seen = dataset.prefetch_stats.hits + dataset.prefetch_stats.misses - before["hits"] - before["misses"]
+	assert seen == len(ds.last.chain()) * params.slices, "Prefetching saw %d datasets" % (seen,)
+	assert list(ds.last.iterate_chain(0, "num", prefetch=100, pre_callback=only_f_and_g_cb)) == [num for _, num in part3 if num < 0]
+	# Columns can be a tuple too
+	assert list(ds.last.iterate(1, ("ds", "num",))) == list(ds.last.iterate(1, ["ds", "num"]))
+	assert list(ds.last.iterate_chain(None, ("ds", "num",))) == alles
+	assert list(ds.last.iterate_chain(None, ("ds", "num",), prefetch=2, range={"num": (None, None)})) == alles
+	assert list(ds.last.iterate_chain(None, parallel=3)) == alles
+	assert sorted(ds.last.iterate_chain(None, parallel=2, ordered=False)) == sorted(alles)
+	assert list(ds.last.iterate_chain(None, ["ds", "num"], parallel=4, filters={"ds": {"c", "e"}.__contains__}, translators={"num": lambda v: v * 2})) == [(name, num * 2) for name, num in alles if name in "ce"]
+	it = ds.last.iterate_chain(None, parallel=2)
+	assert next(it) == alles[0]
+	del it # should stop the workers
+	try:
+		list(ds.last.iterate_chain(None, "num", parallel=2, translators={"num": lambda v: 1 // (v - 1)}))
+		raise Exception("Error in parallel worker was not reported")
+	except ZeroDivisionError:
+		raise Exception("Error in parallel worker raised in the wrong process?")
+	except Exception as e:
+		assert "ZeroDivisionError" in str(e), e
+	sample = ds.last.sample_chain(None, n=5, seed=1)
+	assert len(sample) == 5 and set(sample) <= set(alles)
+	assert sample == ds.last.sample_chain(None, n=5, seed=1)
+	assert ds.last.sample_chain(None, fraction=1) == alles
+	assert set(ds.e.sample_chain(None, n=100, length=3)) == set(part2)
 	two_by_length = ds.d.chain(length=2)
 	two_by_id = ds.d.chain(stop_ds=ds.b)
 	assert two_by_length == two_by_id
@@ -113,3 +151,76 @@ def test_filters(ds):
 	# Test filtering with (non-tupled) single column
 	just_0_num_plus_2_pos = list(ds.last.iterate_chain(0, columns="num", filters={"num": lambda v: v > 0}, translators={"num": (2).__add__}))
 	assert just_0_num_plus_2_pos == [t[1] for t in just_0_plus_2_pos]
+	# Filters only see rows in the range (and in the slice when rehashing)
+	in_range = list(ds.last.iterate_chain(None, range={"num": (10, 20)}))
+	assert in_range and all(name in "efgh" for name, _ in in_range)
+	even = {num: num % 4 == 0 for _, num in in_range}
+	assert list(ds.last.iterate_chain(None, range={"num": (10, 20)}, filters={"num": even.__getitem__})) == [t for t in in_range if t[1] % 4 == 0]
+	seen = []
+	def record(name):
+		seen.append(name)
+		return name != "f"
+	assert list(ds.last.iterate_chain(None, "ds", range={"num": (10, 20)}, filters={"ds": record})) == [name for name, _ in in_range if name != "f"]
+	assert seen == [name for name, _ in in_range], "The filter saw rows outside the range"
+	for sliceno in (0, 1,):
+		rehashed = list(ds.last.iterate_chain(sliceno, "num", hashlabel="num", rehash=True))
+		odd = {num: num % 2 == 1 for num in rehashed}
+		assert list(ds.last.iterate_chain(sliceno, "num", hashlabel="num", rehash=True, filters={"num": odd.__getitem__})) == [num for num in rehashed if num % 2 == 1]
+	# A range that skips every dataset in the chain gives nothing
+	assert list(ds.last.iterate_chain(None, range={"num": (1000, 2000)})) == []
+	assert list(ds.last.iterate_chain(0, range={"num": (1000, 2000)}, filters={"ds": "c".__eq__})) == []
+
+def test_cache(ds):
+	alles = list(ds.last.iterate_chain(None))
+	old_size = dataset._ds_cache.max_size
+	try:
+		# Too small for anything, so only the last loaded dataset is kept.
+		dataset.set_cache_size(1)
+		assert len(dataset._ds_cache) == 1
+		assert list(Dataset(ds.last).iterate_chain(None)) == alles
+		assert len(dataset._ds_cache) == 1
+	finally:
+		dataset.set_cache_size(old_size)
+	tmp = mkdtemp()
+	chain = ds.last.chain()
+	# The shared cache is only for datasets without a dataset.meta (older ones).
+	metas = [resolve_jobid_filename(d.jobid, d._name("meta")) for d in chain]
+	for fn in metas:
+		os.rename(fn, fn + ".hidden")
+	try:
+		dataset.enable_shared_cache(tmp)
+		for d in chain:
+			dataset._ds_cache.pop(d)
+		assert list(Dataset(ds.last).iterate_chain(None)) == alles
+		assert len(os.listdir(tmp)) == len(chain), "Datasets not saved in shared cache"
+		for d in chain:
+			dataset._ds_cache.pop(d)
+		# Now they come from the shared cache, and should be the same.
+		assert [Dataset(d)._data for d in chain] == [d._data for d in chain]
+		assert list(Dataset(ds.last).iterate_chain(None)) == alles
+	finally:
+		dataset.enable_shared_cache(None)
+		rmtree(tmp)
+		for fn in metas:
+			os.rename(fn + ".hidden", fn)
+		for d in chain:
+			dataset._ds_cache.pop(d)
+
+def test_merge(ds, params):
+	if params.slices < 2:
+		return
+	chain = ds.last.chain()
+	assert len(set(d.columns["num"].location for d in chain)) == 1, "Chain in one job not merged to one file"
+	assert len(set(d.columns["num"].offsets[0] for d in chain)) == len(chain)
+	try:
+		dataset.set_merge_threshold(0)
+		dw = DatasetWriter(name="unmerged", previous=ds.last)
+		dw.add("num", "number")
+		for sliceno in range(params.slices):
+			dw.set_slice(sliceno)
+			dw.write(sliceno)
+		unmerged = dw.finish()
+	finally:
+		dataset.set_merge_threshold(None)
+	assert not unmerged.columns["num"].offsets
+	assert list(unmerged.iterate_chain(None, "num")) == list(ds.last.iterate_chain(None, "num")) + list(range(params.slices))
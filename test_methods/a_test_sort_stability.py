@@ -21,7 +21,7 @@ from __future__ import division
 from __future__ import unicode_literals
 
 description = r'''
-Test that dataset_sort sorts stably.
+Test that dataset_sort sorts stably (also when using memory_limit).
 
 Also tests DatasetWriter (again), and also DatasetWriter.finish()
 '''
@@ -58,16 +58,19 @@ def analysis(sliceno, prepare_res):
 def synthesis(params, prepare_res):
 	dw = prepare_res
 	source = dw.finish()
-	jid = subjobs.build(
-		"dataset_sort",
-		options=dict(
-			sort_columns="num",
-			sort_across_slices=True,
-		),
-		datasets=dict(source=source),
-	)
-	ds = Dataset(jid)
-	data = list(ds.iterate(None, "str"))
 	good = list("cghjabdefi") + \
 	       [str(sliceno) for sliceno in range(params.slices)] * 64
-	assert data == good
+	# Also with a memory_limit small enough to need many runs (and merges).
+	for memory_limit in (0, 2000,):
+		jid = subjobs.build(
+			"dataset_sort",
+			options=dict(
+				sort_columns="num",
+				sort_across_slices=True,
+				memory_limit=memory_limit,
+			),
+			datasets=dict(source=source),
+		)
+		ds = Dataset(jid)
+		data = list(ds.iterate(None, "str"))
+		assert data == good, "Unstable sort with memory_limit=%d (%s)" % (memory_limit, jid,)
@@ -21,14 +21,17 @@ from __future__ import division
 from __future__ import unicode_literals
 
 description = r'''
-Test dataset_sort with various options on a dataset with all types.
+Test dataset_sort with various options on a dataset with all types,
+also with a memory_limit small enough to sort on disk.
 '''
 
+import os
 from itertools import chain
 from math import isnan
 from functools import cmp_to_key
 
 from dataset import Dataset
+from jobid import resolve_jobid_filename
 import subjobs
 from . import test_data
 
@@ -46,12 +49,13 @@ def unnan(l):
 		tuple('NaN' if isinstance(v, float) and isnan(v) else v for v in t)
 	for t in l]
 
-def check_one(slices, key, source, reverse=False):
+def check_one(slices, key, source, reverse=False, memory_limit=0):
 	jid = subjobs.build(
 		"dataset_sort",
 		options=dict(
 			sort_columns=key,
 			sort_order="descending" if reverse else "ascending",
+			memory_limit=memory_limit,
 		),
 		datasets=dict(source=source),
 	)
@@ -95,20 +99,27 @@ def synthesis(params):
 		check_one(params.slices, key, source)
 	# Check reverse sorting
 	check_one(params.slices, "int32", source, reverse=True)
+	# Check merging runs from disk (memory_limit=1 gives one row per run)
+	for key in ("ascii", "float64", "datetime",):
+		check_one(params.slices, key, source, memory_limit=1)
+	check_one(params.slices, "int32", source, reverse=True, memory_limit=1)
 	# Check that sorting across slices and by two columns works
-	jid = subjobs.build(
-		"dataset_sort",
-		options=dict(
-			sort_columns=["int64", "int32"],
-			sort_order="descending",
-			sort_across_slices=True,
-		),
-		datasets=dict(source=source),
-	)
 	int64_off = sorted(test_data.data).index("int64")
 	int32_off = sorted(test_data.data).index("int32")
 	all_data = chain.from_iterable(test_data.sort_data_for_slice(sliceno) for sliceno in range(params.slices))
 	good = sorted(all_data, key=lambda t: (noneninf(t[int64_off]), noneninf(t[int32_off]),), reverse=True)
-	ds = Dataset(jid)
-	check = list(ds.iterate(None))
-	assert unnan(check) == unnan(good), "Sorting across slices on [int64, int32] bad (%s)" % (jid,)
+	for memory_limit in (0, 1,):
+		jid = subjobs.build(
+			"dataset_sort",
+			options=dict(
+				sort_columns=["int64", "int32"],
+				sort_order="descending",
+				sort_across_slices=True,
+				memory_limit=memory_limit,
+			),
+			datasets=dict(source=source),
+		)
+		ds = Dataset(jid)
+		check = list(ds.iterate(None))
+		assert unnan(check) == unnan(good), "Sorting across slices on [int64, int32] bad (%s)" % (jid,)
+		assert not [fn for fn in os.listdir(resolve_jobid_filename(jid, '')) if fn.startswith('sort.')], "Run files left in %s" % (jid,)
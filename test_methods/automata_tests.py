@@ -43,6 +43,9 @@ def main(urd):
 	urd.build("test_compare_datasets", datasets=dict(a=reimp_csv, b=reimp_csv_uncompressed))
 	urd.build("test_compare_datasets", datasets=dict(a=reimp_csv, b=reimp_csv_quoted))
 	urd.build("test_dataset_column_names")
+	urd.build("test_dataset_blocks")
+	urd.build("test_dataset_iterate_blocks")
+	urd.build("test_dataset_meta")
 
 	print()
 	print("Testing csvimport with more difficult files")